@@ -0,0 +1,103 @@
+"""
+Compares the throughput of GCNParser against the original split-based parser.
+
+Notices are read from the files given on the command line (one notice per file, e.g.
+saved from a replayed stream), or a built-in example notice is used.
+
+    PYTHONPATH=. python benchmarks/bench_parser.py [-n ROUNDS] [NOTICE_FILE ...]
+"""
+import argparse
+import time
+from pathlib import Path
+
+from stellarium_gcn_wp.gcn_parser import GCNParser, GCNNotice
+
+EXAMPLE_NOTICE = """TITLE:            GCN/AMON NOTICE
+NOTICE_DATE:      Wed 06 Mar 24 21:24:46 UT
+NOTICE_TYPE:      ICECUBE Astrotrack Gold
+STREAM:           24
+RUN_NUM:          138966
+EVENT_NUM:        1234567
+SRC_RA:           53.7456d {+03h 34m 59s} (J2000),
+                  53.9845d {+03h 35m 56s} (current),
+                  53.1236d {+03h 32m 30s} (1950)
+SRC_DEC:          +2.3423d {+02d 20' 32"} (J2000),
+                  +2.3985d {+02d 23' 54"} (current),
+                  +2.1825d {+02d 10' 57"} (1950)
+SRC_ERROR:        1.23 [deg radius, stat-only, 90% containment]
+SRC_ERROR50:      0.45 [deg radius, stat-only, 50% containment]
+DISCOVERY_DATE:   20375 TJD;    66 DOY;   24/03/06 (yy/mm/dd)
+DISCOVERY_TIME:   76937 SOD {21:22:17.00} UT
+REVISION:         0
+ENERGY:           2.3050e+02 [TeV]
+SIGNALNESS:       6.1523e-01 [dn]
+FAR:              0.1234 [yr^-1]
+SUN_POSTN:        346.47d {+23h 05m 52s}   -5.64d {-05d 38' 13"}
+SUN_DIST:         72.52 [deg]   Sun_angle= 4.8 [hr] (East of Sun)
+MOON_POSTN:       303.83d {+20h 15m 18s}  -22.67d {-22d 40' 21"}
+MOON_DIST:        112.95 [deg]
+GAL_COORDS:       180.53,-39.72 [deg] galactic lon,lat of the event
+ECL_COORDS:        54.71,-15.94 [deg] ecliptic lon,lat of the event
+COMMENTS:         IceCube Gold event.
+COMMENTS:         The position error is statistical only, there is no systematic added.
+"""
+
+
+def legacy_parse(notice: str) -> GCNNotice:
+    # The parser as it was before the regex table, for comparison
+    lines = notice.split("\n")
+    kv = {}
+    for line in lines:
+        pos = line.find(":")
+        if pos < 0:
+            continue
+        kv[line[0:pos]] = line[pos + 1:].strip()
+
+    gal_lon, gal_lat = kv['GAL_COORDS'].split('[deg]')[0].split(',')
+
+    return GCNNotice(
+        notice_type=kv['NOTICE_TYPE'],
+        run_num=int(kv['RUN_NUM']),
+        evt_num=int(kv['EVENT_NUM']),
+        ra=float(kv['SRC_RA'].split('d')[0]),
+        dec=float(kv['SRC_DEC'].split('d')[0]),
+        tjd=int(kv["DISCOVERY_DATE"].split("TJD")[0]),
+        sod=int(kv["DISCOVERY_TIME"].split("SOD")[0]),
+        gal_lon=float(gal_lon),
+        gal_lat=float(gal_lat),
+        energy=float(kv["ENERGY"].split('[')[0]),
+        signalness=float(kv["SIGNALNESS"].split('[')[0]),
+        revision=int(kv["REVISION"])
+    )
+
+
+def bench(name: str, fn, notices, rounds: int):
+    t_start = time.perf_counter()
+    for _ in range(rounds):
+        fn(notices)
+    dt = time.perf_counter() - t_start
+    n = len(notices) * rounds
+    print(f"{name:>12}: {n / dt:12.0f} notices/s ({dt / n * 1e6:.2f} us/notice)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--rounds", type=int, default=20000)
+    parser.add_argument("files", nargs="*", type=Path)
+    args = parser.parse_args()
+
+    notices = [f.read_text() for f in args.files] or [EXAMPLE_NOTICE]
+    text_notices = [n for n in notices if GCNParser.detect_format(n) == "text"]
+    rounds = max(1, args.rounds // len(notices))
+
+    for new, old in zip(GCNParser.parse_many(text_notices), map(legacy_parse, text_notices)):
+        assert new == old, f"Parsers disagree: {new} != {old}"
+
+    if text_notices:
+        bench("legacy", lambda ns: [legacy_parse(n) for n in ns], text_notices, rounds)
+        bench("parse_text", lambda ns: [GCNParser.parse_text(n) for n in ns], text_notices, rounds)
+    bench("parse_many", GCNParser.parse_many, notices, rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+Measures the render pipeline: startup overhead and phase latencies of single renders with
+Renderer, and throughput of main's render pool with several concurrent jobs, together with
+the peak memory use. Results are compared against a baseline in benchmarks/baselines/, and
+the script exits with status 1 if any of them got worse by more than the tolerance.
+
+The "stub" profile replaces stellarium, Xvfb and xdotool with the scripts in
+benchmarks/stub/, which write the render script's markers after fixed delays, so it runs
+anywhere and mostly measures our own overhead. The "real" profile uses the installed
+programs, like a normal render.
+
+The durations are mostly the stub's fixed delays, but the throughput depends on how many
+cpus the machine has and how fast it starts processes. So it isn't compared directly, but
+as throughput_ratio: the throughput relative to what the sequential renders of the same
+run allow, i.e. -j JOBS renders per render_s, or fewer if the cpu time a render took in the
+same run doesn't fit on the machine's cpus that often. The durations get more slack on
+machines that start processes slowly: spawn_s, the time a bare python takes to start in
+the same run, is added to TIME_SLACK for every process a phase waits for.
+
+Run it from the repository root with the package importable, e.g.
+
+    PYTHONPATH=. python benchmarks/bench_pipeline.py [--profile stub|real] [-n RENDERS] [-j JOBS] [--save-baseline]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from dataclasses import replace
+from pathlib import Path
+
+from stellarium_gcn_wp import main as sgw_main
+from stellarium_gcn_wp.gcn_parser import GCNParser
+from stellarium_gcn_wp.main import make_hook_executor, make_pool, make_render_params
+from stellarium_gcn_wp.render_queue import QueuedNotice, RenderQueue
+from stellarium_gcn_wp.renderer import Renderer
+
+from bench_parser import EXAMPLE_NOTICE
+
+STUB_DIR = Path(__file__).parent / "stub"
+BASELINE_DIR = Path(__file__).parent / "baselines"
+
+# Seconds the stub waits before each marker. Roughly the shape of a real render, scaled down
+STUB_DELAYS = {"init": 0.3, "render_loop": 0.1, "screen_sized": 0.05, "settled": 0.2, "shot": 0.05}
+STUB_MEMORY_MB = 64
+
+# Metrics where a larger value is better. Everything else is a duration or a size.
+HIGHER_IS_BETTER = {"throughput_ratio"}
+# Metrics that depend on the machine and are only reported, the others are relative to them
+MACHINE_DEPENDENT = {"throughput_per_s", "cpu_per_render_s", "spawn_s"}
+# Differences below this many seconds are noise, even if they are above the tolerance
+TIME_SLACK = 0.05
+# How many processes each duration waits for to start, each gets spawn_s more slack
+SPAWNS = {"startup_s": 2, "render_s": 3, "phase_xvfb_up_s": 1, "phase_render_loop_s": 1,
+          "phase_screen_sized_s": 1}
+
+
+def use_profile(profile: str):
+    if profile == "stub":
+        os.environ["PATH"] = f"{STUB_DIR.absolute()}{os.pathsep}{os.environ['PATH']}"
+        os.environ["SGW_STUB_DELAYS"] = json.dumps(STUB_DELAYS)
+        os.environ["SGW_STUB_MEMORY_MB"] = str(STUB_MEMORY_MB)
+
+    s = sgw_main.Settings
+    s.render_cpu_limit = -1
+    s.render_server = False
+    s.render_cache_dir = None
+    s.base_layer_cache_dir = None
+    s.post_render_callbacks = ()
+    s.priority_preempt_margin = None
+    s.render_display_base = 150
+    s._ra_view_offset = 0.0
+    s._dec_view_offset = 0.0
+
+
+def cpu_time() -> float:
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+def bench_spawn(runs: int = 5) -> dict:
+    times = []
+    for _ in range(runs):
+        t_start = time.monotonic()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        times.append(time.monotonic() - t_start)
+    return {"spawn_s": statistics.median(times)}
+
+
+def bench_renders(render_params, renders: int, tmp_dir: Path) -> dict:
+    phases = defaultdict(list)
+    startups = []
+    totals = []
+    cpu_start = cpu_time()
+    for i in range(renders):
+        t_start = last = time.monotonic()
+
+        def on_phase(phase: str):
+            nonlocal last
+            now = time.monotonic()
+            phases[phase].append(now - last)
+            if phase == "render_loop":
+                startups.append(now - t_start)
+            last = now
+
+        renderer = Renderer(render_params, display=":150", tmp_root=tmp_dir)
+        if not asyncio.run(renderer.render(tmp_dir / f"render_{i}.png", on_phase=on_phase)):
+            raise RuntimeError(f"Render {i} failed")
+        totals.append(time.monotonic() - t_start)
+
+    result = {"startup_s": statistics.mean(startups), "render_s": statistics.mean(totals),
+              "cpu_per_render_s": (cpu_time() - cpu_start) / renders}
+    result.update({f"phase_{phase}_s": statistics.mean(dts) for phase, dts in phases.items()})
+    return result
+
+
+async def bench_throughput(notice, jobs: int, renders: int, tmp_dir: Path) -> dict:
+    sgw_main.Settings.render_workers = jobs
+    sgw_main.Settings.out_file_name = str(tmp_dir / "pool_{evt_num}.png")
+
+    queue = RenderQueue()
+    hook_executor = make_hook_executor()
+    pool = make_pool(queue, False, hook_executor)
+    for i in range(renders):
+        await queue.put(QueuedNotice(text=EXAMPLE_NOTICE, notice=replace(notice, evt_num=notice.evt_num + i)))
+
+    t_start = time.monotonic()
+    rendering = asyncio.create_task(pool.run(), name="bench-pool")
+    try:
+        await queue.join()
+        elapsed = time.monotonic() - t_start
+    finally:
+        await pool.stop()
+        await rendering
+        await hook_executor.shutdown(wait=True)
+
+    rendered = len(list(tmp_dir.glob("pool_*.png")))
+    if rendered != renders:
+        raise RuntimeError(f"Only {rendered} of {renders} renders were written")
+    return {"throughput_per_s": renders / elapsed}
+
+
+def memory() -> dict:
+    # ru_maxrss is in KiB on linux. For children it is the largest single process.
+    return {"peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "child_peak_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+
+
+def throughput_ratio(results: dict, jobs: int) -> float:
+    cpus = len(os.sched_getaffinity(0))
+    ideal = min(jobs / results["render_s"], cpus / max(results["cpu_per_render_s"], 1e-6))
+    return results["throughput_per_s"] / ideal
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for name, value in results.items():
+        if name not in baseline or name in MACHINE_DEPENDENT:
+            continue
+        base = baseline[name]
+        if name in HIGHER_IS_BETTER:
+            worse = value < base * (1 - tolerance)
+        else:
+            worse = value > base * (1 + tolerance)
+            if name.endswith("_s"):
+                slack = TIME_SLACK + SPAWNS.get(name, 0) * results["spawn_s"]
+                worse = worse and value - base > slack
+        if worse:
+            regressions.append(f"{name}: {value:.3f} (baseline {base:.3f})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--profile", choices=["stub", "real"], default="stub")
+    parser.add_argument("-n", "--renders", type=int, default=5, help="Sequential renders for the phase timings")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="Concurrent render workers for the throughput")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed relative regression against the baseline")
+    parser.add_argument("--baseline", type=Path, help="Baseline file, by default baselines/<profile>.json")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("notice", nargs="?", type=Path)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    use_profile(args.profile)
+
+    notice = GCNParser.parse(args.notice.read_text() if args.notice else EXAMPLE_NOTICE)
+    render_params = make_render_params(notice)
+
+    results = bench_spawn()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results.update(bench_renders(render_params, args.renders, Path(tmp_dir)))
+        results.update(asyncio.run(bench_throughput(notice, args.jobs, args.jobs * args.renders, Path(tmp_dir))))
+    results["throughput_ratio"] = throughput_ratio(results, args.jobs)
+    results.update(memory())
+
+    for name, value in results.items():
+        print(f"{name:>28}: {value:9.3f}")
+
+    baseline_path = args.baseline or BASELINE_DIR / f"{args.profile}.json"
+    if args.save_baseline:
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        baseline_path.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"Saved baseline to {baseline_path}")
+        return
+
+    if not baseline_path.exists():
+        print(f"No baseline at {baseline_path}, run with --save-baseline to create one")
+        return
+    regressions = compare(results, json.loads(baseline_path.read_text()), args.tolerance)
+    if regressions:
+        print("Regressions against the baseline:")
+        for regression in regressions:
+            print(f"  {regression}")
+        raise SystemExit(1)
+    print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
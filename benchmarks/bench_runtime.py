@@ -0,0 +1,105 @@
+"""
+Measures what the long running pipeline costs while it waits for notices, and how long it
+takes to shut down. Starts the command line tool with a synthetic replay, using the stub
+programs of bench_pipeline.py, and waits until the notices are rendered. Then it counts
+the cpu time and context switches (i.e. wakeups) of all threads of the process while it
+is idle, and times how long the process takes to exit after a signal.
+
+    PYTHONPATH=. python benchmarks/bench_runtime.py [--idle SECONDS] [--signal TERM|INT] [-n NOTICES]
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from bench_pipeline import STUB_DELAYS, STUB_DIR, STUB_MEMORY_MB
+
+CONFIG = """
+render_display_base = 190
+out_file_name = "{out_dir}/wp_{{evt_num}}_{{revision}}.png"
+archive_path = "{out_dir}/archive.sqlite"
+observer_location = [10.0, 50.0]
+post_render_callbacks = []
+"""
+
+
+def process_stats(pid: int) -> dict:
+    ticks = os.sysconf("SC_CLK_TCK")
+    fields = Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()
+    switches = 0
+    threads = 0
+    for task in Path(f"/proc/{pid}/task").iterdir():
+        try:
+            for line in (task / "status").read_text().splitlines():
+                if line.startswith(("voluntary_ctxt_switches", "nonvoluntary_ctxt_switches")):
+                    switches += int(line.split()[1])
+            threads += 1
+        except OSError:
+            continue
+    return {"cpu_s": (int(fields[11]) + int(fields[12])) / ticks, "switches": switches, "threads": threads}
+
+
+def wait_for_renders(out_dir: Path, process: subprocess.Popen, quiet: float = 2.0, timeout: float = 120.0):
+    # Waits until some outputs are written and no new ones appear for `quiet` seconds
+    t_start = time.monotonic()
+    count, last_change = 0, time.monotonic()
+    while time.monotonic() - t_start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"The pipeline exited with code {process.returncode}")
+        current = len(list(out_dir.glob("wp_*.png")))
+        if current != count:
+            count, last_change = current, time.monotonic()
+        elif count and time.monotonic() - last_change >= quiet:
+            return count
+        time.sleep(0.1)
+    raise RuntimeError("Timed out waiting for renders")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--idle", type=float, default=10.0, help="Seconds to measure the idle pipeline for")
+    parser.add_argument("--signal", choices=["TERM", "INT"], default="TERM", help="Signal to stop the pipeline with")
+    parser.add_argument("-n", "--notices", type=int, default=2, help="Synthetic events to render first")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env["PATH"] = f"{STUB_DIR.absolute()}{os.pathsep}{env['PATH']}"
+    env["SGW_STUB_DELAYS"] = json.dumps(STUB_DELAYS)
+    env["SGW_STUB_MEMORY_MB"] = str(STUB_MEMORY_MB)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_dir = Path(tmp_dir)
+        config = out_dir / "settings.toml"
+        config.write_text(CONFIG.format(out_dir=out_dir))
+        cmd = [sys.executable, "-m", "stellarium_gcn_wp.main", "--config", str(config), "-s", "first",
+               "--synthetic", str(args.notices), "--replay-speed", "0"]
+        process = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            rendered = wait_for_renders(out_dir, process)
+            before = process_stats(process.pid)
+            time.sleep(args.idle)
+            after = process_stats(process.pid)
+
+            t_signal = time.monotonic()
+            process.send_signal(getattr(signal, f"SIG{args.signal}"))
+            process.wait(timeout=60)
+            shutdown = time.monotonic() - t_signal
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+    print(f"{'rendered':>20}: {rendered}")
+    print(f"{'threads':>20}: {after['threads']}")
+    print(f"{'idle wakeups/s':>20}: {(after['switches'] - before['switches']) / args.idle:9.1f}")
+    print(f"{'idle cpu ms/s':>20}: {(after['cpu_s'] - before['cpu_s']) * 1000 / args.idle:9.1f}")
+    print(f"{'shutdown s':>20}: {shutdown:9.3f} (exit code {process.returncode})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Compares renders with the original 10 s wait at 1 fps before the screenshot, the default
+settle delay (10 s at a higher frame rate) and a shorter `--delay` (see SettleParams):
+the wall time of each, and with Pillow installed, how many pixels of the shorter delay's
+image differ from the default one. A shorter delay is only safe if none do. Needs
+stellarium, Xvfb and xdotool, like a normal render.
+
+    PYTHONPATH=. python benchmarks/bench_settle.py [-n RENDERS] [--delay 1.0] [--display :150] [NOTICE_FILE]
+"""
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import List
+
+from stellarium_gcn_wp.gcn_parser import GCNParser
+from stellarium_gcn_wp.main import make_render_params
+from stellarium_gcn_wp.renderer import Renderer, SettleParams
+from stellarium_gcn_wp.resources import ResourceLimits
+
+from bench_parser import EXAMPLE_NOTICE
+
+
+def run(name: str, settle: SettleParams, render_params, renders: int, display: str, cpu_limit: float,
+        out_dir: Path) -> List[Path]:
+    phases = defaultdict(list)
+    totals = []
+    paths = []
+    for i in range(renders):
+        t_start = last = time.monotonic()
+
+        def on_phase(phase: str):
+            nonlocal last
+            now = time.monotonic()
+            phases[phase].append(now - last)
+            last = now
+
+        path = out_dir / f"{name}_{i}.png"
+        renderer = Renderer(render_params, limits=ResourceLimits(cpu_quota=cpu_limit), display=display, settle=settle)
+        if not asyncio.run(renderer.render(path, on_phase=on_phase)):
+            raise RuntimeError(f"Render {i} with {name} failed")
+        totals.append(time.monotonic() - t_start)
+        paths.append(path)
+
+    print(f"{name}: {statistics.mean(totals):.2f} s/render (min {min(totals):.2f}, max {max(totals):.2f})")
+    for phase, dts in phases.items():
+        print(f"  {phase:>12}: {statistics.mean(dts):7.2f} s")
+    return paths
+
+
+def differing_pixels(a_path: Path, b_path: Path) -> float:
+    from PIL import Image, ImageChops
+
+    with Image.open(a_path) as a, Image.open(b_path) as b:
+        diff = ImageChops.difference(a.convert("RGB"), b.convert("RGB")).convert("L")
+    histogram = diff.histogram()
+    return sum(histogram[1:]) / sum(histogram)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--renders", type=int, default=3)
+    parser.add_argument("--delay", type=float, default=1.0, help="The shorter settle delay to check, in seconds")
+    parser.add_argument("--display", type=str, default=":150")
+    parser.add_argument("--cpu-limit", type=float, default=-1)
+    parser.add_argument("notice", nargs="?", type=Path)
+    args = parser.parse_args()
+
+    notice = GCNParser.parse(args.notice.read_text() if args.notice else EXAMPLE_NOTICE)
+    render_params = make_render_params(notice)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        renders = {name: run(name, settle, render_params, args.renders, args.display, args.cpu_limit, Path(tmp_dir))
+                   for name, settle in (("fixed", SettleParams.fixed()), ("default", SettleParams()),
+                                        ("short", SettleParams(delay=args.delay)))}
+        try:
+            diffs = [differing_pixels(a, b) for a, b in zip(renders["default"], renders["short"])]
+        except ImportError:
+            print("Install Pillow to compare the images")
+            return
+    print(f"a {args.delay} s delay differs from the default in {max(diffs) * 100:.3f}% of the pixels at most"
+          + ("" if max(diffs) > 0 else ", so it is safe here"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Checks the startup time of the command line tool against a budget. Runs `--help` and a
+plain import of the main module in fresh interpreters, and fails if the median time is
+over the budget, or if importing the main module, or any module that imports optional
+dependencies lazily, pulls in modules that only some commands need (e.g. the kafka
+clients, which the render-only and replay paths don't use, or Pillow).
+
+    PYTHONPATH=. python benchmarks/bench_startup.py [-n RUNS] [--budget SECONDS]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+# Modules that must not be imported just by importing the main module
+DEFERRED_MODULES = ("confluent_kafka", "gcn_kafka", "http.server", "PIL", "numpy")
+# Our modules that only import the optional dependencies on first use. They are checked on
+# their own as well, since the main module may not import all of them.
+LAZY_MODULES = ("stellarium_gcn_wp.main", "stellarium_gcn_wp.overlay", "stellarium_gcn_wp.output_pipeline",
+                "stellarium_gcn_wp.archive")
+
+COMMANDS = {
+    "import": [sys.executable, "-c", "import stellarium_gcn_wp.main"],
+    "help": [sys.executable, "-m", "stellarium_gcn_wp.main", "--help"],
+    "python": [sys.executable, "-c", "pass"],
+}
+
+
+def measure(cmd, runs: int) -> float:
+    times = []
+    for _ in range(runs):
+        t_start = time.monotonic()
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.monotonic() - t_start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--runs", type=int, default=10)
+    parser.add_argument("--budget", type=float, default=0.3,
+                        help="Maximum median time of `--help`, in seconds")
+    args = parser.parse_args()
+
+    imported = {}
+    for module in LAZY_MODULES:
+        check = (f"import sys, {module}; "
+                 f"print(' '.join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))")
+        found = subprocess.run([sys.executable, "-c", check], check=True, capture_output=True,
+                               text=True).stdout.split()
+        if found:
+            imported[module] = found
+
+    results = {name: measure(cmd, args.runs) for name, cmd in COMMANDS.items()}
+    for name, seconds in results.items():
+        print(f"{name:>8}: {seconds * 1000:7.1f} ms")
+
+    failed = False
+    for module, found in imported.items():
+        print(f"Importing {module} imports {', '.join(found)}")
+        failed = True
+    if results["help"] > args.budget:
+        print(f"Startup takes {results['help']:.3f} s, over the budget of {args.budget:.3f} s")
+        failed = True
+    if failed:
+        raise SystemExit(1)
+    print("Startup is within the budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Compares a full stellarium render of an event with the same event drawn onto a base
+layer, for every projection that can be composited. Writes both images and an amplified
+difference image to the output directory, and prints how many pixels differ. Needs
+stellarium, Xvfb, xdotool and Pillow.
+
+    PYTHONPATH=. python benchmarks/diff_overlay.py [--out diff/] [--projection ProjectionCylinder ...] [NOTICE_FILE]
+"""
+import argparse
+import asyncio
+import time
+from dataclasses import replace
+from pathlib import Path
+
+from PIL import Image, ImageChops
+
+from stellarium_gcn_wp import overlay
+from stellarium_gcn_wp.gcn_parser import GCNParser
+from stellarium_gcn_wp.main import make_render_params
+from stellarium_gcn_wp.renderer import Renderer
+
+from bench_parser import EXAMPLE_NOTICE
+
+
+def compare(full_path: Path, composite_path: Path, diff_path: Path, threshold: int):
+    with Image.open(full_path) as a, Image.open(composite_path) as b:
+        diff = ImageChops.difference(a.convert("RGB"), b.convert("RGB")).convert("L")
+    histogram = diff.histogram()
+    total = sum(histogram)
+    differing = sum(histogram[threshold + 1:])
+    mean = sum(i * n for i, n in enumerate(histogram)) / total
+    diff.point(lambda v: min(255, v * 8)).save(diff_path)
+    return differing / total, mean
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", type=Path, default=Path("diff"))
+    parser.add_argument("--projection", nargs="+", default=list(overlay.PROJECTIONS))
+    parser.add_argument("--display", type=str, default=":150")
+    parser.add_argument("--threshold", type=int, default=32,
+                        help="Pixels that differ by more than this in any channel count as different")
+    parser.add_argument("notice", nargs="?", type=Path)
+    args = parser.parse_args()
+    args.out.mkdir(parents=True, exist_ok=True)
+
+    notice = GCNParser.parse(args.notice.read_text() if args.notice else EXAMPLE_NOTICE)
+    params = replace(make_render_params(notice), ra_view_offset=10.0, dec_view_offset=5.0)
+    outputs = [replace(params, projection=p) for p in args.projection]
+    bases = [overlay.base_layer_params(p, time_bucket=1, view_grid=1e-9) for p in outputs]
+
+    full_paths = [args.out / f"{p.projection}_full.png" for p in outputs]
+    base_paths = [args.out / f"{p.projection}_base.png" for p in outputs]
+    if not asyncio.run(Renderer(outputs, display=args.display).render(full_paths)):
+        raise RuntimeError("Full render failed")
+    if not asyncio.run(Renderer(bases, display=args.display).render(base_paths)):
+        raise RuntimeError("Base layer render failed")
+
+    print(f"{'projection':>24} {'composite':>10} {'differing':>10} {'mean diff':>10}")
+    for p, base, full_path, base_path in zip(outputs, bases, full_paths, base_paths):
+        composite_path = args.out / f"{p.projection}_composite.png"
+        t_start = time.perf_counter()
+        overlay.composite(base_path, overlay.overlay_params(p, base), composite_path)
+        dt = time.perf_counter() - t_start
+        differing, mean = compare(full_path, composite_path, args.out / f"{p.projection}_diff.png",
+                                  args.threshold)
+        print(f"{p.projection:>24} {dt * 1000:8.1f}ms {differing * 100:9.3f}% {mean:10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+import dataclasses
+import json
+import logging
+import math
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+# NumPy is imported by _numpy(), on first use, since importing it is slow
+np = None
+
+from stellarium_gcn_wp.gcn_parser import GCNNotice
+
+logger = logging.getLogger(__name__)
+
+# Height of the declination bands of the sky index, in degrees
+DEC_BAND = 5.0
+
+_NOTICE_FIELDS = [f.name for f in dataclasses.fields(GCNNotice)]
+
+
+def notice_time(notice: GCNNotice) -> float:
+    """Unix time of the event"""
+    # TJD 0 is 587 days before the unix epoch
+    return (notice.tjd - 587) * 86400 + notice.sod
+
+
+def _numpy():
+    global np
+    if np is None:
+        try:
+            import numpy as np
+        except ImportError:
+            pass
+    return np
+
+
+def angular_distance(ra: float, dec: float, ras: Sequence[float], decs: Sequence[float]) -> List[float]:
+    """Great circle distances, in degrees, from ra/dec to each of ras/decs, using NumPy if it is installed."""
+    if _numpy() is not None:
+        ra1, dec1 = np.radians(ra), np.radians(dec)
+        ra2, dec2 = np.radians(np.asarray(ras, dtype=float)), np.radians(np.asarray(decs, dtype=float))
+        # Haversine, which is accurate for small distances too
+        a = np.sin((dec2 - dec1) / 2) ** 2 + np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2) ** 2
+        return np.degrees(2 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))).tolist()
+
+    ra1, dec1 = math.radians(ra), math.radians(dec)
+    result = []
+    for r, d in zip(ras, decs):
+        ra2, dec2 = math.radians(r), math.radians(d)
+        a = math.sin((dec2 - dec1) / 2) ** 2 + math.cos(dec1) * math.cos(dec2) * math.sin((ra2 - ra1) / 2) ** 2
+        result.append(math.degrees(2 * math.asin(math.sqrt(min(1.0, max(0.0, a))))))
+    return result
+
+
+@dataclass
+class ArchivedNotice:
+    notice: GCNNotice
+    # Unix time of the event
+    time: float
+    # Distance from the position of a cone search, in degrees
+    distance: Optional[float] = None
+
+
+class EventArchive:
+    """
+    Every handled notice, and the outputs rendered for it with their variants, so past
+    events can be found without going back to kafka.
+
+    Notices are indexed by event time and by sky position. The sky index splits the sky
+    into DEC_BAND degree declination bands, sorted by ra within each band, so a cone search
+    only reads the notices in a box around the cone, and then filters them by their exact
+    distance.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        path = Path(path).expanduser()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS notices (
+                                notice_type TEXT NOT NULL,
+                                run_num INTEGER NOT NULL,
+                                evt_num INTEGER NOT NULL,
+                                ra REAL NOT NULL,
+                                dec REAL NOT NULL,
+                                tjd INTEGER NOT NULL,
+                                sod INTEGER NOT NULL,
+                                gal_lon REAL NOT NULL,
+                                gal_lat REAL NOT NULL,
+                                energy REAL NOT NULL,
+                                signalness REAL NOT NULL,
+                                revision INTEGER NOT NULL,
+                                time REAL NOT NULL,
+                                dec_band INTEGER NOT NULL,
+                                PRIMARY KEY (run_num, evt_num, revision))""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS notices_time ON notices (time)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS notices_sky ON notices (dec_band, ra)")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS outputs (
+                                run_num INTEGER NOT NULL,
+                                evt_num INTEGER NOT NULL,
+                                revision INTEGER NOT NULL,
+                                output TEXT NOT NULL,
+                                path TEXT NOT NULL,
+                                variants TEXT NOT NULL,
+                                rendered_at REAL NOT NULL,
+                                PRIMARY KEY (run_num, evt_num, revision, output))""")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def record(self, notice: GCNNotice, outputs: Optional[Dict[str, Tuple[Path, Sequence[Path]]]] = None):
+        """Records `notice`, and its `outputs` as (path, variant paths) by output name."""
+        values = [getattr(notice, name) for name in _NOTICE_FIELDS]
+        values += [notice_time(notice), math.floor(notice.dec / DEC_BAND)]
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.execute(f"INSERT OR REPLACE INTO notices ({', '.join(_NOTICE_FIELDS)}, time, dec_band) "
+                                 f"VALUES ({', '.join('?' * len(values))})", values)
+                for name, (path, variants) in (outputs or {}).items():
+                    self._db.execute("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                     (notice.run_num, notice.evt_num, notice.revision, name, str(path),
+                                      json.dumps([str(v) for v in variants]), now))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def outputs(self, run_num: int, evt_num: int, revision: Optional[int] = None) -> Dict[str, dict]:
+        """The outputs of a revision of an event, by name. Without `revision`, those of the latest one."""
+        with self._lock:
+            if revision is None:
+                row = self._db.execute("SELECT MAX(revision) FROM outputs WHERE run_num=? AND evt_num=?",
+                                       (run_num, evt_num)).fetchone()
+                revision = row[0]
+            rows = self._db.execute("""SELECT output, path, variants, rendered_at FROM outputs
+                                       WHERE run_num=? AND evt_num=? AND revision=?""",
+                                    (run_num, evt_num, revision)).fetchall()
+        return {output: {"path": path, "variants": json.loads(variants), "rendered_at": rendered_at}
+                for output, path, variants, rendered_at in rows}
+
+    def _query(self, where: List[str], params: list, start: Optional[float], end: Optional[float],
+               notice_type: Optional[str]) -> List[ArchivedNotice]:
+        if start is not None:
+            where.append("time >= ?")
+            params.append(start)
+        if end is not None:
+            where.append("time < ?")
+            params.append(end)
+        if notice_type is not None:
+            # LIKE ignores case
+            where.append("notice_type LIKE ?")
+            params.append(f"%{notice_type}%")
+        sql = f"SELECT {', '.join(_NOTICE_FIELDS)}, time FROM notices"
+        if where:
+            sql += f" WHERE {' AND '.join(where)}"
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+        return [ArchivedNotice(GCNNotice(*row[:-1]), row[-1]) for row in rows]
+
+    @staticmethod
+    def _latest_revisions(notices: List[ArchivedNotice]) -> List[ArchivedNotice]:
+        latest: Dict[Tuple[int, int], ArchivedNotice] = {}
+        for n in notices:
+            key = n.notice.run_num, n.notice.evt_num
+            if key not in latest or n.notice.revision > latest[key].notice.revision:
+                latest[key] = n
+        return list(latest.values())
+
+    def time_range(self, start: Optional[float] = None, end: Optional[float] = None,
+                   notice_type: Optional[str] = None, all_revisions: bool = False) -> List[ArchivedNotice]:
+        """Events between the unix times `start` and `end`, latest first. Only the latest revision of each
+        event is returned, unless `all_revisions` is set."""
+        notices = self._query([], [], start, end, notice_type)
+        if not all_revisions:
+            notices = self._latest_revisions(notices)
+        return sorted(notices, key=lambda n: n.time, reverse=True)
+
+    def cone_search(self, ra: float, dec: float, radius: float,
+                    start: Optional[float] = None, end: Optional[float] = None,
+                    notice_type: Optional[str] = None, all_revisions: bool = False) -> List[ArchivedNotice]:
+        """Like time_range(), but only events within `radius` degrees of ra/dec."""
+        ra = ra % 360.0
+        dec_min, dec_max = max(-90.0, dec - radius), min(90.0, dec + radius)
+        where = ["dec_band BETWEEN ? AND ?", "dec BETWEEN ? AND ?"]
+        params: list = [math.floor(dec_min / DEC_BAND), math.floor(dec_max / DEC_BAND), dec_min, dec_max]
+
+        # Range of ra of the box around the cone, unless it contains a pole
+        max_abs_dec = max(abs(dec_min), abs(dec_max))
+        if max_abs_dec < 90.0 and radius < 90.0:
+            half_width = math.degrees(math.asin(min(1.0, math.sin(math.radians(radius))
+                                                    / math.cos(math.radians(max_abs_dec)))))
+            if half_width < 90.0:
+                ra_min, ra_max = ra - half_width, ra + half_width
+                if ra_min < 0:
+                    where.append("(ra >= ? OR ra <= ?)")
+                    params += [ra_min + 360.0, ra_max]
+                elif ra_max >= 360.0:
+                    where.append("(ra >= ? OR ra <= ?)")
+                    params += [ra_min, ra_max - 360.0]
+                else:
+                    where.append("ra BETWEEN ? AND ?")
+                    params += [ra_min, ra_max]
+
+        candidates = self._query(where, params, start, end, notice_type)
+        distances = angular_distance(ra, dec, [n.notice.ra for n in candidates],
+                                     [n.notice.dec for n in candidates])
+        notices = []
+        for n, distance in zip(candidates, distances):
+            if distance <= radius:
+                n.distance = distance
+                notices.append(n)
+        if not all_revisions:
+            notices = self._latest_revisions(notices)
+        return sorted(notices, key=lambda n: n.time, reverse=True)
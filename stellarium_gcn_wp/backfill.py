@@ -0,0 +1,201 @@
+import asyncio
+import datetime
+import logging
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from confluent_kafka import TopicPartition
+from gcn_kafka import Consumer
+
+from stellarium_gcn_wp.commit_ledger import CommitLedger
+from stellarium_gcn_wp.gcn_parser import GCNParser
+from stellarium_gcn_wp.render_pool import RenderPool, RenderWorker
+from stellarium_gcn_wp.render_queue import QueuedNotice, RenderQueue
+from stellarium_gcn_wp.settings import Settings
+
+logger = logging.getLogger(__name__)
+
+
+class Backfill:
+    """
+    Renders all notices on `topics` in a range of offsets or times, without joining a
+    consumer group. Notices are fetched in batches and fed to a render pool through a
+    bounded queue, so fetching stops while the renderers are busy. When run() is cancelled,
+    the renders in progress get `shutdown_timeout` seconds to finish.
+
+    Progress is recorded in a CommitLedger at `checkpoint_path`. Running a backfill with
+    the same checkpoint again continues after the last contiguously rendered notice.
+    """
+
+    def __init__(self, topics: List[str], checkpoint_path: Union[str, Path],
+                 handler: Callable[[QueuedNotice, RenderWorker], Awaitable[None]],
+                 since: Optional[datetime.datetime] = None,
+                 until: Optional[datetime.datetime] = None,
+                 from_offset: Optional[int] = None,
+                 batch_size: int = 100, max_pending: int = 16, workers: int = 1,
+                 progress_interval: float = 60.0, shutdown_timeout: Optional[float] = None,
+                 consumer_factory: Optional[Callable[[dict], Consumer]] = None):
+        self._topics = topics
+        self._handler = handler
+        self._since = since
+        self._until = until
+        self._from_offset = from_offset
+        self._batch_size = batch_size
+        self._progress_interval = progress_interval
+        self._shutdown_timeout = shutdown_timeout
+
+        self._ledger = CommitLedger(checkpoint_path)
+        self._queue = RenderQueue(maxsize=max_pending, on_done=self._on_done)
+        self._pool = RenderPool(self._queue, handler,
+                                workers=workers,
+                                limits=Settings.render_limits,
+                                display_base=Settings.render_display_base,
+                                use_server=Settings.render_server,
+                                server_port_base=Settings.render_server_port,
+                                screen_width=Settings.screen_size[0],
+                                screen_height=Settings.screen_size[1],
+                                phase_timeouts=Settings.render_phase_timeouts,
+                                settle=Settings.render_settle)
+        config = {"auto.offset.reset": "earliest", "enable.auto.commit": False}
+        if consumer_factory is not None:
+            self._consumer = consumer_factory(config)
+        else:
+            self._consumer = Consumer(config=config,
+                                      client_id=Settings.gcn_kafka_id,
+                                      client_secret=Settings.gcn_kafka_secret)
+
+        self._fetched = 0
+        self._parsed = 0
+        self._done = 0
+
+    @staticmethod
+    def _timestamp_ms(ts: datetime.datetime) -> int:
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=datetime.timezone.utc)
+        return int(ts.timestamp() * 1000)
+
+    def _offsets_for_time(self, partitions: List[TopicPartition],
+                          ts: datetime.datetime) -> Dict[Tuple[str, int], int]:
+        ms = self._timestamp_ms(ts)
+        found = self._consumer.offsets_for_times([TopicPartition(p.topic, p.partition, ms) for p in partitions],
+                                                 timeout=30)
+        result = {}
+        for p in found:
+            if p.offset < 0:
+                # No message at or after the time, so use the end of the partition
+                p.offset = self._consumer.get_watermark_offsets(p, timeout=30)[1]
+            result[(p.topic, p.partition)] = p.offset
+        return result
+
+    def _plan(self) -> Tuple[List[TopicPartition], Dict[Tuple[str, int], int]]:
+        """Returns the partitions to assign, with their start offsets, and the end offset of each partition."""
+        partitions = []
+        for topic in self._topics:
+            metadata = self._consumer.list_topics(topic, timeout=30).topics[topic]
+            partitions.extend(TopicPartition(topic, p) for p in metadata.partitions)
+
+        watermarks = {(p.topic, p.partition): self._consumer.get_watermark_offsets(p, timeout=30)
+                      for p in partitions}
+
+        if self._until is not None:
+            end = self._offsets_for_time(partitions, self._until)
+        else:
+            end = {key: high for key, (_, high) in watermarks.items()}
+
+        if self._since is not None:
+            start = self._offsets_for_time(partitions, self._since)
+        elif self._from_offset is not None:
+            start = {key: self._from_offset for key in watermarks}
+        else:
+            start = {key: low for key, (low, _) in watermarks.items()}
+
+        checkpoint = self._ledger.positions()
+        for p in partitions:
+            key = (p.topic, p.partition)
+            p.offset = max(start[key], watermarks[key][0], checkpoint.get(key, 0))
+            logger.info(f"Backfilling topic={p.topic} partition={p.partition} from offset {p.offset} to {end[key]}")
+        return partitions, end
+
+    def _on_done(self, item: QueuedNotice):
+        if item.offset is not None:
+            self._ledger.completed(item.topic, item.partition, item.offset)
+        self._done += 1
+        self._checkpoint()
+
+    def _checkpoint(self):
+        for topic, partition, offset in self._ledger.uncommitted():
+            self._ledger.committed(topic, partition, offset)
+
+    def _report(self, t_start: float):
+        dt = time.monotonic() - t_start
+        fetched, parsed, done = self._fetched, self._parsed, self._done
+        logger.info(f"Backfill progress: fetched={fetched}, parsed={parsed}, done={done}, "
+                    f"queued={self._queue.qsize()}, {fetched / dt:.2f} notices/s, "
+                    f"{done / dt * 3600:.1f} renders/hour")
+
+    async def _fetch(self, partitions: List[TopicPartition], end: Dict[Tuple[str, int], int], t_start: float):
+        remaining = {(p.topic, p.partition) for p in partitions if p.offset < end[(p.topic, p.partition)]}
+        self._consumer.assign([p for p in partitions if (p.topic, p.partition) in remaining])
+
+        last_report = time.monotonic()
+        while remaining:
+            batch = []
+            consume = asyncio.ensure_future(asyncio.to_thread(self._consumer.consume,
+                                                              num_messages=self._batch_size, timeout=1))
+            try:
+                messages = await asyncio.shield(consume)
+            except asyncio.CancelledError:
+                # Let the kafka call finish, so close() doesn't run at the same time
+                await asyncio.gather(consume, return_exceptions=True)
+                raise
+            for message in messages:
+                if message.error():
+                    logger.warning(message.error())
+                    continue
+                key = (message.topic(), message.partition())
+                if key not in remaining or message.offset() >= end[key]:
+                    continue
+                if message.offset() + 1 >= end[key]:
+                    remaining.discard(key)
+                    self._consumer.pause([TopicPartition(*key)])
+                if self._ledger.received(message.topic(), message.partition(), message.offset()):
+                    batch.append(QueuedNotice(text=message.value().decode(), topic=message.topic(),
+                                              partition=message.partition(), offset=message.offset()))
+
+            self._fetched += len(batch)
+
+            notices = GCNParser.parse_many([item.text for item in batch], skip_errors=True)
+            for item, notice in zip(batch, notices):
+                if notice is None:
+                    logger.warning(f"Skipping notice at offset {item.offset} that failed to parse")
+                    item.trace.finish("invalid")
+                    self._on_done(item)
+                    continue
+                item.notice = notice
+                item.trace.mark("parse")
+                self._parsed += 1
+                await self._queue.put(item)
+
+            self._checkpoint()
+            if time.monotonic() - last_report >= self._progress_interval:
+                self._report(t_start)
+                last_report = time.monotonic()
+
+    async def run(self):
+        t_start = time.monotonic()
+        pool = asyncio.create_task(self._pool.run(), name="backfill-pool")
+
+        try:
+            partitions, end = await asyncio.to_thread(self._plan)
+            await self._fetch(partitions, end, t_start)
+
+            logger.info("All notices fetched, waiting for renders to finish")
+            await self._queue.join()
+        finally:
+            await self._pool.stop(self._shutdown_timeout)
+            await pool
+            self._checkpoint()
+            await asyncio.to_thread(self._consumer.close)
+            self._report(t_start)
+            self._ledger.close()
@@ -0,0 +1,96 @@
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+
+class CommitLedger:
+    """
+    Local record of the kafka messages we have received and finished handling, so the
+    consumer can keep fetching while renders are running and commit offsets later.
+
+    For each (topic, partition), the offset that is safe to commit is the lowest offset
+    that was received but not completed yet, or one past the highest completed offset if
+    nothing is outstanding. Since messages of a partition arrive in order, everything
+    below that offset has been handled. Offsets that were completed above the committed
+    one are remembered, so they are skipped when kafka delivers them again after a restart.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        path = Path(path).expanduser()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS offsets (
+                                topic TEXT NOT NULL,
+                                partition INTEGER NOT NULL,
+                                offset INTEGER NOT NULL,
+                                completed INTEGER NOT NULL DEFAULT 0,
+                                PRIMARY KEY (topic, partition, offset))""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS committed (
+                                topic TEXT NOT NULL,
+                                partition INTEGER NOT NULL,
+                                offset INTEGER NOT NULL,
+                                PRIMARY KEY (topic, partition))""")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def received(self, topic: str, partition: int, offset: int) -> bool:
+        """Records a received message. Returns False if it was already handled before."""
+        with self._lock:
+            row = self._db.execute("SELECT offset FROM committed WHERE topic=? AND partition=?",
+                                   (topic, partition)).fetchone()
+            if row is not None and offset < row[0]:
+                return False
+            row = self._db.execute("SELECT completed FROM offsets WHERE topic=? AND partition=? AND offset=?",
+                                   (topic, partition, offset)).fetchone()
+            if row is not None:
+                return not row[0]
+            self._db.execute("INSERT INTO offsets (topic, partition, offset) VALUES (?, ?, ?)",
+                             (topic, partition, offset))
+            return True
+
+    def completed(self, topic: str, partition: int, offset: int):
+        with self._lock:
+            self._db.execute("UPDATE offsets SET completed=1 WHERE topic=? AND partition=? AND offset=?",
+                             (topic, partition, offset))
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM offsets WHERE completed=0").fetchone()[0]
+
+    def watermarks(self) -> Dict[Tuple[str, int], int]:
+        """Returns the offset that can be committed for each (topic, partition)."""
+        with self._lock:
+            rows = self._db.execute("""SELECT topic, partition,
+                                              MIN(CASE WHEN completed=0 THEN offset END),
+                                              MAX(offset) + 1
+                                       FROM offsets GROUP BY topic, partition""").fetchall()
+        return {(topic, partition): first_pending if first_pending is not None else end
+                for topic, partition, first_pending, end in rows}
+
+    def uncommitted(self) -> List[Tuple[str, int, int]]:
+        """Returns the (topic, partition, offset) watermarks that advanced since the last commit."""
+        committed = self.positions()
+        return [(topic, partition, offset) for (topic, partition), offset in self.watermarks().items()
+                if offset > committed.get((topic, partition), -1)]
+
+    def positions(self) -> Dict[Tuple[str, int], int]:
+        """Returns the last committed offset for each (topic, partition)."""
+        with self._lock:
+            return {(topic, partition): offset for topic, partition, offset
+                    in self._db.execute("SELECT topic, partition, offset FROM committed")}
+
+    def committed(self, topic: str, partition: int, offset: int):
+        """Records a successful commit, and forgets about the offsets below it."""
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO committed (topic, partition, offset) VALUES (?, ?, ?)",
+                             (topic, partition, offset))
+            self._db.execute("DELETE FROM offsets WHERE topic=? AND partition=? AND offset<?",
+                             (topic, partition, offset))
@@ -0,0 +1,183 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional, Tuple
+
+from confluent_kafka import TopicPartition
+
+logger = logging.getLogger(__name__)
+
+# Special offsets, with the same values as in confluent_kafka
+OFFSET_BEGINNING = -2
+OFFSET_END = -1
+OFFSET_INVALID = -1001
+
+
+@dataclass
+class FakeMessage:
+    _topic: str
+    _offset: int
+    _value: bytes
+    _timestamp: float
+
+    def topic(self) -> str:
+        return self._topic
+
+    def partition(self) -> int:
+        return 0
+
+    def offset(self) -> int:
+        return self._offset
+
+    def value(self) -> bytes:
+        return self._value
+
+    def timestamp(self) -> Tuple[int, int]:
+        # (TIMESTAMP_CREATE_TIME, milliseconds), like confluent_kafka
+        return 1, int(self._timestamp * 1000)
+
+    def error(self):
+        return None
+
+
+class FakeBroker:
+    """
+    In-process stand-in for the GCN kafka broker, for running the pipeline without network
+    access or credentials. Every topic has a single partition. Use `consumer` as the
+    consumer factory of GCNConsumer or Backfill, and `produce` (e.g. through a Replayer)
+    to publish notices.
+    """
+
+    def __init__(self):
+        self._topics: Dict[str, List[FakeMessage]] = {}
+        self._committed: Dict[Tuple[str, str], int] = {}
+        self._cond = threading.Condition()
+
+    def produce(self, topic: str, value: bytes, timestamp: Optional[float] = None):
+        with self._cond:
+            messages = self._topics.setdefault(topic, [])
+            messages.append(FakeMessage(topic, len(messages), value,
+                                        time.time() if timestamp is None else timestamp))
+            self._cond.notify_all()
+
+    def consumer(self, config: dict) -> "FakeConsumer":
+        return FakeConsumer(self, config)
+
+
+class FakeConsumer:
+    """The subset of the confluent_kafka Consumer interface that is used by this package."""
+
+    def __init__(self, broker: FakeBroker, config: dict):
+        self._broker = broker
+        self._group = config.get("group.id")
+        self._reset = config.get("auto.offset.reset", "latest")
+        self._positions: Dict[str, int] = {}
+        self._paused = set()
+        self._subscribed: List[str] = []
+        self._on_assign: Optional[Callable] = None
+
+    def subscribe(self, topics: List[str], on_assign: Optional[Callable] = None):
+        self._subscribed = list(topics)
+        self._on_assign = on_assign
+        partitions = [TopicPartition(topic, 0, self._start_offset(topic)) for topic in topics]
+        if on_assign is not None:
+            on_assign(self, partitions)
+        else:
+            self.assign(partitions)
+
+    def _start_offset(self, topic: str) -> int:
+        committed = self._broker._committed.get((self._group, topic))
+        if self._group is not None and committed is not None:
+            return committed
+        return OFFSET_BEGINNING if self._reset == "earliest" else OFFSET_END
+
+    def assign(self, partitions: List[TopicPartition]):
+        with self._broker._cond:
+            for p in partitions:
+                low, high = 0, len(self._broker._topics.get(p.topic, []))
+                offset = p.offset
+                if offset == OFFSET_BEGINNING:
+                    offset = low
+                elif offset in (OFFSET_END, OFFSET_INVALID):
+                    offset = high
+                self._positions[p.topic] = offset
+
+    def assignment(self) -> List[TopicPartition]:
+        return [TopicPartition(topic, 0, offset) for topic, offset in self._positions.items()]
+
+    def position(self, partitions: List[TopicPartition]) -> List[TopicPartition]:
+        return [TopicPartition(p.topic, 0, self._positions.get(p.topic, OFFSET_INVALID)) for p in partitions]
+
+    def pause(self, partitions: List[TopicPartition]):
+        self._paused.update(p.topic for p in partitions)
+
+    def resume(self, partitions: List[TopicPartition]):
+        self._paused.difference_update(p.topic for p in partitions)
+
+    def list_topics(self, topic: Optional[str] = None, timeout: float = -1):
+        with self._broker._cond:
+            names = [topic] if topic is not None else list(self._broker._topics)
+        return SimpleNamespace(topics={name: SimpleNamespace(partitions={0: None}) for name in names})
+
+    def get_watermark_offsets(self, partition: TopicPartition, timeout: float = -1, cached: bool = False):
+        with self._broker._cond:
+            return 0, len(self._broker._topics.get(partition.topic, []))
+
+    def offsets_for_times(self, partitions: List[TopicPartition], timeout: float = -1) -> List[TopicPartition]:
+        result = []
+        with self._broker._cond:
+            for p in partitions:
+                offset = -1
+                for m in self._broker._topics.get(p.topic, []):
+                    if m.timestamp()[1] >= p.offset:
+                        offset = m.offset()
+                        break
+                result.append(TopicPartition(p.topic, 0, offset))
+        return result
+
+    def _next(self) -> Optional[FakeMessage]:
+        for topic, offset in self._positions.items():
+            if topic in self._paused:
+                continue
+            messages = self._broker._topics.get(topic, [])
+            if offset < len(messages):
+                self._positions[topic] = offset + 1
+                return messages[offset]
+        return None
+
+    def consume(self, num_messages: int = 1, timeout: float = -1) -> List[FakeMessage]:
+        deadline = time.monotonic() + (timeout if timeout >= 0 else 1e9)
+        result = []
+        with self._broker._cond:
+            while len(result) < num_messages:
+                if (message := self._next()) is not None:
+                    result.append(message)
+                    continue
+                if result:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._broker._cond.wait(remaining)
+        return result
+
+    def poll(self, timeout: float = -1) -> Optional[FakeMessage]:
+        messages = self.consume(1, timeout)
+        return messages[0] if messages else None
+
+    def commit(self, message: Optional[FakeMessage] = None, offsets: Optional[List[TopicPartition]] = None,
+               asynchronous: bool = True):
+        if self._group is None:
+            raise RuntimeError("Can't commit without a group.id")
+        if message is not None:
+            offsets = [TopicPartition(message.topic(), 0, message.offset() + 1)]
+        with self._broker._cond:
+            for p in offsets or []:
+                self._broker._committed[(self._group, p.topic)] = p.offset
+        # Like kafka, a synchronous commit returns the committed offsets, with their errors
+        return None if asynchronous else [TopicPartition(p.topic, p.partition, p.offset) for p in offsets or []]
+
+    def close(self):
+        pass
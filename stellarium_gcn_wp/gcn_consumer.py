@@ -1,20 +1,60 @@
+import asyncio
 import logging
 import threading
 import time
-from queue import Queue
-from typing import Literal, List, Optional
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Literal, List, Optional, Sequence
 
+from confluent_kafka import KafkaException, TopicPartition
 from gcn_kafka import Consumer
+from stellarium_gcn_wp import metrics
+from stellarium_gcn_wp.commit_ledger import CommitLedger
+from stellarium_gcn_wp.render_queue import QueuedNotice
 from stellarium_gcn_wp.settings import Settings
 
 logger = logging.getLogger(__name__)
 
+consumer_lag = metrics.registry.gauge("sgw_kafka_lag", "Messages on the broker that were not fetched yet",
+                                      ["topic", "partition"])
+prefetched = metrics.registry.gauge("sgw_kafka_prefetched", "Fetched messages waiting for room in the render queue")
+filtered = metrics.registry.counter("sgw_kafka_filtered_total", "Messages dropped by the topic or notice type filter",
+                                    ["topic"])
+
+
+def notice_type_of(value: bytes) -> Optional[bytes]:
+    """The NOTICE_TYPE of a classic text notice, without decoding it, or None for other formats."""
+    start = value.find(b"NOTICE_TYPE:")
+    if start < 0:
+        return None
+    end = value.find(b"\n", start)
+    return value[start + len(b"NOTICE_TYPE:"):end if end >= 0 else None].strip()
+
 
 class GCNConsumer:
+    """
+    Fetches notices from kafka in batches of up to `batch_size` messages into a prefetch
+    buffer, and moves them from there into `queue`, an asyncio.Queue or RenderQueue, as it
+    has room. Fetching is paused while the buffer holds `prefetch_bytes` of messages, so
+    catching up on a long backlog only keeps that much in memory. Messages from other
+    topics, and classic text notices whose NOTICE_TYPE doesn't contain any of `notice_types`,
+    are dropped before they are decoded.
+    `kafka_config` is added to the consumer configuration, e.g. to tune fetch sizes.
 
-    def __init__(self, queue: Queue,
+    run() fetches until stop() is called. The kafka client blocks, so it is only used from a
+    worker thread, which hands fetched messages to the event loop, and doesn't wake it up
+    while there are none. The buffer is drained into the queue on the event loop.
+    """
+
+    def __init__(self, queue: "asyncio.Queue[QueuedNotice]",
                  start_on: Literal["first", "last", "next", "track"] = "last",
-                 topics: Optional[List[str]] = None):
+                 topics: Optional[List[str]] = None,
+                 ledger: Optional[CommitLedger] = None,
+                 consumer_factory: Optional[Callable[[dict], Consumer]] = None,
+                 batch_size: int = 100, batch_timeout: float = 1.0,
+                 prefetch_bytes: int = 8 * 1024 ** 2,
+                 notice_types: Optional[Sequence[str]] = None,
+                 kafka_config: Optional[Dict[str, Any]] = None,
+                 lag_interval: float = 30.0):
         if topics is None or len(topics) == 0:
             topics = ['gcn.classic.text.ICECUBE_ASTROTRACK_BRONZE',
                       'gcn.classic.text.ICECUBE_ASTROTRACK_GOLD']
@@ -23,7 +63,19 @@ class GCNConsumer:
 
         self._queue = queue
         self._keep_running = False
-        self._thread = None
+        self._buffered = asyncio.Event()
+        self._topics = set(topics)
+        self._notice_types = [t.lower().encode() for t in notice_types] if notice_types else None
+        self._batch_size = batch_size
+        self._batch_timeout = batch_timeout
+        self._prefetch_bytes = prefetch_bytes
+        self._buffer: Deque = deque()
+        # Counted by the fetch thread before it hands messages over, and uncounted on the
+        # event loop once they are in the queue or dropped
+        self._buffered_bytes = 0
+        self._buffered_lock = threading.Lock()
+        self._lag_interval = lag_interval
+        self._start_on = start_on
 
         auto_offset = "earliest"
         if start_on == "next":
@@ -36,25 +88,39 @@ class GCNConsumer:
             "max.poll.interval.ms": 30 * 60 * 1000,
             "logger": kafka_logger,
             "error_cb": lambda x: logger.info(f"Kafka error {x}"),
-            "throttle_cb": lambda x: logger.info(f"Kafka throttle {x}")
+            "throttle_cb": lambda x: logger.info(f"Kafka throttle {x}"),
+            **(kafka_config or {}),
         }
 
         self._tracking = False
+        self._ledger = None
+        self._paused = False
         if start_on == "track":
+            if ledger is None:
+                raise ValueError("A commit ledger is required in 'track' mode")
             config["group.id"] = Settings.gcn_kafka_group_id
             config["enable.auto.commit"] = False
             self._tracking = True
+            self._ledger = ledger
 
         logger.debug(f"start_on={start_on}, tracking={self._tracking}, config={config}")
-        self._consumer = Consumer(config=config,
-                                  client_id=Settings.gcn_kafka_id,
-                                  client_secret=Settings.gcn_kafka_secret)
+        if consumer_factory is not None:
+            self._consumer = consumer_factory(config)
+        else:
+            self._consumer = Consumer(config=config,
+                                      client_id=Settings.gcn_kafka_id,
+                                      client_secret=Settings.gcn_kafka_secret)
 
-        if start_on == "last":
-            self._consumer.subscribe(topics,
-                                     on_assign=self._latest_on_assign)
+        self._consumer.subscribe(topics, on_assign=self._on_assign)
+
+    def _on_assign(self, consumer, partitions):
+        if self._start_on == "last":
+            self._latest_on_assign(consumer, partitions)
         else:
-            self._consumer.subscribe(topics)
+            consumer.assign(partitions)
+        # Partitions assigned in a rebalance start out fetching, even while the buffer is full
+        if self._paused:
+            consumer.pause(partitions)
 
     @staticmethod
     def _latest_on_assign(consumer, partitions):
@@ -65,33 +131,151 @@ class GCNConsumer:
             part.offset = max(newest_offset, last_offset - 1)
         consumer.assign(partitions)
 
-    def start(self):
+    async def run(self):
+        """Fetches notices until stop() is called. close() the consumer afterwards."""
         logger.info("Starting GCN consumer")
-        self._thread = threading.Thread(target=self._run)
         self._keep_running = True
-        self._thread.start()
+        drain = asyncio.create_task(self._drain(), name="gcn-drain")
+        fetch = asyncio.ensure_future(asyncio.to_thread(self._fetch, asyncio.get_running_loop()))
+        try:
+            await asyncio.shield(fetch)
+        except asyncio.CancelledError:
+            self._keep_running = False
+            # Let the kafka call finish, so close() doesn't run at the same time
+            await asyncio.gather(fetch, return_exceptions=True)
+            raise
+        finally:
+            drain.cancel()
+            await asyncio.gather(drain, return_exceptions=True)
 
     def stop(self):
+        """Makes run() return after the current fetch, which takes up to `batch_timeout` seconds."""
         logger.info("Stopping GCN consumer")
         self._keep_running = False
-        if self._thread is not None:
-            self._thread.join()
 
-    def _run(self):
+    async def close(self):
+        """Commits the offsets of the notices that were handled since the last commit, and leaves the group."""
+        if self._tracking:
+            await asyncio.to_thread(self._commit)
+        await asyncio.to_thread(self._consumer.close)
+
+    def _update_flow_control(self):
+        # Stop fetching while the prefetch buffer is full, but keep polling so the consumer
+        # stays in its group.
+        with self._buffered_lock:
+            full = self._buffered_bytes >= self._prefetch_bytes
+        if full != self._paused:
+            assignment = self._consumer.assignment()
+            if full:
+                logger.info("Prefetch buffer is full, pausing consumption")
+                self._consumer.pause(assignment)
+            else:
+                logger.info("Resuming consumption")
+                self._consumer.resume(assignment)
+            self._paused = full
+
+    def _count_buffered(self, size: int):
+        with self._buffered_lock:
+            self._buffered_bytes += size
+
+    def _commit(self):
+        # Waits for the broker, so the ledger only forgets offsets that were actually committed.
+        # Offsets that failed are committed again the next time.
+        offsets = self._ledger.uncommitted()
+        if not offsets:
+            return
+        logger.info(f"Committing offsets {offsets}")
+        try:
+            results = self._consumer.commit(offsets=[TopicPartition(topic, partition, offset)
+                                                     for topic, partition, offset in offsets],
+                                            asynchronous=False)
+        except KafkaException as e:
+            logger.warning(f"Failed to commit offsets: {e}")
+            return
+        for tp in results:
+            if tp.error is not None:
+                logger.warning(f"Failed to commit offset {tp.offset} of {tp.topic} [{tp.partition}]: {tp.error}")
+                continue
+            self._ledger.committed(tp.topic, tp.partition, tp.offset)
+
+    def _accept(self, message) -> bool:
+        if message.topic() not in self._topics:
+            return False
+        if self._notice_types is None:
+            return True
+        notice_type = notice_type_of(message.value())
+        return notice_type is None or any(t in notice_type.lower() for t in self._notice_types)
+
+    def _receive_all(self, messages: list):
+        for message in messages:
+            self._receive(message)
+
+    def _receive(self, message):
+        if message.error():
+            logger.warning(message.error())
+            return
+        logger.info(f'topic={message.topic()}, offset={message.offset()}')
+        metrics.notices_received.inc(topic=message.topic())
+
+        if not self._accept(message):
+            filtered.inc(topic=message.topic())
+            self._count_buffered(-len(message.value()))
+            # Nothing to render, so it counts as handled right away
+            if self._ledger is not None and self._ledger.received(message.topic(), message.partition(),
+                                                                  message.offset()):
+                self._ledger.completed(message.topic(), message.partition(), message.offset())
+            return
+
+        if self._ledger is not None and not self._ledger.received(message.topic(), message.partition(),
+                                                                  message.offset()):
+            logger.info(f"Skipping already handled message topic={message.topic()} "
+                        f"offset={message.offset()}")
+            self._count_buffered(-len(message.value()))
+            return
+
+        self._buffer.append(message)
+        self._buffered.set()
+
+    async def _drain(self):
+        # Moves buffered messages into the queue, waiting for room in it
+        while True:
+            await self._buffered.wait()
+            while self._buffer:
+                message = self._buffer[0]
+                item = QueuedNotice(text=message.value().decode(), topic=message.topic(),
+                                    partition=message.partition(), offset=message.offset())
+                item.trace.info.update(topic=message.topic(), partition=message.partition(),
+                                       offset=message.offset())
+                await self._queue.put(item)
+                self._buffer.popleft()
+                self._count_buffered(-len(message.value()))
+                prefetched.set(len(self._buffer))
+            self._buffered.clear()
+
+    def _report_lag(self):
+        try:
+            assignment = self._consumer.assignment()
+            positions = self._consumer.position(assignment)
+            for tp in positions:
+                low, high = self._consumer.get_watermark_offsets(tp, timeout=1.0, cached=False)
+                position = tp.offset if tp.offset >= 0 else low
+                consumer_lag.set(max(0, high - position), topic=tp.topic, partition=str(tp.partition))
+        except Exception as e:
+            logger.debug(f"Failed to get consumer lag: {e}")
+
+    def _fetch(self, loop: asyncio.AbstractEventLoop):
+        # Runs in a worker thread, which is the only one using the kafka client until it returns
+        last_commit = last_lag = time.monotonic()
         while self._keep_running:
-            if (message := self._consumer.poll(timeout=1)) is not None:
-                if message.error():
-                    logger.warning(message.error())
-                    continue
-                logger.info(f'topic={message.topic()}, offset={message.offset()}')
-                value = message.value().decode()
-                self._queue.put(item=value, block=True)
-
-                if self._tracking:
-                    logger.info("Waiting to commit..")
-                    while self._queue.unfinished_tasks and self._keep_running:
-                        time.sleep(1)
-
-                    if self._keep_running:
-                        logger.info(f"commiting topic={message.topic()} offset={message.offset()}")
-                        self._consumer.commit(message)
+            self._update_flow_control()
+            messages = self._consumer.consume(num_messages=self._batch_size, timeout=self._batch_timeout)
+            if messages:
+                # Counted here, so the next flow control check sees them before the loop does
+                self._count_buffered(sum(len(m.value()) for m in messages if not m.error()))
+                loop.call_soon_threadsafe(self._receive_all, messages)
+            if time.monotonic() - last_lag >= self._lag_interval:
+                self._report_lag()
+                last_lag = time.monotonic()
+            if self._tracking and time.monotonic() - last_commit >= Settings.commit_interval:
+                self._commit()
+                last_commit = time.monotonic()
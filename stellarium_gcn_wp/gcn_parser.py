@@ -1,4 +1,10 @@
+import datetime
+import json
+import math
+import re
+import xml.etree.ElementTree as ElementTree
 from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Literal, Optional, Tuple
 
 
 @dataclass
@@ -23,30 +29,293 @@ class GCNNotice:
     revision: int
 
 
+class GCNParseError(ValueError):
+    pass
+
+
+class UnknownFormatError(GCNParseError):
+    pass
+
+
+class MissingFieldError(GCNParseError, KeyError):
+    # Also a KeyError, which is what the parser used to raise for missing fields
+    def __init__(self, field: str):
+        super().__init__(f"Notice is missing field '{field}'")
+        self.field = field
+
+    def __str__(self):
+        # Without the quotes KeyError puts around its message
+        return self.args[0]
+
+
+class InvalidFieldError(GCNParseError):
+    def __init__(self, field: str, value: Any):
+        super().__init__(f"Notice has invalid value for field '{field}': {value!r}")
+        self.field = field
+        self.value = value
+
+
+NoticeFormat = Literal["text", "voevent", "json"]
+
+# TJD 0 is 1968-05-24, 587 days before the unix epoch
+_TJD_UNIX_OFFSET = 587
+
+# Rotation from J2000 equatorial to galactic coordinates
+_EQ_TO_GAL = ((-0.0548755604162154, -0.8734370902348850, -0.4838350155487132),
+              (+0.4941094278755837, -0.4448296299600112, +0.7469822444972189),
+              (-0.8676661490190047, -0.1980763734312015, +0.4559837761750669))
+
+
+def _first_int(value: str) -> int:
+    # e.g. "20375 TJD;    66 DOY;   24/03/06 (yy/mm/dd)"
+    return int(value.split(None, 1)[0])
+
+
+def _first_float(value: str) -> float:
+    # e.g. "53.7456d {+03h 34m 59s} (J2000)," or "2.3050e+02 [TeV]"
+    return float(value.split(None, 1)[0].rstrip("d,"))
+
+
+def _float_pair(value: str) -> Tuple[float, float]:
+    # e.g. "180.53,-39.72 [deg] galactic lon,lat of the event"
+    first, second = value.split("[", 1)[0].split(",")
+    return float(first), float(second)
+
+
+# Fields of a classic text notice that we need, and how to convert their values.
+# A single regex picks the lines of all of these fields out of the notice, which is
+# a lot faster than looking at every line.
+_TEXT_FIELDS: Dict[str, Callable[[str], Any]] = {
+    "NOTICE_TYPE": str.strip,
+    "RUN_NUM": _first_int,
+    "EVENT_NUM": _first_int,
+    "SRC_RA": _first_float,
+    "SRC_DEC": _first_float,
+    "DISCOVERY_DATE": _first_int,
+    "DISCOVERY_TIME": _first_int,
+    "GAL_COORDS": _float_pair,
+    "ENERGY": _first_float,
+    "SIGNALNESS": _first_float,
+    "REVISION": _first_int,
+}
+_TEXT_LINE = re.compile(r"\n(%s):[ \t]*([^\n]*)" % "|".join(_TEXT_FIELDS))
+
+# VOEvent packet types of the IceCube track alerts, and the matching classic text notice type
+_VOEVENT_PACKET_TYPES = {
+    "173": "ICECUBE Astrotrack Gold",
+    "174": "ICECUBE Astrotrack Bronze",
+}
+
+# Keys that are accepted for each field in JSON notices, in order of preference
+_JSON_KEYS = {
+    "notice_type": ("notice_type", "type", "alert_type"),
+    "run_num": ("run_num", "run_id"),
+    "evt_num": ("evt_num", "event_num", "event_id"),
+    "ra": ("ra",),
+    "dec": ("dec",),
+    "time": ("trigger_time", "alert_datetime", "event_time"),
+    "energy": ("energy",),
+    "signalness": ("signalness",),
+    "revision": ("revision", "rev", "alert_revision"),
+}
+
+
+def equatorial_to_galactic(ra: float, dec: float) -> Tuple[float, float]:
+    """Converts J2000 ra/dec to galactic lon/lat, all in degrees."""
+    ra, dec = math.radians(ra), math.radians(dec)
+    v = (math.cos(dec) * math.cos(ra), math.cos(dec) * math.sin(ra), math.sin(dec))
+    x, y, z = (sum(r * c for r, c in zip(row, v)) for row in _EQ_TO_GAL)
+    lon = math.degrees(math.atan2(y, x)) % 360.0
+    lat = math.degrees(math.asin(max(-1.0, min(1.0, z))))
+    return lon, lat
+
+
+def datetime_to_tjd_sod(ts: datetime.datetime) -> Tuple[int, int]:
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    delta = ts - datetime.datetime(1970, 1, 1)
+    return delta.days + _TJD_UNIX_OFFSET, delta.seconds
+
+
+def _parse_time(field: str, value: Any) -> Tuple[int, int]:
+    try:
+        return datetime_to_tjd_sod(datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00")))
+    except ValueError:
+        raise InvalidFieldError(field, value) from None
+
+
+def _convert(field: str, value: Any, conv: Callable[[Any], Any]):
+    try:
+        return conv(value)
+    except (TypeError, ValueError, IndexError):
+        raise InvalidFieldError(field, value) from None
+
+
 class GCNParser:
     @staticmethod
-    def parse(notice: str):
-        lines = notice.split("\n")
-        kv = {}
-        for line in lines:
-            pos = line.find(":")
-            if pos < 0:
-                continue
-            kv[line[0:pos]] = line[pos + 1:].strip()
+    def detect_format(notice: str) -> NoticeFormat:
+        start = notice.lstrip()[:1]
+        if start == "<":
+            return "voevent"
+        if start == "{":
+            return "json"
+        return "text"
+
+    @staticmethod
+    def parse_text(notice: str) -> GCNNotice:
+        # The leading newline lets the first line match as well
+        values = dict(_TEXT_LINE.findall("\n" + notice))
+        try:
+            for name, conv in _TEXT_FIELDS.items():
+                values[name] = conv(values[name])
+        except KeyError:
+            raise MissingFieldError(name) from None
+        except (ValueError, IndexError):
+            raise InvalidFieldError(name, values[name]) from None
+
+        gal_lon, gal_lat = values["GAL_COORDS"]
+        return GCNNotice(
+            notice_type=values["NOTICE_TYPE"],
+            run_num=values["RUN_NUM"],
+            evt_num=values["EVENT_NUM"],
+            ra=values["SRC_RA"],
+            dec=values["SRC_DEC"],
+            tjd=values["DISCOVERY_DATE"],
+            sod=values["DISCOVERY_TIME"],
+            gal_lon=gal_lon,
+            gal_lat=gal_lat,
+            energy=values["ENERGY"],
+            signalness=values["SIGNALNESS"],
+            revision=values["REVISION"]
+        )
+
+    @staticmethod
+    def parse_voevent(notice: str) -> GCNNotice:
+        try:
+            root = ElementTree.fromstring(notice)
+        except ElementTree.ParseError as e:
+            raise GCNParseError(f"Invalid VOEvent XML: {e}") from None
+
+        params = {}
+        coords = {}
+        iso_time = None
+        # Element tags are namespaced depending on the producer, so only look at the local names
+        for el in root.iter():
+            tag = el.tag.rsplit("}", 1)[-1]
+            if tag == "Param" and "name" in el.attrib:
+                params[el.attrib["name"].lower()] = el.attrib.get("value")
+            elif tag in ("C1", "C2") and el.text is not None:
+                coords[tag] = el.text
+            elif tag == "ISOTime" and iso_time is None:
+                iso_time = el.text
+
+        def param(name: str, conv: Callable[[Any], Any], *aliases: str):
+            for key in (name, *aliases):
+                if params.get(key.lower()) is not None:
+                    return _convert(key, params[key.lower()], conv)
+            raise MissingFieldError(name)
+
+        packet_type = param("Packet_Type", str)
+        notice_type = _VOEVENT_PACKET_TYPES.get(packet_type)
+        if notice_type is None:
+            raise InvalidFieldError("Packet_Type", packet_type)
+
+        for c in ("C1", "C2"):
+            if c not in coords:
+                raise MissingFieldError(c)
+        if iso_time is None:
+            raise MissingFieldError("ISOTime")
+
+        ra = _convert("C1", coords["C1"], float)
+        dec = _convert("C2", coords["C2"], float)
+        tjd, sod = _parse_time("ISOTime", iso_time)
+        gal_lon, gal_lat = equatorial_to_galactic(ra, dec)
+        return GCNNotice(
+            notice_type=notice_type,
+            run_num=param("run_id", int, "run_num"),
+            evt_num=param("event_id", int, "event_num"),
+            ra=ra,
+            dec=dec,
+            tjd=tjd,
+            sod=sod,
+            gal_lon=gal_lon,
+            gal_lat=gal_lat,
+            energy=param("Energy", float),
+            signalness=param("Signalness", float),
+            revision=param("Rev", int, "Revision")
+        )
+
+    @staticmethod
+    def parse_json(notice: str) -> GCNNotice:
+        try:
+            values = json.loads(notice)
+        except json.JSONDecodeError as e:
+            raise GCNParseError(f"Invalid JSON: {e}") from None
+        if not isinstance(values, dict):
+            raise GCNParseError("JSON notice is not an object")
 
-        gal_lon, gal_lat = kv['GAL_COORDS'].split('[deg]')[0].split(',')
+        def get(field: str, conv: Callable[[Any], Any]):
+            for key in _JSON_KEYS[field]:
+                if values.get(key) is not None:
+                    return _convert(key, values[key], conv)
+            raise MissingFieldError(_JSON_KEYS[field][0])
 
+        ra = get("ra", float)
+        dec = get("dec", float)
+        tjd, sod = _parse_time("trigger_time", get("time", str))
+        if "gal_lon" in values and "gal_lat" in values:
+            gal_lon = _convert("gal_lon", values["gal_lon"], float)
+            gal_lat = _convert("gal_lat", values["gal_lat"], float)
+        else:
+            gal_lon, gal_lat = equatorial_to_galactic(ra, dec)
         return GCNNotice(
-            notice_type=kv['NOTICE_TYPE'],
-            run_num=int(kv['RUN_NUM']),
-            evt_num=int(kv['EVENT_NUM']),
-            ra=float(kv['SRC_RA'].split('d')[0]),
-            dec=float(kv['SRC_DEC'].split('d')[0]),
-            tjd=int(kv["DISCOVERY_DATE"].split("TJD")[0]),
-            sod=int(kv["DISCOVERY_TIME"].split("SOD")[0]),
-            gal_lon=float(gal_lon),
-            gal_lat=float(gal_lat),
-            energy=float(kv["ENERGY"].split('[')[0]),
-            signalness=float(kv["SIGNALNESS"].split('[')[0]),
-            revision=int(kv["REVISION"])
+            notice_type=get("notice_type", str),
+            run_num=get("run_num", int),
+            evt_num=get("evt_num", int),
+            ra=ra,
+            dec=dec,
+            tjd=tjd,
+            sod=sod,
+            gal_lon=gal_lon,
+            gal_lat=gal_lat,
+            energy=get("energy", float),
+            signalness=get("signalness", float),
+            revision=get("revision", int)
         )
+
+    @staticmethod
+    def parse(notice: str, format: Optional[NoticeFormat] = None) -> GCNNotice:
+        """
+        Parses a notice in any of the supported formats. If `format` is not given, it
+        is detected from the notice. Raises a GCNParseError if the notice can't be parsed.
+        """
+        if format is None:
+            format = GCNParser.detect_format(notice)
+        parser = _PARSERS.get(format)
+        if parser is None:
+            raise UnknownFormatError(f"Unknown notice format '{format}'")
+        return parser(notice)
+
+    @staticmethod
+    def parse_many(notices: Iterable[str], format: Optional[NoticeFormat] = None,
+                   skip_errors: bool = False) -> List[Optional[GCNNotice]]:
+        """
+        Parses all `notices`. With `skip_errors`, notices that fail to parse are returned
+        as None instead of raising, so the result lines up with the input.
+        """
+        results = []
+        for notice in notices:
+            try:
+                results.append(GCNParser.parse(notice, format))
+            except GCNParseError:
+                if not skip_errors:
+                    raise
+                results.append(None)
+        return results
+
+
+_PARSERS: Dict[str, Callable[[str], GCNNotice]] = {
+    "text": GCNParser.parse_text,
+    "voevent": GCNParser.parse_voevent,
+    "json": GCNParser.parse_json,
+}
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import subprocess
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Set
+
+from stellarium_gcn_wp import metrics
+from stellarium_gcn_wp.hooks import OutputsCallback
+
+logger = logging.getLogger(__name__)
+
+hook_results = metrics.registry.counter("sgw_hook_results_total", "Finished post render hooks", ["hook", "result"])
+hook_seconds = metrics.registry.histogram("sgw_hook_seconds", "Time taken by post render hooks", ["hook"])
+
+
+class HookTimeoutError(TimeoutError):
+    pass
+
+
+@dataclass
+class HookResult:
+    hook: str
+    # "ok", "failed" or "timeout"
+    result: str
+    attempts: int
+    seconds: float
+    error: Optional[BaseException] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.result == "ok"
+
+
+def hook_name(hook: Callable) -> str:
+    return getattr(hook, "__name__", type(hook).__name__)
+
+
+class HookExecutor:
+    """
+    Runs post render callbacks in the background, as tasks of the event loop, up to
+    `workers` at a time, so a slow or hung hook doesn't hold up rendering and committing of
+    the next notices. Each hook runs for one notice at a time, in the order they were
+    submitted, so e.g. the wallpaper of an older notice never replaces a newer one. Each
+    attempt of a hook is given `timeout` seconds, and failed attempts are retried up to
+    `retries` times, `retry_delay` seconds apart.
+
+    Hooks are plain functions, which run in threads of their own. Python can't stop a
+    thread, so a hook that times out keeps running in the background until it returns, but
+    its task moves on. Until that thread returns, further attempts of the hook fail right
+    away instead of starting another one, so there is at most one thread per hook. Hooks
+    that run commands (see hooks.run_command) kill the command when it takes too long.
+    """
+
+    def __init__(self, callbacks: Sequence[Callable], workers: int = 4, timeout: Optional[float] = 60.0,
+                 retries: int = 1, retry_delay: float = 5.0,
+                 on_result: Optional[Callable[[HookResult], None]] = None):
+        self._callbacks = list(callbacks)
+        self._semaphore = asyncio.Semaphore(workers)
+        # Keeps the runs of each hook in order, by index in `callbacks`
+        self._locks = [asyncio.Lock() for _ in self._callbacks]
+        # The thread of the last attempt of each hook, which may still be running after a timeout
+        self._threads: Dict[int, threading.Thread] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._timeout = timeout
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._on_result = on_result
+
+    def submit(self, outputs: Dict[str, Path], trace: Optional[metrics.Trace] = None) -> List[asyncio.Task]:
+        """
+        Starts all callbacks for `outputs`, and returns a task with the HookResult of each. A
+        `trace` of the notice gets a hook:<name> stage for each hook, and is only written
+        once all of them are done.
+        """
+        primary = next(iter(outputs.values()))
+        tasks = []
+        for index, cb in enumerate(self._callbacks):
+            arg = outputs if isinstance(cb, OutputsCallback) else primary
+            task = asyncio.create_task(self._run(index, arg, trace), name=f"hook-{hook_name(cb)}")
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            if trace is not None:
+                trace.hold()
+                task.add_done_callback(lambda _: trace.release())
+            tasks.append(task)
+        return tasks
+
+    async def run(self, outputs: Dict[str, Path]) -> List[HookResult]:
+        """Runs all callbacks for `outputs` and waits for them."""
+        return list(await asyncio.gather(*self.submit(outputs)))
+
+    async def shutdown(self, wait: bool = True):
+        """Waits for the hooks that are running or waiting to run, or cancels them if not `wait`."""
+        tasks = list(self._tasks)
+        if not wait:
+            for task in tasks:
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _attempt(self, index: int, arg):
+        # Runs in a separate thread, so we can stop waiting for it
+        cb = self._callbacks[index]
+        if (previous := self._threads.get(index)) is not None and previous.is_alive():
+            raise HookTimeoutError(f"Hook {hook_name(cb)} is still running after an earlier timeout")
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        def finish(error: Optional[BaseException]):
+            if not done.done():
+                done.set_result(error)
+
+        def target():
+            error = None
+            try:
+                cb(arg)
+            except BaseException as e:
+                error = e
+            try:
+                loop.call_soon_threadsafe(finish, error)
+            except RuntimeError:
+                # The event loop is closed, nobody is waiting anymore
+                pass
+
+        thread = threading.Thread(target=target, name=f"hook-{hook_name(cb)}", daemon=True)
+        self._threads[index] = thread
+        thread.start()
+        try:
+            async with asyncio.timeout(self._timeout):
+                error = await done
+        except TimeoutError:
+            raise HookTimeoutError(f"Hook {hook_name(cb)} didn't finish within {self._timeout} s") from None
+        if error is not None:
+            raise error
+
+    async def _run(self, index: int, arg, trace: Optional[metrics.Trace]) -> HookResult:
+        async with self._locks[index], self._semaphore:
+            result = await self._run_attempts(index, arg)
+        if trace is not None:
+            trace.mark(f"hook:{result.hook}")
+            trace.info.setdefault("hooks", {})[result.hook] = result.result
+        return result
+
+    async def _run_attempts(self, index: int, arg) -> HookResult:
+        name = hook_name(self._callbacks[index])
+        t_start = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                await self._attempt(index, arg)
+                result = HookResult(name, "ok", attempt, time.monotonic() - t_start)
+                break
+            except Exception as e:
+                kind = "timeout" if isinstance(e, (HookTimeoutError, subprocess.TimeoutExpired)) else "failed"
+                if attempt > self._retries:
+                    logger.error(f"Hook {name} {kind} after {attempt} attempts: {e}")
+                    result = HookResult(name, kind, attempt, time.monotonic() - t_start, e)
+                    break
+                logger.warning(f"Hook {name} {kind} ({e}), retrying in {self._retry_delay} s")
+                await asyncio.sleep(self._retry_delay)
+
+        if result.ok:
+            logger.info(f"Hook {name} finished in {result.seconds:.2f} s")
+        hook_results.inc(hook=name, result=result.result)
+        hook_seconds.observe(result.seconds, hook=name)
+        if self._on_result is not None:
+            self._on_result(result)
+        return result
@@ -1,19 +1,139 @@
+import os
+import shutil
 import subprocess
+import tempfile
+from abc import ABC, abstractmethod
 from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional, Sequence
 
 import logging
 logger = logging.getLogger(__name__)
 
+# Commands run by hooks are killed after this many seconds
+COMMAND_TIMEOUT = 60.0
+
+
+def run_command(argv: Sequence[str], timeout: Optional[float] = COMMAND_TIMEOUT):
+    """Runs `argv` without a shell. Raises if it fails or doesn't finish within `timeout` seconds."""
+    subprocess.run([str(a) for a in argv], check=True, timeout=timeout,
+                   stdin=subprocess.DEVNULL, capture_output=True)
+
+
+class OutputsCallback(ABC):
+    """
+    Post render callbacks are called with the path of the first output. Callbacks that
+    derive from this class are called with the paths of all outputs, by output name, instead.
+    """
+
+    @abstractmethod
+    def __call__(self, outputs: Dict[str, Path]):
+        pass
+
+
+class on_output(OutputsCallback):
+    """Calls `callback` with the path of the output called `name`, e.g. on_output("lockscreen", kde_set_lockscreen)"""
+
+    def __init__(self, name: str, callback: Callable[[Path], None]):
+        self.name = name
+        self.callback = callback
+        self.__name__ = getattr(callback, "__name__", type(callback).__name__)
+
+    def __call__(self, outputs: Dict[str, Path]):
+        if self.name not in outputs:
+            logger.warning(f"No output called '{self.name}' for {self.__name__}")
+            return
+        self.callback(outputs[self.name])
+
+
+class Command:
+    """
+    Runs a command for the rendered image. {path} in any argument is replaced with the
+    path of the image, e.g. Command(["feh", "--bg-fill", "{path}"])
+    """
+
+    def __init__(self, argv: Sequence[str], timeout: Optional[float] = COMMAND_TIMEOUT):
+        self.argv = list(argv)
+        self.timeout = timeout
+        self.__name__ = Path(self.argv[0]).name
+
+    def __call__(self, image_path: Path):
+        run_command([a.replace("{path}", str(image_path.absolute())) for a in self.argv], self.timeout)
+
+
+class Publisher(OutputsCallback):
+    """
+    Publishes the outputs of a render somewhere else, e.g. to other machines or desktops.
+    `names` restricts publishing to some of the outputs.
+    """
+
+    def __init__(self, names: Optional[Iterable[str]] = None):
+        self.names = set(names) if names is not None else None
+        self.__name__ = type(self).__name__
+
+    def __call__(self, outputs: Dict[str, Path]):
+        if self.names is not None:
+            outputs = {name: path for name, path in outputs.items() if name in self.names}
+        if outputs:
+            self.publish(outputs)
+
+    @abstractmethod
+    def publish(self, outputs: Dict[str, Path]):
+        pass
+
+
+class DirectoryPublisher(Publisher):
+    """
+    Copies the outputs into `directory`, e.g. a shared or synced directory that other
+    machines pick wallpapers up from. With `stable_names`, every output is saved as
+    <output name><suffix>, so the directory always has the latest image under the same name.
+    """
+
+    def __init__(self, directory: str | Path, stable_names: bool = True, names: Optional[Iterable[str]] = None):
+        super().__init__(names)
+        self.directory = Path(directory).expanduser()
+        self.stable_names = stable_names
+
+    def publish(self, outputs: Dict[str, Path]):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for name, path in outputs.items():
+            target = self.directory / (f"{name}{path.suffix}" if self.stable_names else path.name)
+            # Copy next to the target and rename, so readers never see a partial image
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            os.close(fd)
+            try:
+                shutil.copyfile(path, tmp_path)
+                os.replace(tmp_path, target)
+            except BaseException:
+                Path(tmp_path).unlink(missing_ok=True)
+                raise
+            logger.info(f"Published {path} to {target}")
+
+
+class RsyncPublisher(Publisher):
+    """Copies the outputs to `target` with rsync, which can be a local path or host:path."""
+
+    def __init__(self, target: str, args: Sequence[str] = ("-a",), timeout: Optional[float] = COMMAND_TIMEOUT,
+                 names: Optional[Iterable[str]] = None):
+        super().__init__(names)
+        self.target = target
+        self.args = list(args)
+        self.timeout = timeout
+
+    def publish(self, outputs: Dict[str, Path]):
+        run_command(["rsync", *self.args, *(str(p) for p in outputs.values()), self.target], self.timeout)
+        logger.info(f"Published {len(outputs)} outputs to {self.target}")
+
+
 # Wallpaper setters for KDE
 def kde_set_wallpaper(image_path: Path):
     logger.info(f"Setting KDE wallpaper to {image_path}")
-    subprocess.run(f"plasma-apply-wallpaperimage {image_path.absolute()}", shell=True)
+    run_command(["plasma-apply-wallpaperimage", image_path.absolute()])
 
 
 def kde_set_lockscreen(image_path: Path):
     logger.info(f"Setting KDE lockscreen image to {image_path}")
-    subprocess.run(f"kwriteconfig5 --file kscreenlockerrc --group Greeter --group Wallpaper"
-                   f" --group org.kde.image --group General --key Image {image_path.absolute()}", shell=True)
+    run_command(["kwriteconfig5", "--file", "kscreenlockerrc", "--group", "Greeter", "--group", "Wallpaper",
+                 "--group", "org.kde.image", "--group", "General", "--key", "Image", image_path.absolute()])
 
 # Wallpaper setters for Gnome
 def gnome3_light_theme_set_wallpaper(image_path: Path):
@@ -26,5 +146,5 @@ def gnome3_set_wallpaper(image_path: Path, dark: bool):
     theme = "dark" if dark else "light"
     logger.info(f"Setting Gnome3 {theme}-theme wallpaper to {image_path}")
     config_key = "picture-uri-dark" if dark else "picture-uri"
-    subprocess.run(f"gsettings set org.gnome.desktop.background {config_key} file://{image_path.absolute()}",
-                   shell=True)
\ No newline at end of file
+    run_command(["gsettings", "set", "org.gnome.desktop.background", config_key,
+                 f"file://{image_path.absolute()}"])
@@ -1,20 +1,33 @@
 import argparse
+import asyncio
 import dataclasses
 import datetime
+import os
 import random
+import signal
 import sys
 import time
 from pathlib import Path
+from typing import TYPE_CHECKING, Awaitable, Callable, Coroutine, Iterable, List, Sequence, Tuple
 
-from stellarium_gcn_wp.gcn_consumer import GCNConsumer
-from stellarium_gcn_wp.gcn_parser import GCNParser, GCNNotice
-from stellarium_gcn_wp.renderer import RenderParams, Renderer
-from stellarium_gcn_wp.settings import Settings
-
-from queue import Queue, Empty
+from stellarium_gcn_wp import metrics, overlay
+from stellarium_gcn_wp.archive import ArchivedNotice, EventArchive
+from stellarium_gcn_wp.gcn_parser import GCNParser, GCNNotice, GCNParseError
+from stellarium_gcn_wp.hook_executor import HookExecutor
+from stellarium_gcn_wp.notice_files import read_notices
+from stellarium_gcn_wp.output_pipeline import OutputProcessor
+from stellarium_gcn_wp.priority import PriorityPolicy
+from stellarium_gcn_wp.render_cache import RenderCache
+from stellarium_gcn_wp.render_pool import RenderPool, RenderWorker
+from stellarium_gcn_wp.render_queue import QueuedNotice, RenderQueue
+from stellarium_gcn_wp.renderer import OutputSpec, RenderParams
+from stellarium_gcn_wp.settings import DEFAULT_CONFIG_PATH, Settings
 
 import logging
 
+if TYPE_CHECKING:
+    from stellarium_gcn_wp.gcn_consumer import GCNConsumer
+
 logger = logging.getLogger(__name__)
 
 
@@ -25,6 +38,9 @@ def tjd_sod_to_datetime_utc(tjd: int, sod: int) -> datetime.datetime:
 def make_render_params(notice: GCNNotice) -> RenderParams:
     ts = tjd_sod_to_datetime_utc(notice.tjd, notice.sod)
 
+    ra_view_offset, dec_view_offset = Settings.view_offsets(notice.run_num, notice.evt_num)
+    observer_location = Settings.observer_location
+
     color = "#ffbf00"  # gold
     if "Bronze" in notice.notice_type:
         color = "#CD7F32"  # bronze
@@ -34,10 +50,10 @@ def make_render_params(notice: GCNNotice) -> RenderParams:
         image_height=Settings.image_height,
         fov=Settings.fov,
         projection=Settings.projection,
-        ra_view_offset=Settings.ra_view_offset,
-        dec_view_offset=Settings.dec_view_offset,
-        observer_lon=Settings.observer_location[0],
-        observer_lat=Settings.observer_location[1],
+        ra_view_offset=ra_view_offset,
+        dec_view_offset=dec_view_offset,
+        observer_lon=observer_location[0],
+        observer_lat=observer_location[1],
         ra=notice.ra,
         dec=notice.dec,
         tjd=notice.tjd,
@@ -50,37 +66,381 @@ def make_render_params(notice: GCNNotice) -> RenderParams:
     )
 
 
-def run(queue: Queue, once: bool):
-    while True:
-        logger.info("Waiting for GCN Notice")
-        while True:
+def make_out_filename(notice: GCNNotice, output: OutputSpec, multiple: bool) -> Path:
+    pattern = output.out_file_name or Settings.out_file_name
+    if multiple and output.out_file_name is None and "{output}" not in pattern:
+        # Keep the outputs from overwriting each other
+        path = Path(pattern)
+        pattern = str(path.with_name(f"{path.stem}_{{output}}{path.suffix}"))
+    out_filename = Path(pattern.format(output=output.name, **dataclasses.asdict(notice)))
+    out_filename = out_filename.expanduser().resolve()
+    out_filename.parent.mkdir(parents=True, exist_ok=True)
+    return out_filename
+
+
+async def handle_notice(item: QueuedNotice, worker: RenderWorker, hook_executor: HookExecutor,
+                        render_cache: RenderCache | None = None,
+                        compositor: overlay.BaseLayerCompositor | None = None,
+                        skip_existing: bool = False, output_processor: OutputProcessor | None = None):
+    notice = item.notice
+    if notice is None:
+        notice = GCNParser.parse(item.text)
+    logger.info(f"Parsed GCN notice: {notice}")
+    # Archived right away, so it is there even if it isn't rendered. Its outputs are added after the render
+    if output_processor is not None:
+        output_processor.record(notice)
+
+    logger.info(f"Rendering on worker {worker.index}")
+    rp = make_render_params(notice)
+    specs = Settings.render_outputs
+    outputs = {spec.name: (spec.apply(rp), make_out_filename(notice, spec, len(specs) > 1)) for spec in specs}
+
+    item.trace.mark("prepare")
+
+    missing = dict(outputs)
+    if skip_existing:
+        missing = {name: output for name, output in missing.items() if not output[1].exists()}
+        if not missing:
+            logger.info(f"All outputs for revision {notice.revision} of event {notice.evt_num} exist, skipping")
+            item.trace.finish("skipped")
+            return
+
+    # Only render the outputs that are not cached
+    if render_cache is not None:
+        uncached = len(missing)
+        for name, (params, out_filename) in list(missing.items()):
+            if render_cache.get(RenderCache.key(params), out_filename):
+                logger.info(f"Using cached render of output '{name}' for event {notice.evt_num}")
+                del missing[name]
+        if len(missing) < uncached:
+            item.trace.mark("cache")
+
+    if missing and compositor is not None:
+        missing = await compositor.render(
+            missing, lambda ps, paths: worker.render(ps, paths, Settings.render_timeout, item.cancel, item.trace.mark),
+            worker.tmp_dir)
+        item.trace.mark("composite")
+
+    rendered = True
+    if missing and not item.cancel.is_set():
+        params = [params for params, _ in missing.values()]
+        out_filenames = [out_filename for _, out_filename in missing.values()]
+        rendered = await worker.render(params, out_filenames, Settings.render_timeout, item.cancel, item.trace.mark)
+        if rendered and render_cache is not None:
+            for p, out_filename in zip(params, out_filenames):
+                render_cache.put(RenderCache.key(p), out_filename)
+
+    if item.cancel.is_set():
+        if item.preempted:
+            # The queue renders it again later
+            logger.info(f"Render for event {notice.evt_num} was preempted by a more important notice")
+            return
+        logger.info(f"Render for revision {notice.revision} of event {notice.evt_num} was superseded")
+        item.trace.finish("cancelled")
+        return
+    # Outputs that weren't written may not end up in the archive or be handed to the hooks
+    if not rendered or not all(out_filename.exists() for _, out_filename in outputs.values()):
+        logger.error(f"Render for revision {notice.revision} of event {notice.evt_num} failed")
+        item.trace.finish("failed")
+        return
+    logger.info(f"Render for event {notice.evt_num} saved to "
+                f"{', '.join(str(out_filename) for _, out_filename in outputs.values())}")
+
+    # Variants, the archive and the hooks are handled in the background, so they don't
+    # hold up the next notice
+    if output_processor is not None:
+        output_processor.submit(notice, {name: out_filename for name, (_, out_filename) in outputs.items()})
+    hook_executor.submit({name: out_filename for name, (_, out_filename) in outputs.items()}, trace=item.trace)
+
+
+def make_hook_executor() -> HookExecutor:
+    return HookExecutor(Settings.post_render_callbacks, workers=Settings.hook_workers,
+                        timeout=Settings.hook_timeout, retries=Settings.hook_retries,
+                        retry_delay=Settings.hook_retry_delay)
+
+
+def make_output_processor(archive: EventArchive | None) -> OutputProcessor | None:
+    if not Settings.output_formats and not Settings.thumbnail_widths and archive is None:
+        return None
+    return OutputProcessor(Settings.output_formats, quality=Settings.output_quality,
+                           thumbnail_widths=Settings.thumbnail_widths,
+                           thumbnail_format=Settings.thumbnail_format, archive=archive)
+
+
+def make_handler(hook_executor: HookExecutor, skip_existing: bool = False,
+                 output_processor: OutputProcessor | None = None
+                 ) -> Callable[[QueuedNotice, RenderWorker], Awaitable[None]]:
+    render_cache = None
+    if Settings.render_cache_dir is not None:
+        render_cache = RenderCache(Settings.render_cache_dir,
+                                   max_bytes=Settings.render_cache_max_bytes,
+                                   max_age=Settings.render_cache_max_age)
+    compositor = None
+    if Settings.base_layer_cache_dir is not None:
+        if overlay.available():
+            compositor = overlay.BaseLayerCompositor(RenderCache(Settings.base_layer_cache_dir,
+                                                                 max_bytes=Settings.render_cache_max_bytes,
+                                                                 max_age=Settings.render_cache_max_age),
+                                                     time_bucket=Settings.base_layer_time_bucket,
+                                                     view_grid=Settings.base_layer_view_grid)
+        else:
+            logger.warning("Pillow is not installed, rendering without base layers")
+    return lambda item, worker: handle_notice(item, worker, hook_executor, render_cache, compositor, skip_existing,
+                                              output_processor)
+
+
+def make_pool(queue: RenderQueue, once: bool, hook_executor: HookExecutor, skip_existing: bool = False,
+              output_processor: OutputProcessor | None = None) -> RenderPool:
+    screen_width, screen_height = Settings.screen_size
+    return RenderPool(queue, make_handler(hook_executor, skip_existing, output_processor),
+                      workers=1 if once else Settings.render_workers,
+                      limits=Settings.render_limits,
+                      display_base=Settings.render_display_base,
+                      use_server=Settings.render_server,
+                      server_port_base=Settings.render_server_port,
+                      screen_width=screen_width,
+                      screen_height=screen_height,
+                      phase_timeouts=Settings.render_phase_timeouts,
+                      settle=Settings.render_settle)
+
+
+async def run(queue: RenderQueue, consumer: "GCNConsumer", once: bool, hook_executor: HookExecutor,
+              output_processor: OutputProcessor | None = None):
+    """
+    Renders the notices `consumer` puts into `queue` until the first render if `once`,
+    or until cancelled. Then the consumer is stopped, and the renders in progress get
+    Settings.shutdown_timeout seconds to finish, before the handled notices are committed.
+    """
+    pool = make_pool(queue, once, hook_executor, output_processor=output_processor)
+    consuming = asyncio.create_task(consumer.run(), name="gcn-consumer")
+    rendering = asyncio.create_task(pool.run(once), name="render-pool")
+    logger.info("Waiting for GCN Notice")
+    try:
+        done, _ = await asyncio.wait((consuming, rendering), return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            # Raises if the consumer or the pool failed
+            task.result()
+    finally:
+        consumer.stop()
+        await pool.stop(Settings.shutdown_timeout)
+        await asyncio.gather(rendering, consuming, return_exceptions=True)
+        await hook_executor.shutdown(wait=True)
+        await consumer.close()
+
+
+async def render_notices(items: Iterable[QueuedNotice], hook_executor: HookExecutor, skip_existing: bool = True,
+                         output_processor: OutputProcessor | None = None) -> Tuple[int, int]:
+    """
+    Renders `items` with Settings.render_workers workers, without kafka, and waits for their
+    hooks. Returns the number of notices that were queued, and of those that failed to render.
+    """
+    failed = 0
+
+    def on_done(item: QueuedNotice):
+        nonlocal failed
+        if item.trace.result == "failed":
+            failed += 1
+
+    queue = RenderQueue(maxsize=Settings.max_queued_notices, on_done=on_done)
+    pool = make_pool(queue, False, hook_executor, skip_existing, output_processor)
+    rendering = asyncio.create_task(pool.run(), name="render-pool")
+
+    queued = 0
+    try:
+        for item in items:
+            await queue.put(item)
+            queued += 1
+        await queue.join()
+    finally:
+        await pool.stop(Settings.shutdown_timeout)
+        await rendering
+        await hook_executor.shutdown(wait=True)
+    return queued, failed
+
+
+async def render_files(paths: Sequence[str], hook_executor: HookExecutor, skip_existing: bool = True,
+                       output_processor: OutputProcessor | None = None) -> int:
+    """
+    Renders the notices in `paths` (see notice_files.read_notices). Returns the number of
+    notices that couldn't be parsed or rendered.
+    """
+    failed = 0
+
+    def parsed():
+        nonlocal failed
+        for source, text in read_notices(paths):
             try:
-                gcn_text = queue.get(block=True, timeout=0.5)
-                break
-            except Empty:
+                notice = GCNParser.parse(text)
+            except GCNParseError as e:
+                logger.warning(f"Skipping notice {source}: {e}")
+                failed += 1
                 continue
+            yield QueuedNotice(text=text, notice=notice)
+
+    queued, failed_renders = await render_notices(parsed(), hook_executor, skip_existing, output_processor)
+    logger.info(f"Finished {queued} notices, {failed_renders} failed to render, {failed} could not be parsed")
+    return failed + failed_renders
 
-        notice = GCNParser.parse(gcn_text)
-        logger.info(f"Parsed GCN notice: {notice}")
 
-        logger.info("Rendering")
-        rp = make_render_params(notice)
-        renderer = Renderer(render_params=rp, cpu_limit=Settings.render_cpu_limit)
-        out_filename = Path(Settings.out_file_name.format(**dataclasses.asdict(notice)))
-        out_filename = out_filename.expanduser().resolve()
-        out_filename.parent.mkdir(parents=True, exist_ok=True)
+async def consume(args: argparse.Namespace, topics: List[str], hook_executor: HookExecutor,
+                  output_processor: OutputProcessor | None = None):
+    """Renders the notices on `topics`, as a backfill or as they arrive, from GCN or a replay."""
+    # Replays are published to an in-process broker, which the consumer reads from
+    # instead of GCN
+    consumer_factory = None
+    replayer = None
+    if args.replay is not None or args.synthetic is not None:
+        # The kafka clients take a while to import, so they are only imported when needed
+        from stellarium_gcn_wp.fake_kafka import FakeBroker
+        from stellarium_gcn_wp.notice_sources import FileNoticeSource, Replayer, SyntheticNoticeSource
 
-        renderer.render(out_filename, Settings.render_timeout)
-        logger.info(f"Render for event {notice.evt_num} saved to {out_filename}")
+        broker = FakeBroker()
+        consumer_factory = broker.consumer
+        if args.replay is not None:
+            source = FileNoticeSource(args.replay)
+        else:
+            source = SyntheticNoticeSource(args.synthetic, rate=args.synthetic_rate)
+        replayer = Replayer(broker, source, speed=args.replay_speed)
 
-        for cb in Settings.post_render_callbacks:
-            cb(out_filename)
+    if args.command == "backfill":
+        from stellarium_gcn_wp.backfill import Backfill
 
-        queue.task_done()
+        if replayer is not None:
+            await replayer.run()
+        backfill = Backfill(topics, args.checkpoint, make_handler(hook_executor, output_processor=output_processor),
+                            since=args.since, until=args.until, from_offset=args.from_offset,
+                            batch_size=args.batch_size, max_pending=args.max_pending,
+                            workers=Settings.render_workers, shutdown_timeout=Settings.shutdown_timeout,
+                            consumer_factory=consumer_factory)
+        try:
+            await backfill.run()
+        finally:
+            await hook_executor.shutdown(wait=True)
+        return
 
-        if once:
+    from stellarium_gcn_wp.commit_ledger import CommitLedger
+    from stellarium_gcn_wp.gcn_consumer import GCNConsumer
+
+    ledger = None
+    on_done = None
+    if args.start == "track":
+        ledger = CommitLedger(Settings.commit_ledger_path)
+
+        def mark_completed(item: QueuedNotice):
+            if item.offset is not None:
+                ledger.completed(item.topic, item.partition, item.offset)
+
+        on_done = mark_completed
+
+    policy = PriorityPolicy(Settings.priority_rules, aging=Settings.priority_aging,
+                            preempt_margin=Settings.priority_preempt_margin)
+    queue = RenderQueue(maxsize=Settings.max_queued_notices, on_done=on_done, policy=policy,
+                        workers=1 if args.once else Settings.render_workers)
+    consumer = GCNConsumer(queue, start_on=args.start, topics=topics, ledger=ledger,
+                           consumer_factory=consumer_factory,
+                           batch_size=Settings.kafka_batch_size, batch_timeout=Settings.kafka_batch_timeout,
+                           prefetch_bytes=Settings.kafka_prefetch_bytes, notice_types=Settings.notice_types,
+                           kafka_config=Settings.kafka_config, lag_interval=Settings.kafka_lag_interval)
+    replaying = None
+    if replayer is not None:
+        replaying = asyncio.create_task(replayer.run(), name="replayer")
+
+    try:
+        # If we are initializing tracking, we want to consume every event and commit it,
+        # so we start at the end of the stream in the future
+        if args.init_tracking:
+            if not args.start == "track":
+                logger.warning(f"Can only initialize tracking when --start is 'track'. Is currently '{args.start}'")
+
+            logger.info("Initializing tracking by moving to end of stream")
+            consuming = asyncio.create_task(consumer.run(), name="gcn-consumer")
+            try:
+                while True:
+                    try:
+                        item = await asyncio.wait_for(queue.get(), 10.0)
+                    except TimeoutError:
+                        break
+                    queue.done(item)
+            finally:
+                consumer.stop()
+                await consuming
+                await consumer.close()
+            logger.info("Done initializing tracking.")
             return
 
+        logger.info("Starting main loop")
+        await run(queue, consumer, args.once, hook_executor, output_processor)
+    finally:
+        if replaying is not None:
+            replaying.cancel()
+
+
+def run_until_signalled(main: Coroutine):
+    """
+    Runs `main` on a new event loop, and returns its result. The first SIGTERM or SIGINT
+    cancels it, so it shuts down gracefully, and a second one cancels the shutdown too. If it
+    was cancelled, exits with 128 + the signal number, like a shell reports a process killed
+    by that signal.
+    """
+    received: List[signal.Signals] = []
+
+    async def runner():
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+
+        def on_signal(sig: signal.Signals):
+            received.append(sig)
+            if task.cancelling():
+                logger.warning(f"Received {sig.name} again, not waiting for renders to finish")
+            else:
+                logger.info(f"Received {sig.name}, shutting down...")
+            task.cancel()
+
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, on_signal, sig)
+        try:
+            return await main, False
+        except asyncio.CancelledError:
+            if not received:
+                raise
+            return None, True
+
+    result, cancelled = asyncio.run(runner())
+    if cancelled:
+        sys.exit(128 + received[0])
+    return result
+
+
+def parse_ra_dec(value: str) -> Tuple[float, float]:
+    ra, dec = value.split(",")
+    return float(ra), float(dec)
+
+
+def query_archive(archive: EventArchive, args: argparse.Namespace) -> List[ArchivedNotice]:
+    def unix_time(ts: datetime.datetime | None) -> float | None:
+        if ts is None:
+            return None
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=datetime.timezone.utc)
+        return ts.timestamp()
+
+    start, end = unix_time(args.since), unix_time(args.until)
+    if args.near is not None:
+        results = archive.cone_search(*args.near, args.radius, start, end, args.notice_type, args.all_revisions)
+    else:
+        results = archive.time_range(start, end, args.notice_type, args.all_revisions)
+    return results[:args.limit] if args.limit is not None else results
+
+
+def print_archived(archive: EventArchive, archived: ArchivedNotice):
+    n = archived.notice
+    ts = tjd_sod_to_datetime_utc(n.tjd, n.sod)
+    distance = f" {archived.distance:5.2f}°" if archived.distance is not None else ""
+    outputs = archive.outputs(n.run_num, n.evt_num, n.revision)
+    paths = " ".join(output["path"] for output in outputs.values())
+    print(f"{ts.isoformat()} {n.notice_type:<24} {n.run_num}/{n.evt_num} rev {n.revision} "
+          f"ra {n.ra:7.3f} dec {n.dec:+7.3f}{distance} {paths}".rstrip())
+
 
 def main():
     logging.basicConfig(level=logging.INFO, stream=sys.stdout,
@@ -95,11 +455,114 @@ def main():
     parser.add_argument("-1", "--once", action="store_true", default=False)
     parser.add_argument("-o", "--output", type=str)
     parser.add_argument("-i", "--init-tracking", action="store_true", default=False)
+    parser.add_argument("--render-server", action="store_true", default=False)
+    parser.add_argument("-j", "--workers", type=int)
+    parser.add_argument("--replay", type=str, nargs="+", metavar="PATH",
+                        help="Replay notices from files instead of subscribing to GCN")
+    parser.add_argument("--synthetic", type=int, metavar="COUNT",
+                        help="Replay COUNT generated events instead of subscribing to GCN")
+    parser.add_argument("--synthetic-rate", type=float, default=60.0,
+                        help="Events per hour for --synthetic")
+    parser.add_argument("--replay-speed", type=float, default=1.0,
+                        help="Time scale of the replay, 0 replays everything at once")
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve prometheus metrics on this port")
+    parser.add_argument("--trace-file", type=str,
+                        help="Append the per-stage timeline of every notice to this JSONL file")
+    parser.add_argument("--config", type=str,
+                        help="TOML or env file to read settings from, by default $STELLARIUM_GCN_CONFIG "
+                             f"or {DEFAULT_CONFIG_PATH} if it exists")
+
+    subparsers = parser.add_subparsers(dest="command")
+    backfill_parser = subparsers.add_parser("backfill", help="Render all past notices in a range")
+    backfill_parser.add_argument("--since", type=datetime.datetime.fromisoformat,
+                                 help="Start at the first notice at or after this (UTC) time")
+    backfill_parser.add_argument("--until", type=datetime.datetime.fromisoformat,
+                                 help="Stop before the first notice at or after this (UTC) time")
+    backfill_parser.add_argument("--from-offset", type=int,
+                                 help="Start at this offset in each partition")
+    backfill_parser.add_argument("--checkpoint", type=str, default=Settings.backfill_checkpoint_path)
+    backfill_parser.add_argument("--batch-size", type=int, default=100)
+    backfill_parser.add_argument("--max-pending", type=int, default=16)
+
+    render_parser = subparsers.add_parser("render", help="Render notices from files or stdin, without kafka")
+    render_parser.add_argument("paths", nargs="*", default=["-"], metavar="PATH",
+                               help="Notice files, directories, glob patterns or - for stdin (the default)")
+    render_parser.add_argument("--force", action="store_true", default=False,
+                               help="Render outputs again that already exist")
+    render_parser.add_argument("--hooks", action="store_true", default=False,
+                               help="Run the post render callbacks for every rendered notice")
+
+    archive_parser = subparsers.add_parser("archive", help="Find past events in the archive, and render them")
+    archive_parser.add_argument("--near", type=parse_ra_dec, metavar="RA,DEC",
+                                help="Only events within --radius degrees of this position (J2000, degrees)")
+    archive_parser.add_argument("--radius", type=float, default=10.0)
+    archive_parser.add_argument("--since", type=datetime.datetime.fromisoformat,
+                                help="Only events at or after this (UTC) time")
+    archive_parser.add_argument("--until", type=datetime.datetime.fromisoformat,
+                                help="Only events before this (UTC) time")
+    archive_parser.add_argument("--notice-type", type=str,
+                                help="Only notice types that contain this, e.g. gold")
+    archive_parser.add_argument("--all-revisions", action="store_true", default=False,
+                                help="List every revision of an event, not just the latest")
+    archive_parser.add_argument("-n", "--limit", type=int, help="Only the N most recent events")
+    archive_parser.add_argument("--render", action="store_true", default=False,
+                                help="Render the events that were found, and run the post render callbacks")
 
     args = parser.parse_args()
 
+    config = args.config or os.environ.get("STELLARIUM_GCN_CONFIG")
+    if config is None and Path(DEFAULT_CONFIG_PATH).expanduser().exists():
+        config = DEFAULT_CONFIG_PATH
+    if config is not None:
+        Settings.load(config)
+
     if args.output is not None:
         Settings.out_file_name = args.output
+    if args.render_server:
+        Settings.render_server = True
+    if args.workers is not None:
+        Settings.render_workers = args.workers
+    if args.metrics_port is not None:
+        Settings.metrics_port = args.metrics_port
+    if args.trace_file is not None:
+        Settings.trace_file = args.trace_file
+
+    if Settings.metrics_port is not None:
+        metrics.MetricsServer(Settings.metrics_port).start()
+    if Settings.trace_file is not None:
+        metrics.set_trace_writer(metrics.TraceWriter(Settings.trace_file))
+
+    archive = EventArchive(Settings.archive_path) if Settings.archive_path is not None else None
+    output_processor = make_output_processor(archive)
+
+    if args.command == "archive":
+        if archive is None:
+            logger.error("The archive is disabled, set archive_path in the settings")
+            sys.exit(1)
+        results = query_archive(archive, args)
+        for archived in results:
+            print_archived(archive, archived)
+        failed = 0
+        if args.render and results:
+            _, failed = run_until_signalled(render_notices(
+                (QueuedNotice(text="", notice=archived.notice) for archived in results),
+                make_hook_executor(), skip_existing=False, output_processor=output_processor))
+        output_processor.shutdown(wait=True)
+        sys.exit(0 if results and not failed else 1)
+
+    if args.command == "render":
+        # When rendering many notices, e.g. a whole archive, setting the wallpaper for each
+        # of them is rarely what is wanted
+        if not args.hooks:
+            Settings.post_render_callbacks = ()
+        try:
+            failed = run_until_signalled(render_files(args.paths, make_hook_executor(), skip_existing=not args.force,
+                                                      output_processor=output_processor))
+        finally:
+            if output_processor is not None:
+                output_processor.shutdown(wait=True)
+        sys.exit(1 if failed else 0)
 
     types = args.type.split(",")
     types = [t.strip() for t in types]
@@ -111,33 +574,11 @@ def main():
             t = 'gcn.classic.text.ICECUBE_ASTROTRACK_BRONZE'
         topics.append(t)
 
-    queue = Queue()
-    consumer = GCNConsumer(queue, start_on=args.start, topics=topics)
-    consumer.start()
-
-    # If we are initializing tracking, we want to consume every event and commit it,
-    # so we start at the end of the stream in the future
-    if args.init_tracking:
-        if not args.start == "track":
-            logger.warning(f"Can only initialize tracking when --start is 'track'. Is currently '{args.start}'")
-
-        logger.info("Initializing tracking by moving to end of stream")
-        while True:
-            try:
-                _ = queue.get(True, 10.0)
-                queue.task_done()
-            except Empty:
-                logger.info("Done initializing tracking.")
-                exit(0)
-
     try:
-        logger.info("Starting main loop")
-        run(queue, args.once)
-    except KeyboardInterrupt:
-        logger.info("Shutting down...")
+        run_until_signalled(consume(args, topics, make_hook_executor(), output_processor))
     finally:
-        consumer.stop()
-
+        if output_processor is not None:
+            output_processor.shutdown(wait=True)
 
 if __name__ == "__main__":
     main()
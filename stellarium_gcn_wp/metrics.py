@@ -0,0 +1,268 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+LabelValues = Tuple[str, ...]
+
+# Stages of a render range from milliseconds to the render timeout, so the buckets
+# need to cover a lot more than the usual prometheus defaults.
+DEFAULT_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800)
+
+
+def _format_labels(names: Sequence[str], values: LabelValues, extra: str = "") -> str:
+    parts = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(n, "")) for n in self.label_names)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def expose(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.label_names, k)} {v}" for k, v in self._values.items()]
+
+
+class Gauge(Counter):
+    type_name = "gauge"
+
+    def set(self, value: float, **labels: str):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self._buckets = tuple(sorted(buckets))
+        # label values -> (bucket counts, sum, count)
+        self._values: Dict[LabelValues, Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, n = self._values.get(key, ([0] * len(self._buckets), 0.0, 0))
+            i = bisect.bisect_left(self._buckets, value)
+            if i < len(counts):
+                counts[i] += 1
+            self._values[key] = (counts, total + value, n + 1)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total, n) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self._buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.label_names, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {n}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {n}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, help: str, labels: Sequence[str], **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, help, labels, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, help, labels)
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labels, buckets=buckets)
+
+    def expose(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(m.expose() for m in metrics) + "\n"
+
+
+registry = MetricsRegistry()
+
+notices_received = registry.counter("sgw_notices_received_total", "Notices received", ["topic"])
+notices_finished = registry.counter("sgw_notices_finished_total", "Notices that left the pipeline", ["result"])
+stage_seconds = registry.histogram("sgw_stage_seconds", "Time spent in each pipeline stage", ["stage"])
+notice_seconds = registry.histogram("sgw_notice_seconds", "Time from receiving a notice until it is finished")
+
+
+class MetricsServer:
+    """Serves the metrics of `registry` in the prometheus text format on /metrics."""
+
+    def __init__(self, port: int, host: str = "127.0.0.1", metrics: MetricsRegistry = registry):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.expose().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._thread = None
+
+    def start(self):
+        logger.info(f"Serving metrics on http://{self._server.server_address[0]}:"
+                    f"{self._server.server_address[1]}/metrics")
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class TraceWriter:
+    """Appends finished traces to a JSONL file."""
+
+    def __init__(self, path: Union[str, Path]):
+        path = Path(path).expanduser()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = path.open("a")
+        self._lock = threading.Lock()
+
+    def write(self, entry: dict):
+        line = json.dumps(entry)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+_trace_writer: Optional[TraceWriter] = None
+
+
+def set_trace_writer(writer: Optional[TraceWriter]):
+    global _trace_writer
+    _trace_writer = writer
+
+
+class Trace:
+    """
+    Timeline of a single notice through the pipeline. Each mark() ends the stage since
+    the previous mark (or the creation of the trace). finish() records the duration of
+    every stage in the stage_seconds histogram and writes the trace to the trace file.
+    Work that goes on in the background after the notice is done, like the hooks, can
+    hold() the trace, so that happens once the last of it calls release().
+    """
+
+    def __init__(self, **info):
+        self.info = info
+        self._start = time.monotonic()
+        self._wall_start = time.time()
+        self._marks: List[Tuple[str, float]] = []
+        self._holds = 0
+        self._written = False
+        # How the notice left the pipeline, e.g. "done" or "failed", once it is finished
+        self.result: Optional[str] = None
+
+    def mark(self, stage: str):
+        self._marks.append((stage, time.monotonic()))
+
+    def stages(self) -> List[Tuple[str, float]]:
+        """Returns (stage, duration) for every stage so far."""
+        result = []
+        last = self._start
+        for stage, t in list(self._marks):
+            result.append((stage, t - last))
+            last = t
+        return result
+
+    def hold(self):
+        self._holds += 1
+
+    def release(self):
+        self._holds -= 1
+        if self._holds == 0 and self.result is not None:
+            self._write()
+
+    def finish(self, result: str = "done"):
+        if self.result is not None:
+            return
+        self.result = result
+        if self._holds == 0:
+            self._write()
+
+    def _write(self):
+        if self._written:
+            return
+        self._written = True
+        result = self.result
+        total = time.monotonic() - self._start
+        stages = self.stages()
+        for stage, dt in stages:
+            stage_seconds.observe(dt, stage=stage)
+        notice_seconds.observe(total)
+        notices_finished.inc(result=result)
+
+        if _trace_writer is not None:
+            _trace_writer.write({"start": self._wall_start, "result": result, "total": total,
+                                 "stages": [{"stage": s, "seconds": dt} for s, dt in stages],
+                                 **self.info})
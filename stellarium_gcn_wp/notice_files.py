@@ -0,0 +1,68 @@
+import glob
+import json
+import logging
+import re
+import sys
+from pathlib import Path
+from typing import Iterator, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Every classic text notice starts with its TITLE line
+_TEXT_NOTICE_START = re.compile(r"^(?=TITLE:)", re.MULTILINE)
+
+
+def split_notices(text: str) -> List[str]:
+    """
+    Splits `text` into single notices. Several classic text notices can follow each other,
+    e.g. in a saved mail archive. VOEvent and JSON notices are one per text.
+    """
+    if not text.strip():
+        return []
+    if text.lstrip()[:1] in ("<", "{"):
+        return [text]
+    return [notice for notice in _TEXT_NOTICE_START.split(text) if notice.strip()]
+
+
+def _expand(path: str) -> List[Path]:
+    path = str(Path(path).expanduser())
+    if glob.has_magic(path):
+        matches = sorted(glob.glob(path, recursive=True))
+    else:
+        matches = [path] if Path(path).exists() else []
+    if not matches:
+        logger.warning(f"No files match '{path}'")
+    files = []
+    for match in map(Path, matches):
+        files.extend(sorted(p for p in match.iterdir() if p.is_file()) if match.is_dir() else [match])
+    return files
+
+
+def read_notices(paths: Sequence[str]) -> Iterator[Tuple[str, str]]:
+    """
+    Yields (source, text) for every notice in `paths`, in order. Every path can be a
+    file, a directory of files, a glob pattern or "-" for stdin. Files can contain several
+    classic text notices, and .jsonl files one {"notice": ...} object per line, like those
+    read by notice_sources.FileNoticeSource.
+    """
+    for path in paths:
+        if path == "-":
+            for i, notice in enumerate(split_notices(sys.stdin.read())):
+                yield f"<stdin>:{i}", notice
+            continue
+
+        for f in _expand(path):
+            if f.suffix == ".jsonl":
+                with f.open() as lines:
+                    for i, line in enumerate(lines, 1):
+                        if not line.strip():
+                            continue
+                        try:
+                            yield f"{f}:{i}", json.loads(line)["notice"]
+                        except (ValueError, KeyError, TypeError):
+                            # Handed on as it is, so it fails to parse like any other bad notice,
+                            # instead of ending the whole batch
+                            yield f"{f}:{i}", line
+                continue
+            for i, notice in enumerate(split_notices(f.read_text())):
+                yield f"{f}:{i}" if i else str(f), notice
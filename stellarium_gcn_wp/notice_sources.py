@@ -0,0 +1,198 @@
+import asyncio
+import datetime
+import json
+import logging
+import random
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence, Union
+
+from stellarium_gcn_wp.fake_kafka import FakeBroker
+from stellarium_gcn_wp.gcn_parser import GCNParser, GCNParseError, datetime_to_tjd_sod, equatorial_to_galactic
+
+logger = logging.getLogger(__name__)
+
+GOLD_TOPIC = "gcn.classic.text.ICECUBE_ASTROTRACK_GOLD"
+BRONZE_TOPIC = "gcn.classic.text.ICECUBE_ASTROTRACK_BRONZE"
+
+
+@dataclass
+class NoticeRecord:
+    # Unix time at which the notice was (or would have been) published
+    timestamp: float
+    topic: str
+    text: str
+
+
+class NoticeSource(ABC):
+    """A source of notices for replaying, e.g. through a Replayer into a FakeBroker."""
+
+    @abstractmethod
+    def records(self) -> Iterator[NoticeRecord]:
+        """Yields the notices of this source, ordered by timestamp."""
+
+
+def _topic_for(notice_type: str) -> str:
+    return BRONZE_TOPIC if "Bronze" in notice_type else GOLD_TOPIC
+
+
+class FileNoticeSource(NoticeSource):
+    """
+    Notices read from files. Every path can be a single notice, a directory of notices,
+    or a .jsonl file with one {"timestamp", "topic", "notice"} object per line. The
+    timestamp of a plain notice is its NOTICE_DATE, or the event time if that is missing.
+    """
+
+    def __init__(self, paths: Sequence[Union[str, Path]]):
+        self._paths = [Path(p).expanduser() for p in paths]
+
+    @staticmethod
+    def _from_jsonl(path: Path) -> Iterator[NoticeRecord]:
+        with path.open() as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                timestamp = entry.get("timestamp", 0.0)
+                if isinstance(timestamp, str):
+                    timestamp = datetime.datetime.fromisoformat(timestamp).timestamp()
+                text = entry["notice"]
+                topic = entry.get("topic") or _topic_for(text)
+                yield NoticeRecord(timestamp=float(timestamp), topic=topic, text=text)
+
+    @staticmethod
+    def _from_notice(path: Path) -> Optional[NoticeRecord]:
+        text = path.read_text()
+        try:
+            notice = GCNParser.parse(text)
+        except GCNParseError as e:
+            logger.warning(f"Skipping {path}: {e}")
+            return None
+
+        timestamp = (notice.tjd - 587) * 86400 + notice.sod
+        for line in text.splitlines():
+            if line.startswith("NOTICE_DATE:"):
+                try:
+                    date = datetime.datetime.strptime(line.split(":", 1)[1].strip(), "%a %d %b %y %H:%M:%S UT")
+                    timestamp = date.replace(tzinfo=datetime.timezone.utc).timestamp()
+                except ValueError:
+                    pass
+                break
+        return NoticeRecord(timestamp=timestamp, topic=_topic_for(notice.notice_type), text=text)
+
+    def records(self) -> Iterator[NoticeRecord]:
+        records: List[NoticeRecord] = []
+        for path in self._paths:
+            files = sorted(p for p in path.iterdir() if p.is_file()) if path.is_dir() else [path]
+            for f in files:
+                if f.suffix == ".jsonl":
+                    records.extend(self._from_jsonl(f))
+                elif (record := self._from_notice(f)) is not None:
+                    records.append(record)
+        records.sort(key=lambda r: r.timestamp)
+        yield from records
+
+
+class SyntheticNoticeSource(NoticeSource):
+    """
+    Generates classic text notices for `count` events, arriving as a poisson process
+    with `rate` events per hour. Each event is followed by up to `max_revisions` further
+    revisions, `revision_interval` seconds apart on average. The same seed always
+    generates the same notices.
+    """
+
+    def __init__(self, count: int, rate: float = 60.0, max_revisions: int = 2,
+                 revision_interval: float = 120.0, bronze_fraction: float = 0.5,
+                 start: Optional[float] = None, seed: Union[int, str, None] = 0):
+        self._count = count
+        self._rate = rate
+        self._max_revisions = max_revisions
+        self._revision_interval = revision_interval
+        self._bronze_fraction = bronze_fraction
+        self._start = time.time() if start is None else start
+        self._seed = seed
+
+    @staticmethod
+    def format_notice(notice_type: str, run_num: int, evt_num: int, revision: int,
+                      ra: float, dec: float, event_time: float, notice_time: float,
+                      energy: float, signalness: float) -> str:
+        event_dt = datetime.datetime.fromtimestamp(event_time, datetime.timezone.utc)
+        notice_dt = datetime.datetime.fromtimestamp(notice_time, datetime.timezone.utc)
+        tjd, sod = datetime_to_tjd_sod(event_dt)
+        gal_lon, gal_lat = equatorial_to_galactic(ra, dec)
+        return (f"TITLE:            GCN/AMON NOTICE\n"
+                f"NOTICE_DATE:      {notice_dt.strftime('%a %d %b %y %H:%M:%S')} UT\n"
+                f"NOTICE_TYPE:      {notice_type}\n"
+                f"STREAM:           24\n"
+                f"RUN_NUM:          {run_num}\n"
+                f"EVENT_NUM:        {evt_num}\n"
+                f"SRC_RA:           {ra:.4f}d (J2000)\n"
+                f"SRC_DEC:          {dec:+.4f}d (J2000)\n"
+                f"SRC_ERROR:        1.00 [deg radius, stat-only, 90% containment]\n"
+                f"DISCOVERY_DATE:   {tjd} TJD\n"
+                f"DISCOVERY_TIME:   {sod} SOD {{{event_dt.strftime('%H:%M:%S.00')}}} UT\n"
+                f"REVISION:         {revision}\n"
+                f"ENERGY:           {energy:.4e} [TeV]\n"
+                f"SIGNALNESS:       {signalness:.4e} [dn]\n"
+                f"GAL_COORDS:       {gal_lon:.2f},{gal_lat:.2f} [deg] galactic lon,lat of the event\n"
+                f"COMMENTS:         Synthetic notice for testing.\n")
+
+    def records(self) -> Iterator[NoticeRecord]:
+        rng = random.Random(self._seed)
+        records = []
+        t = self._start
+        for i in range(self._count):
+            t += rng.expovariate(self._rate / 3600.0)
+            bronze = rng.random() < self._bronze_fraction
+            notice_type = "ICECUBE Astrotrack Bronze" if bronze else "ICECUBE Astrotrack Gold"
+            run_num = 130000 + i
+            evt_num = rng.randrange(1, 100000000)
+            ra = rng.uniform(0, 360)
+            dec = rng.uniform(-90, 90)
+            energy = rng.lognormvariate(5, 1)
+            signalness = rng.uniform(0.1, 0.3) if bronze else rng.uniform(0.5, 0.9)
+
+            notice_time = t
+            for revision in range(rng.randint(0, self._max_revisions) + 1):
+                # Later revisions refine the position a little
+                rev_ra = (ra + rng.gauss(0, 0.5)) % 360
+                rev_dec = max(-90.0, min(90.0, dec + rng.gauss(0, 0.5)))
+                text = self.format_notice(notice_type, run_num, evt_num, revision, rev_ra, rev_dec,
+                                          t - 30, notice_time, energy, signalness)
+                records.append(NoticeRecord(timestamp=notice_time, topic=_topic_for(notice_type), text=text))
+                notice_time += rng.expovariate(1 / self._revision_interval)
+
+        records.sort(key=lambda r: r.timestamp)
+        yield from records
+
+
+class Replayer:
+    """
+    Publishes the notices of `source` to a FakeBroker, keeping the time between notices
+    scaled down by `speed` (e.g. 100 replays 100x faster than real time). A speed of 0
+    publishes everything at once. Runs as a task, and stops when it is cancelled.
+    """
+
+    def __init__(self, broker: FakeBroker, source: NoticeSource, speed: float = 1.0):
+        self._broker = broker
+        self._source = source
+        self._speed = speed
+        self.published = 0
+
+    async def run(self):
+        logger.info(f"Starting notice replay at {self._speed}x")
+        t_start = time.monotonic()
+        first = None
+        for record in self._source.records():
+            if first is None:
+                first = record.timestamp
+            delay = 0.0
+            if self._speed > 0:
+                delay = (record.timestamp - first) / self._speed - (time.monotonic() - t_start)
+            # Also yields to the other tasks between notices of a replay at full speed
+            await asyncio.sleep(max(0.0, delay))
+            self._broker.produce(record.topic, record.text.encode(), record.timestamp)
+            self.published += 1
+        logger.info(f"Notice replay finished after {self.published} notices")
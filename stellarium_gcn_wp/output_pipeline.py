@@ -0,0 +1,151 @@
+import errno
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+# Pillow is imported by available(), on first use, since importing it is slow
+Image = None
+
+from stellarium_gcn_wp.archive import EventArchive
+from stellarium_gcn_wp.gcn_parser import GCNNotice
+
+logger = logging.getLogger(__name__)
+
+# Pillow format names of the variant formats, by file extension
+FORMATS = {"webp": "WEBP", "jpeg": "JPEG", "jpg": "JPEG", "png": "PNG"}
+
+
+def available() -> bool:
+    """Whether variants and thumbnails can be made, i.e. Pillow is installed."""
+    global Image
+    if Image is None:
+        try:
+            from PIL import Image
+        except ImportError:
+            return False
+    return True
+
+
+@contextmanager
+def atomic_write(dest: Union[str, Path]) -> Iterator[Path]:
+    """
+    Yields a temporary path next to `dest` to write to, and renames it to `dest` if the
+    block succeeds. Readers of `dest`, e.g. a desktop picking up a new wallpaper, see
+    either the old or the new file, never a partial one.
+    """
+    dest = Path(dest)
+    fd, tmp = tempfile.mkstemp(dir=dest.parent, prefix=f".{dest.name}.", suffix=".tmp")
+    os.close(fd)
+    tmp = Path(tmp)
+    try:
+        yield tmp
+        # mkstemp creates files that only we can read
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, dest)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def place(src: Union[str, Path], dest: Union[str, Path]):
+    """
+    Moves `src` to `dest` atomically. This is a rename if both are on the same filesystem,
+    otherwise `src` is copied next to `dest` first.
+    """
+    try:
+        os.replace(src, dest)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    with atomic_write(dest) as tmp:
+        shutil.copyfile(src, tmp)
+    os.unlink(src)
+
+
+def variant_path(path: Path, format: str, width: Optional[int] = None) -> Path:
+    """Path of the `format` variant of the image at `path`, or of its thumbnail `width` pixels wide."""
+    if width is None:
+        return path.with_suffix(f".{format}")
+    return path.with_name(f"{path.stem}_thumb{width}.{format}")
+
+
+class OutputProcessor:
+    """
+    Makes variants of rendered images in the background: a copy in each of `formats`
+    (e.g. "webp", which is much smaller than the PNG stellarium writes) and thumbnails
+    `thumbnail_widths` pixels wide, next to the image. The notice and its outputs are then
+    recorded in `archive`. All files are written atomically.
+
+    Notices that are parsed but not rendered, e.g. because the render failed, are recorded
+    without outputs with record().
+    """
+
+    def __init__(self, formats: Sequence[str] = (), quality: int = 85,
+                 thumbnail_widths: Sequence[int] = (), thumbnail_format: str = "webp",
+                 archive: Optional[EventArchive] = None, workers: int = 1):
+        for format in (*formats, thumbnail_format):
+            if format not in FORMATS:
+                raise ValueError(f"Unknown image format '{format}', must be one of {', '.join(FORMATS)}")
+        self._formats = list(formats)
+        self._quality = quality
+        self._thumbnail_widths = list(thumbnail_widths)
+        self._thumbnail_format = thumbnail_format
+        self._archive = archive
+        if (self._formats or self._thumbnail_widths) and not available():
+            logger.warning("Pillow is not installed, not making image variants or thumbnails")
+            self._formats = []
+            self._thumbnail_widths = []
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="outputs")
+
+    def submit(self, notice: GCNNotice, outputs: Dict[str, Path]) -> Future:
+        return self._pool.submit(self._process, notice, dict(outputs))
+
+    def record(self, notice: GCNNotice) -> Optional[Future]:
+        """Records `notice` in the archive without outputs. submit() adds them once they are rendered."""
+        if self._archive is None:
+            return None
+        return self._pool.submit(self._archive.record, notice)
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait, cancel_futures=not wait)
+        if self._archive is not None and wait:
+            self._archive.close()
+
+    def _save(self, image, dest: Path, format: str):
+        with atomic_write(dest) as tmp:
+            image.save(tmp, format=FORMATS[format], quality=self._quality)
+
+    def _variants(self, path: Path) -> List[Path]:
+        if not self._formats and not self._thumbnail_widths:
+            return []
+        variants = []
+        with Image.open(path) as image:
+            image = image.convert("RGB")
+        for format in self._formats:
+            dest = variant_path(path, format)
+            self._save(image, dest, format)
+            variants.append(dest)
+        for width in self._thumbnail_widths:
+            height = max(1, round(image.height * width / image.width))
+            dest = variant_path(path, self._thumbnail_format, width)
+            self._save(image.resize((width, height), Image.LANCZOS), dest, self._thumbnail_format)
+            variants.append(dest)
+        return variants
+
+    def _process(self, notice: GCNNotice, outputs: Dict[str, Path]):
+        recorded: Dict[str, Tuple[Path, List[Path]]] = {}
+        for name, path in outputs.items():
+            try:
+                variants = self._variants(path)
+            except Exception:
+                logger.exception(f"Failed to make variants of {path}")
+                variants = []
+            recorded[name] = (path, variants)
+        if self._archive is not None:
+            self._archive.record(notice, recorded)
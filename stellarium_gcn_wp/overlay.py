@@ -0,0 +1,312 @@
+import asyncio
+import logging
+import math
+import tempfile
+from dataclasses import replace
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+# Pillow is imported by available(), on first use, since importing it is slow
+Image = ImageDraw = ImageFont = None
+
+from stellarium_gcn_wp.output_pipeline import atomic_write
+from stellarium_gcn_wp.render_cache import RenderCache
+from stellarium_gcn_wp.renderer import RenderParams
+
+logger = logging.getLogger(__name__)
+
+Vector = Tuple[float, float, float]
+
+# Offsets (ra, dec, in degrees) of the label anchors from the event, and the label fields,
+# in the same order as in screenshot.ssc
+LABELS = (("evt_str", 3, -3), ("date_str", 3, 0), ("pos_str", 3, 3), ("en_str", 3, 6))
+MARKER_SIZE = 6.0
+
+# Font that stellarium uses by default
+FONT_NAME = "DejaVuSans.ttf"
+
+
+class UnsupportedProjectionError(ValueError):
+    pass
+
+
+def available() -> bool:
+    """Whether compositing is possible, i.e. Pillow is installed."""
+    global Image, ImageDraw, ImageFont
+    if Image is None:
+        try:
+            from PIL import Image, ImageDraw, ImageFont
+        except ImportError:
+            return False
+    return True
+
+
+def _forward_perspective(x, y, z):
+    return (x / -z, y / -z) if z < 0 else None
+
+
+def _forward_stereographic(x, y, z):
+    h = 0.5 * (1 - z)
+    return (x / h, y / h) if h > 0 else None
+
+
+def _forward_equal_area(x, y, z):
+    d = 1 - z
+    if d <= 0:
+        return None
+    f = math.sqrt(2 / d)
+    return x * f, y * f
+
+
+def _forward_fisheye(x, y, z):
+    a = math.acos(max(-1.0, min(1.0, -z)))
+    r = math.hypot(x, y)
+    f = a / r if r > 0 else 1.0
+    return x * f, y * f
+
+
+def _forward_orthographic(x, y, z):
+    return (x, y) if z < 0 else None
+
+
+def _forward_cylinder(x, y, z):
+    return math.atan2(x, -z), math.asin(max(-1.0, min(1.0, y)))
+
+
+def _forward_mercator(x, y, z):
+    if abs(y) >= 1:
+        return None
+    return math.atan2(x, -z), math.atanh(y)
+
+
+# Projections of stellarium, as (forward projection of a unit vector in view coordinates,
+# scaling of half the fov). View coordinates have x to the right, y up and the view
+# direction along -z, like in stellarium's StelProjector classes.
+PROJECTIONS: Dict[str, Tuple[Callable, Callable[[float], float]]] = {
+    "ProjectionPerspective": (_forward_perspective, math.tan),
+    "ProjectionStereographic": (_forward_stereographic, lambda a: 2 * math.tan(a / 2)),
+    "ProjectionEqualArea": (_forward_equal_area, lambda a: 2 * math.sin(a / 2)),
+    "ProjectionFisheye": (_forward_fisheye, lambda a: a),
+    "ProjectionOrthographic": (_forward_orthographic, math.sin),
+    "ProjectionCylinder": (_forward_cylinder, lambda a: a),
+    "ProjectionMercator": (_forward_mercator, lambda a: a),
+}
+
+
+def _dot(a: Vector, b: Vector) -> float:
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+
+def _cross(a: Vector, b: Vector) -> Vector:
+    return a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0]
+
+
+def _normalize(a: Vector) -> Vector:
+    n = math.sqrt(_dot(a, a))
+    return a[0] / n, a[1] / n, a[2] / n
+
+
+def julian_day(tjd: int, sod: float) -> float:
+    # TJD is JD - 2440000.5
+    return tjd + 2440000.5 + sod / 86400.0
+
+
+def precess(ra: float, dec: float, jd: float) -> Tuple[float, float]:
+    """Precesses J2000 ra/dec (degrees) to the equinox of date (IAU 1976, Meeus 21.4)."""
+    t = (jd - 2451545.0) / 36525.0
+    zeta = math.radians((2306.2181 * t + 0.30188 * t ** 2 + 0.017998 * t ** 3) / 3600)
+    z = math.radians((2306.2181 * t + 1.09468 * t ** 2 + 0.018203 * t ** 3) / 3600)
+    theta = math.radians((2004.3109 * t - 0.42665 * t ** 2 - 0.041833 * t ** 3) / 3600)
+
+    ra0, dec0 = math.radians(ra), math.radians(dec)
+    a = math.cos(dec0) * math.sin(ra0 + zeta)
+    b = math.cos(theta) * math.cos(dec0) * math.cos(ra0 + zeta) - math.sin(theta) * math.sin(dec0)
+    c = math.sin(theta) * math.cos(dec0) * math.cos(ra0 + zeta) + math.cos(theta) * math.sin(dec0)
+    return math.degrees(math.atan2(a, b) + z) % 360.0, math.degrees(math.asin(max(-1.0, min(1.0, c))))
+
+
+def sidereal_time(jd: float) -> float:
+    """Greenwich mean sidereal time in degrees."""
+    t = (jd - 2451545.0) / 36525.0
+    return (280.46061837 + 360.98564736629 * (jd - 2451545.0)
+            + 0.000387933 * t ** 2 - t ** 3 / 38710000.0) % 360.0
+
+
+class SkyProjector:
+    """
+    Maps J2000 ra/dec to pixel coordinates in a stellarium screenshot made with `params`:
+    the view direction is the event position plus the view offset, the mount is alt-azimuthal
+    (zenith up), refraction is off (the script disables the atmosphere) and the viewport
+    diameter is the smaller side of the image. Nutation and aberration are ignored, which
+    is well below a pixel for wallpaper fovs.
+    """
+
+    def __init__(self, params: RenderParams):
+        if params.projection not in PROJECTIONS:
+            raise UnsupportedProjectionError(f"Can't project '{params.projection}'")
+        self._forward, scaling = PROJECTIONS[params.projection]
+        self._width = params.image_width
+        self._height = params.image_height
+        self._pixel_per_rad = 0.5 * min(self._width, self._height) / scaling(math.radians(params.fov / 2))
+
+        self._jd = julian_day(params.tjd, params.sod)
+        self._lst = sidereal_time(self._jd) + params.observer_lon
+        lat = math.radians(params.observer_lat)
+        self._sin_lat, self._cos_lat = math.sin(lat), math.cos(lat)
+
+        forward = self._to_horizontal(params.ra + params.ra_view_offset, params.dec + params.dec_view_offset)
+        zenith = (0.0, 0.0, 1.0)
+        if abs(_dot(forward, zenith)) > 0.99999:
+            # Looking straight up or down, stellarium keeps north up
+            zenith = (0.0, 1.0, 0.0)
+        up = _normalize(tuple(zc - _dot(zenith, forward) * fc for zc, fc in zip(zenith, forward)))
+        self._forward_axis = forward
+        self._up = up
+        self._right = _cross(forward, up)
+
+    def _to_horizontal(self, ra: float, dec: float) -> Vector:
+        # Unit vector in (east, north, up) coordinates
+        ra, dec = precess(ra, dec, self._jd)
+        h = math.radians(self._lst - ra)
+        dec = math.radians(dec)
+        return (-math.cos(dec) * math.sin(h),
+                math.sin(dec) * self._cos_lat - math.cos(dec) * math.cos(h) * self._sin_lat,
+                math.sin(dec) * self._sin_lat + math.cos(dec) * math.cos(h) * self._cos_lat)
+
+    def project(self, ra: float, dec: float) -> Optional[Tuple[float, float]]:
+        """Pixel coordinates (from the top left) of ra/dec, or None if it is behind the projection."""
+        v = self._to_horizontal(ra, dec)
+        xy = self._forward(_dot(v, self._right), _dot(v, self._up), -_dot(v, self._forward_axis))
+        if xy is None:
+            return None
+        return (self._width / 2 + xy[0] * self._pixel_per_rad,
+                self._height / 2 - xy[1] * self._pixel_per_rad)
+
+
+def _font(size: int):
+    try:
+        return ImageFont.truetype(FONT_NAME, size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+def draw_overlay(image, params: RenderParams, projector: Optional[SkyProjector] = None):
+    """Draws the event marker and labels of `params` onto `image`, like screenshot.ssc does."""
+    if not available():
+        raise RuntimeError("Pillow is not installed")
+    if projector is None:
+        projector = SkyProjector(params)
+    draw = ImageDraw.Draw(image)
+
+    if params.show_marker:
+        pos = projector.project(params.ra, params.dec)
+        if pos is not None:
+            x, y = pos
+            draw.line((x - MARKER_SIZE, y, x + MARKER_SIZE, y), fill=params.marker_color, width=2)
+            draw.line((x, y - MARKER_SIZE, x, y + MARKER_SIZE), fill=params.marker_color, width=2)
+
+    if params.show_labels:
+        font = _font(params.label_size)
+        for field, ra_offset, dec_offset in LABELS:
+            anchor_pos = projector.project(params.ra + ra_offset, params.dec + dec_offset)
+            if anchor_pos is None:
+                continue
+            # The labels are on the east side of their anchor, which is on the left of the
+            # screen or on the right, depending on where the view is looking
+            east = projector.project(params.ra + ra_offset + 0.1, params.dec + dec_offset)
+            anchor = "rm" if east is not None and east[0] < anchor_pos[0] else "lm"
+            draw.text(anchor_pos, getattr(params, field), fill=params.marker_color, font=font, anchor=anchor)
+
+
+def composite(base_path: Union[str, Path], params: RenderParams, out_path: Union[str, Path]):
+    """Draws the overlay of `params` onto the base layer at `base_path` and saves it to `out_path`."""
+    if not available():
+        raise RuntimeError("Pillow is not installed")
+    with Image.open(base_path) as base:
+        image = base.convert("RGB")
+    draw_overlay(image, params)
+    with atomic_write(out_path) as tmp_path:
+        image.save(tmp_path, format="PNG")
+
+
+def base_layer_params(params: RenderParams, time_bucket: float, view_grid: float) -> RenderParams:
+    """
+    The parameters of the unlabeled sky behind `params`. The event time is rounded down
+    to `time_bucket` seconds and the event position to a `view_grid` degree grid, so
+    revisions of an event and events close in time and position share a base layer. The
+    view offsets stay the same, so they need to be deterministic (see view_offset_seed)
+    for base layers to be reused.
+    """
+    t = math.floor((params.tjd * 86400 + params.sod) / time_bucket) * time_bucket
+    ra = round(params.ra / view_grid) * view_grid % 360.0
+    dec = max(-90.0, min(90.0, round(params.dec / view_grid) * view_grid))
+    return replace(params, tjd=int(t // 86400), sod=int(t % 86400), ra=ra, dec=dec,
+                   show_marker=False, show_labels=False, label_size=0, marker_color="",
+                   evt_str="", date_str="", pos_str="", en_str="")
+
+
+def overlay_params(params: RenderParams, base: RenderParams) -> RenderParams:
+    """`params` as seen in the view of `base`, i.e. with the view direction and time of the base layer."""
+    return replace(params, tjd=base.tjd, sod=base.sod,
+                   ra_view_offset=base.ra + base.ra_view_offset - params.ra,
+                   dec_view_offset=base.dec + base.dec_view_offset - params.dec)
+
+
+Outputs = Dict[str, Tuple[RenderParams, Path]]
+
+
+class BaseLayerCompositor:
+    """
+    Produces outputs by drawing the marker and labels onto a cached render of the sky
+    without them. Missing base layers are rendered with `render`, all in one go.
+    """
+
+    def __init__(self, cache: RenderCache, time_bucket: float = 600.0, view_grid: float = 1.0):
+        self._cache = cache
+        self._time_bucket = time_bucket
+        self._view_grid = view_grid
+
+    async def render(self, outputs: Outputs, render: Callable[[List[RenderParams], List[Path]], Awaitable[bool]],
+                     tmp_dir: Optional[Path] = None) -> Outputs:
+        """Produces as many of `outputs` as possible, and returns the ones that weren't."""
+        remaining: Outputs = {}
+        bases: Dict[str, RenderParams] = {}
+        for name, (params, out_path) in outputs.items():
+            if params.projection not in PROJECTIONS:
+                logger.info(f"Can't composite output '{name}' with {params.projection}")
+                remaining[name] = (params, out_path)
+                continue
+            base = base_layer_params(params, self._time_bucket, self._view_grid)
+            bases[RenderCache.key(base)] = base
+
+        with tempfile.TemporaryDirectory(dir=tmp_dir) as work_dir:
+            base_paths: Dict[str, Path] = {}
+            to_render = []
+            for key in bases:
+                if (path := self._cache.lookup(key)) is not None:
+                    logger.info(f"Base layer cache hit for {key}")
+                    base_paths[key] = path
+                else:
+                    to_render.append(key)
+
+            if to_render:
+                logger.info(f"Rendering {len(to_render)} base layers")
+                paths = [Path(work_dir) / f"{key}.png" for key in to_render]
+                if await render([bases[key] for key in to_render], paths):
+                    for key, path in zip(to_render, paths):
+                        self._cache.put(key, path)
+                        base_paths[key] = path
+
+            for name, (params, out_path) in outputs.items():
+                if name in remaining:
+                    continue
+                base = base_layer_params(params, self._time_bucket, self._view_grid)
+                base_path = base_paths.get(RenderCache.key(base))
+                try:
+                    if base_path is None:
+                        raise FileNotFoundError
+                    # Drawing and encoding the image takes a while, so it doesn't run on the event loop
+                    await asyncio.to_thread(composite, base_path, overlay_params(params, base), out_path)
+                except FileNotFoundError:
+                    remaining[name] = (params, out_path)
+        return remaining
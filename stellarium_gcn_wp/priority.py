@@ -0,0 +1,94 @@
+import time
+from dataclasses import dataclass
+from typing import Optional, Sequence
+
+from stellarium_gcn_wp import metrics
+from stellarium_gcn_wp.gcn_parser import GCNNotice
+
+queue_depth = metrics.registry.gauge("sgw_queue_depth", "Notices waiting to be rendered", ["priority"])
+queue_wait_seconds = metrics.registry.histogram("sgw_queue_wait_seconds", "Time notices waited to be rendered",
+                                                ["priority"])
+preemptions = metrics.registry.counter("sgw_preemptions_total", "Renders preempted by more important notices",
+                                       ["priority"])
+
+
+@dataclass(frozen=True)
+class PriorityRule:
+    """
+    Gives notices that match all of the set conditions the priority `priority`. Notices with
+    a higher priority are rendered first. `notice_type` matches if it is contained in the
+    notice type, ignoring case, e.g. "gold", and `max_age` is the age of the event in seconds.
+    """
+    name: str
+    priority: int
+    notice_type: Optional[str] = None
+    min_signalness: Optional[float] = None
+    min_energy: Optional[float] = None
+    max_age: Optional[float] = None
+
+    def matches(self, notice: GCNNotice, now: float) -> bool:
+        if self.notice_type is not None and self.notice_type.lower() not in notice.notice_type.lower():
+            return False
+        if self.min_signalness is not None and notice.signalness < self.min_signalness:
+            return False
+        if self.min_energy is not None and notice.energy < self.min_energy:
+            return False
+        if self.max_age is not None:
+            # TJD 0 is 587 days before the unix epoch
+            event_time = (notice.tjd - 587) * 86400 + notice.sod
+            if now - event_time > self.max_age:
+                return False
+        return True
+
+
+DEFAULT_RULE = PriorityRule("default", 0)
+
+
+class PriorityPolicy:
+    """
+    Decides the order in which notices are rendered. Every notice gets the priority of the
+    first rule it matches, or `default`.
+
+    With `aging`, a waiting notice gains one priority level every `aging` seconds, so
+    backfills and low priority notices are still rendered while new alerts keep coming in.
+    A notice that is rendering is preempted, i.e. cancelled and put back in the queue, when
+    a notice that is at least `preempt_margin` levels more important arrives and no worker
+    is free. Each notice is preempted at most `max_preemptions` times.
+    """
+
+    def __init__(self, rules: Sequence[PriorityRule] = (), default: PriorityRule = DEFAULT_RULE,
+                 aging: Optional[float] = None, preempt_margin: Optional[int] = None,
+                 max_preemptions: int = 1):
+        self.rules = list(rules)
+        self.default = default
+        self.aging = aging
+        self.preempt_margin = preempt_margin
+        self.max_preemptions = max_preemptions
+
+    def rule(self, notice: Optional[GCNNotice], now: Optional[float] = None) -> PriorityRule:
+        if notice is None:
+            return self.default
+        now = time.time() if now is None else now
+        for rule in self.rules:
+            if rule.matches(notice, now):
+                return rule
+        return self.default
+
+    def score(self, priority: int, enqueued: float) -> float:
+        """
+        Order of a notice in the queue, higher first. Aging adds the same amount to every
+        waiting notice per second, so the order of two notices never changes while they wait
+        and the score can be computed once, from the time the notice was queued.
+        """
+        if not self.aging:
+            return priority
+        return priority - enqueued / self.aging
+
+    def effective_priority(self, priority: int, enqueued: float, now: Optional[float] = None) -> float:
+        if not self.aging:
+            return priority
+        now = time.monotonic() if now is None else now
+        return priority + (now - enqueued) / self.aging
+
+    def should_preempt(self, running_priority: float, new_priority: float) -> bool:
+        return self.preempt_margin is not None and new_priority - running_priority >= self.preempt_margin
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import os
+import signal
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Default time limits, in seconds, for each phase of a render. Phases that take longer
+# fail the render right away, instead of waiting for the overall render timeout.
+#   xvfb:         until the X server accepts connections
+#   render_loop:  until stellarium has loaded and started running the script
+#   window:       until the stellarium window is visible and has been resized
+#   screen_sized: until the script has seen the new window size
+#   settled:      until the settle delay has passed, see SettleParams
+#   done:         until the screenshot is written
+DEFAULT_PHASE_TIMEOUTS: Dict[str, float] = {
+    "xvfb": 10.0,
+    "render_loop": 5 * 60.0,
+    "window": 30.0,
+    "screen_sized": 60.0,
+    "settled": 5 * 60.0,
+    "done": 20 * 60.0,
+}
+
+
+class ReadinessError(RuntimeError):
+    """A process exited, or a phase didn't finish in time."""
+
+
+def resolve_phase_timeouts(overrides: Optional[Dict[str, float]] = None) -> Dict[str, float]:
+    return {**DEFAULT_PHASE_TIMEOUTS, **(overrides or {})}
+
+
+async def _wait_or_exit(process: asyncio.subprocess.Process, coro, what: str, timeout: Optional[float]):
+    # Waits for `coro`, failing if `process` exits first or the timeout expires
+    task = asyncio.ensure_future(coro)
+    exited = asyncio.ensure_future(process.wait())
+    try:
+        done, _ = await asyncio.wait((task, exited), timeout=timeout,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        if task in done:
+            return task.result()
+        if exited in done:
+            raise ReadinessError(f"Process exited with code {process.returncode} while waiting for {what}")
+        raise ReadinessError(f"Timed out after {timeout} s waiting for {what}")
+    finally:
+        for t in (task, exited):
+            t.cancel()
+
+
+async def start_xvfb(display: str, width: int, height: int, timeout: Optional[float] = None,
+                     wrap: Optional[Callable[[List[str]], List[str]]] = None) -> asyncio.subprocess.Process:
+    """
+    Starts Xvfb on `display` and returns once it accepts connections. Xvfb writes the
+    display number to the -displayfd pipe when it is ready, so there is no need to guess
+    how long the startup takes. `wrap` can change the command, e.g. to put Xvfb under
+    resource limits, as long as Xvfb keeps the pid it is started with.
+    """
+    read_fd, write_fd = os.pipe()
+    argv = ["Xvfb", display, "-screen", "0", f"{width}x{height}x24", "-displayfd", str(write_fd)]
+    if wrap is not None:
+        argv = wrap(argv)
+    try:
+        process = await asyncio.create_subprocess_exec(*argv, stderr=asyncio.subprocess.DEVNULL,
+                                                       pass_fds=(write_fd,))
+    except BaseException:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
+
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                                os.fdopen(read_fd, "rb", 0))
+    try:
+        line = await _wait_or_exit(process, reader.readline(), f"Xvfb on {display}", timeout)
+        if not line.strip():
+            raise ReadinessError(f"Xvfb on {display} closed its display pipe without becoming ready")
+    except BaseException:
+        if process.returncode is None:
+            process.terminate()
+        raise
+    finally:
+        transport.close()
+    return process
+
+
+async def terminate(*processes: Optional[asyncio.subprocess.Process], timeout: float = 5.0):
+    """
+    Terminates `processes` (None entries are skipped) and everything in their process groups,
+    which is all of it for processes started with start_new_session=True (e.g. stellarium
+    behind a shell and the resource limit wrappers). All of them are signalled before waiting
+    for any, so cancelling the wait doesn't leave some running. Groups that don't exit within
+    `timeout` seconds are killed.
+    """
+    def send(process: asyncio.subprocess.Process, sig):
+        try:
+            pgid = os.getpgid(process.pid)
+            if pgid == process.pid:
+                os.killpg(pgid, sig)
+            else:
+                process.send_signal(sig)
+        except ProcessLookupError:
+            pass
+
+    running = [p for p in processes if p is not None and p.returncode is None]
+    for p in running:
+        send(p, signal.SIGTERM)
+    try:
+        async with asyncio.timeout(timeout):
+            await asyncio.gather(*(p.wait() for p in running))
+    except TimeoutError:
+        for p in running:
+            if p.returncode is None:
+                logger.warning(f"Process {p.pid} didn't exit after SIGTERM, killing it")
+                send(p, signal.SIGKILL)
+        await asyncio.gather(*(p.wait() for p in running))
+
+
+class MarkerReader:
+    """
+    Reads the stdout of a stellarium process and collects the [SGW] markers written by
+    the render script. stdout is drained continuously, so stellarium never blocks on a
+    full pipe. End of output, i.e. stellarium exiting, fails every wait for a marker.
+    """
+
+    def __init__(self, process: asyncio.subprocess.Process):
+        self._process = process
+        self._markers: asyncio.Queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._read())
+
+    async def _read(self):
+        while line := await self._process.stdout.readline():
+            line = line.decode(errors="replace").rstrip()
+            logger.debug("[stdout] %s", line)
+            if "[SGW]" in line:
+                self._markers.put_nowait(line)
+        self._markers.put_nowait(None)
+
+    def clear(self):
+        """Forgets markers that were received so far, e.g. from a previous script."""
+        while not self._markers.empty():
+            if self._markers.get_nowait() is None:
+                self._markers.put_nowait(None)
+                break
+
+    async def wait(self, marker: str, timeout: Optional[float] = None):
+        try:
+            async with asyncio.timeout(timeout):
+                while True:
+                    line = await self._markers.get()
+                    if line is None:
+                        # Leave the end marker for later waits
+                        self._markers.put_nowait(None)
+                        await asyncio.wait([asyncio.ensure_future(self._process.wait())], timeout=1.0)
+                        raise ReadinessError(f"Stellarium exited (code={self._process.returncode}) "
+                                             f"while waiting for '{marker}'")
+                    if marker in line:
+                        return
+        except TimeoutError:
+            raise ReadinessError(f"Timed out after {timeout} s waiting for '{marker}'") from None
+
+    def close(self):
+        self._task.cancel()
+
+
+async def xdotool(display: str, *args: str, timeout: Optional[float] = None) -> str:
+    """Runs xdotool on `display`, and returns its output. Fails if xdotool does."""
+    env = {**os.environ, "DISPLAY": display}
+    process = await asyncio.create_subprocess_exec("xdotool", *args, env=env,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE)
+    try:
+        async with asyncio.timeout(timeout):
+            stdout, stderr = await process.communicate()
+    except TimeoutError:
+        process.kill()
+        raise ReadinessError(f"xdotool {' '.join(args)} timed out") from None
+    if process.returncode != 0:
+        raise ReadinessError(f"xdotool {' '.join(args)} failed: {stderr.decode().strip()}")
+    return stdout.decode()
+
+
+async def fit_window(display: str, width: int, height: int, timeout: Optional[float] = None):
+    """Waits for the stellarium window to be visible, then moves it to 0,0 and resizes it."""
+    try:
+        async with asyncio.timeout(timeout):
+            output = await xdotool(display, "search", "--sync", "--onlyvisible", "stellarium")
+            window_id = output.split()[0]
+            await xdotool(display, "windowmove", window_id, "0", "0")
+            await xdotool(display, "windowsize", window_id, str(width), str(height))
+    except TimeoutError:
+        raise ReadinessError(f"Timed out after {timeout} s waiting for the stellarium window") from None
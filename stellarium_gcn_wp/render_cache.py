@@ -0,0 +1,109 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from dataclasses import asdict
+from pathlib import Path
+from typing import Optional, Union
+
+from stellarium_gcn_wp.output_pipeline import atomic_write
+from stellarium_gcn_wp.renderer import RenderParams, Renderer
+
+logger = logging.getLogger(__name__)
+
+
+class RenderCache:
+    """
+    Disk cache of rendered images, keyed by a hash of the render parameters and the
+    render script template. Entries are evicted when they are older than `max_age`
+    seconds, or least-recently-used first when the cache grows beyond `max_bytes`.
+    """
+
+    def __init__(self, cache_dir: Union[str, Path], max_bytes: Optional[int] = None,
+                 max_age: Optional[float] = None):
+        self._dir = Path(cache_dir).expanduser().resolve()
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(render_params: RenderParams, template: Optional[str] = None) -> str:
+        if template is None:
+            template = Renderer.TEMPLATE_PATH.read_text()
+        h = hashlib.sha256()
+        h.update(json.dumps(asdict(render_params), sort_keys=True).encode())
+        h.update(b"\0")
+        h.update(template.encode())
+        return h.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self._dir / f"{key}.png"
+
+    def _expired(self, path: Path, now: float) -> bool:
+        return self._max_age is not None and now - path.stat().st_mtime > self._max_age
+
+    def lookup(self, key: str) -> Optional[Path]:
+        """Returns the path of the cached image for `key`, or None on a cache miss."""
+        path = self._path(key)
+        try:
+            if self._expired(path, time.time()):
+                path.unlink(missing_ok=True)
+                return None
+            # The modification time doubles as the last-used time for LRU eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def get(self, key: str, out_path: Union[str, Path]) -> bool:
+        """Copies the cached image for `key` to `out_path`. Returns False on a cache miss."""
+        path = self.lookup(key)
+        if path is None:
+            return False
+        try:
+            with atomic_write(out_path) as tmp_path:
+                shutil.copyfile(path, tmp_path)
+        except FileNotFoundError:
+            return False
+
+        logger.info(f"Render cache hit for {key}")
+        return True
+
+    def put(self, key: str, image_path: Union[str, Path]):
+        # Copy to a temporary file first, so concurrent readers never see a partial image
+        fd, tmp_path = tempfile.mkstemp(dir=self._dir, suffix=".tmp")
+        os.close(fd)
+        shutil.copyfile(image_path, tmp_path)
+        os.replace(tmp_path, self._path(key))
+        logger.info(f"Added {key} to render cache")
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            now = time.time()
+            entries = []
+            for path in self._dir.glob("*.png"):
+                try:
+                    if self._expired(path, now):
+                        path.unlink()
+                        continue
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            if self._max_bytes is None:
+                return
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self._max_bytes:
+                    break
+                logger.info(f"Evicting {path.name} from render cache")
+                path.unlink(missing_ok=True)
+                total -= size
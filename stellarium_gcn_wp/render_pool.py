@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import shutil
+import tempfile
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Union
+
+from stellarium_gcn_wp.render_queue import QueuedNotice, RenderQueue
+from stellarium_gcn_wp.render_server import RenderServer
+from stellarium_gcn_wp.renderer import RenderParams, Renderer, SettleParams
+from stellarium_gcn_wp.resources import ResourceLimits
+
+logger = logging.getLogger(__name__)
+
+
+class DisplayAllocator:
+    """
+    Hands out X display numbers that are not in use by any running X server. A display
+    counts as in use if it has a lock file or socket in /tmp, or if it was already
+    handed out by this allocator.
+    """
+
+    def __init__(self, base: int = 99):
+        self._base = base
+        self._allocated = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _in_use(num: int) -> bool:
+        return Path(f"/tmp/.X{num}-lock").exists() or Path(f"/tmp/.X11-unix/X{num}").exists()
+
+    def allocate(self) -> str:
+        with self._lock:
+            num = self._base
+            while num in self._allocated or self._in_use(num):
+                num += 1
+            self._allocated.add(num)
+            return f":{num}"
+
+    def release(self, display: str):
+        with self._lock:
+            self._allocated.discard(int(display.lstrip(":")))
+
+
+@dataclass
+class RenderWorker:
+    index: int
+    display: str
+    tmp_dir: Path
+    limits: Optional[ResourceLimits] = None
+    server: Optional[RenderServer] = None
+    phase_timeouts: Optional[Dict[str, float]] = None
+    settle: Optional[SettleParams] = None
+
+    async def render(self, render_params: Union[RenderParams, Sequence[RenderParams]],
+                     out_path: Union[str, Path, Sequence[Union[str, Path]]],
+                     timeout: Optional[float] = None, cancel: Optional[asyncio.Event] = None,
+                     on_phase: Optional[Callable[[str], None]] = None) -> bool:
+        if self.server is not None:
+            return await self.server.render(render_params, out_path, timeout, cancel, on_phase)
+        renderer = Renderer(render_params=render_params, limits=self.limits,
+                            display=self.display, tmp_root=self.tmp_dir,
+                            phase_timeouts=self.phase_timeouts, settle=self.settle)
+        return await renderer.render(out_path, timeout, cancel, on_phase)
+
+
+class RenderPool:
+    """
+    Runs `workers` tasks that take notices from `queue` and hand them to `handler`
+    together with the worker that should render them. Each worker has its own X display
+    and temporary directory, and gets an equal share of the cpu quota in `limits`.
+    """
+
+    def __init__(self, queue: RenderQueue, handler: Callable[[QueuedNotice, RenderWorker], Awaitable[None]],
+                 workers: int = 1, limits: Optional[ResourceLimits] = None, display_base: int = 99,
+                 use_server: bool = False, server_port_base: int = 8090,
+                 screen_width: int = 1920, screen_height: int = 1200,
+                 phase_timeouts: Optional[Dict[str, float]] = None,
+                 settle: Optional[SettleParams] = None):
+        self._queue = queue
+        self._handler = handler
+        self._allocator = DisplayAllocator(display_base)
+        self._keep_running = False
+        self._once = False
+        self._tasks: List[asyncio.Task] = []
+        # The notice each worker is handling, by worker index
+        self._busy: Dict[int, QueuedNotice] = {}
+
+        if limits is not None:
+            limits = limits.share(workers)
+
+        self._workers: List[RenderWorker] = []
+        for i in range(workers):
+            display = self._allocator.allocate()
+            tmp_dir = Path(tempfile.mkdtemp(prefix=f"stellarium-gcn-wp-{i}-"))
+            server = None
+            if use_server:
+                server = RenderServer(display=display, port=server_port_base + i,
+                                      screen_width=screen_width, screen_height=screen_height,
+                                      limits=limits, tmp_root=tmp_dir,
+                                      phase_timeouts=phase_timeouts, settle=settle)
+            self._workers.append(RenderWorker(index=i, display=display, tmp_dir=tmp_dir,
+                                              limits=limits, server=server,
+                                              phase_timeouts=phase_timeouts, settle=settle))
+            logger.info(f"Render worker {i}: display={display}, tmp_dir={tmp_dir}, limits={limits}")
+
+    @property
+    def workers(self) -> List[RenderWorker]:
+        return self._workers
+
+    async def run(self, once: bool = False):
+        """Runs the workers until stop() is called, or after the first render if `once` is set."""
+        self._keep_running = True
+        self._once = once
+        self._tasks = [asyncio.create_task(self._run_worker(w), name=f"render-worker-{w.index}")
+                       for w in self._workers]
+        try:
+            await asyncio.wait(self._tasks, return_when=asyncio.FIRST_COMPLETED if once else asyncio.ALL_COMPLETED)
+        finally:
+            for t in self._tasks:
+                t.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            for w in self._workers:
+                if w.server is not None:
+                    await w.server.stop()
+                self._allocator.release(w.display)
+                shutil.rmtree(w.tmp_dir, ignore_errors=True)
+            self._workers = []
+
+    async def stop(self, timeout: Optional[float] = None):
+        """
+        Stops taking notices from the queue. Renders in progress get `timeout` seconds to
+        finish (without a limit if None) before they are cancelled. Cancelled notices are not
+        marked as done, so e.g. their kafka offsets are not committed.
+        """
+        self._keep_running = False
+        busy = []
+        for w, task in zip(self._workers, self._tasks):
+            if w.index in self._busy:
+                busy.append(task)
+            else:
+                task.cancel()
+        if busy:
+            logger.info(f"Waiting for {len(busy)} renders to finish")
+            _, pending = await asyncio.wait(busy, timeout=timeout)
+            for task in pending:
+                logger.warning(f"Cancelling {task.get_name()}, which didn't finish in time")
+                task.cancel()
+
+    async def _run_worker(self, worker: RenderWorker):
+        while self._keep_running:
+            item = await self._queue.get()
+            self._busy[worker.index] = item
+            try:
+                await self._handler(item, worker)
+            except asyncio.CancelledError:
+                item.trace.finish("cancelled")
+                raise
+            except Exception:
+                logger.exception(f"Render worker {worker.index} failed to handle notice")
+                item.trace.finish("failed")
+            finally:
+                del self._busy[worker.index]
+            # A preempted notice goes back into the queue, so it isn't the one render of `once`
+            preempted = item.preempted
+            self._queue.done(item)
+
+            if self._once and not preempted:
+                self._keep_running = False
@@ -0,0 +1,293 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, List, Optional, Tuple, Union
+
+from stellarium_gcn_wp.gcn_parser import GCNParser, GCNNotice, GCNParseError
+from stellarium_gcn_wp.metrics import Trace
+from stellarium_gcn_wp.priority import DEFAULT_RULE, PriorityPolicy, PriorityRule, preemptions, queue_depth, \
+    queue_wait_seconds
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class QueuedNotice:
+    text: str
+    notice: Optional[GCNNotice] = None
+
+    # Kafka message this notice was received in, if any
+    topic: Optional[str] = None
+    partition: Optional[int] = None
+    offset: Optional[int] = None
+
+    # Set when a newer revision of the same event arrives while this one is rendering
+    cancel: asyncio.Event = field(default_factory=asyncio.Event)
+
+    trace: Trace = field(default_factory=Trace)
+
+    # Scheduling state, set by the queue
+    rule: PriorityRule = DEFAULT_RULE
+    enqueued: Optional[float] = None
+    preemptions: int = 0
+    # Set when the render was cancelled to make room for a more important notice, in
+    # which case done() puts the notice back in the queue
+    preempted: bool = False
+    _seq: int = field(default=0, repr=False)
+
+    @property
+    def key(self):
+        if self.notice is None:
+            # Can't coalesce notices we don't understand, so give each its own key
+            return id(self)
+        return self.notice.run_num, self.notice.evt_num
+
+    @property
+    def revision(self) -> int:
+        return -1 if self.notice is None else self.notice.revision
+
+
+class RenderQueue:
+    """
+    Queue of GCN notice texts which only keeps the newest revision of each event
+    (run_num, evt_num). Items are returned as QueuedNotice. Like asyncio.Queue, it must
+    only be used from the event loop it runs on, and put() waits while the queue holds
+    `maxsize` notices.
+
+    A notice that is superseded by a newer revision while it is pending is dropped,
+    and one that is superseded while it is being rendered gets its cancel event set.
+    Dropped notices count as finished tasks, so join() and unfinished_tasks behave as
+    if they had been rendered.
+
+    Notices are returned in the order given by `policy` (see PriorityPolicy), or in the order
+    they were queued without one. Preemption needs to know the number of `workers` taking
+    items from the queue.
+
+    Consumers must call done() once they are finished with an item. `on_done` is called
+    for every item that is either done or dropped, but not for preempted items, which go
+    back into the queue.
+    """
+
+    def __init__(self, maxsize: int = 0, on_done: Optional[Callable[[QueuedNotice], None]] = None,
+                 policy: Optional[PriorityPolicy] = None, workers: Optional[int] = None):
+        self.maxsize = maxsize
+        self._on_done = on_done
+        self._policy = policy or PriorityPolicy()
+        self._workers = workers
+
+        self._pending: Dict[object, QueuedNotice] = {}
+        # (-score, sequence number, key). Entries of replaced items are skipped in _get()
+        self._heap: List[Tuple[float, int, object]] = []
+        self._seq = itertools.count()
+        self._depth: Dict[str, int] = defaultdict(int)
+        self._in_flight: Dict[object, QueuedNotice] = {}
+
+        self._getters: Deque[asyncio.Future] = deque()
+        self._putters: Deque[asyncio.Future] = deque()
+        self.unfinished_tasks = 0
+        self._finished = asyncio.Event()
+        self._finished.set()
+
+    def qsize(self) -> int:
+        return len(self._pending)
+
+    def empty(self) -> bool:
+        return not self._pending
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= self.qsize()
+
+    @staticmethod
+    def _wakeup_next(waiters: Deque[asyncio.Future]):
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    async def _wait(self, waiters: Deque[asyncio.Future]):
+        waiter = asyncio.get_running_loop().create_future()
+        waiters.append(waiter)
+        try:
+            await waiter
+        except BaseException:
+            waiter.cancel()
+            if waiter in waiters:
+                waiters.remove(waiter)
+            # Pass on a wakeup this waiter got but can't use anymore
+            self._changed()
+            raise
+
+    def _changed(self):
+        # Wakes up whoever can make progress now
+        if not self.empty():
+            self._wakeup_next(self._getters)
+        if not self.full():
+            self._wakeup_next(self._putters)
+        if self.unfinished_tasks == 0:
+            self._finished.set()
+
+    def put_nowait(self, item: Union[str, QueuedNotice]):
+        if self.full():
+            raise asyncio.QueueFull
+        self.unfinished_tasks += 1
+        self._finished.clear()
+        self._put(item)
+        self._changed()
+
+    async def put(self, item: Union[str, QueuedNotice]):
+        while self.full():
+            await self._wait(self._putters)
+        self.put_nowait(item)
+
+    def get_nowait(self) -> QueuedNotice:
+        if self.empty():
+            raise asyncio.QueueEmpty
+        item = self._get()
+        self._changed()
+        return item
+
+    async def get(self) -> QueuedNotice:
+        while self.empty():
+            await self._wait(self._getters)
+        return self.get_nowait()
+
+    async def join(self):
+        """Waits until every notice that was put is done or dropped."""
+        await self._finished.wait()
+
+    def _add_pending(self, queued: QueuedNotice):
+        if (old := self._pending.get(queued.key)) is not None:
+            self._update_depth(old.rule, -1)
+        self._pending[queued.key] = queued
+        self._update_depth(queued.rule, 1)
+        queued._seq = next(self._seq)
+        heapq.heappush(self._heap, (-self._policy.score(queued.rule.priority, queued.enqueued),
+                                    queued._seq, queued.key))
+
+    def _update_depth(self, rule: PriorityRule, change: int):
+        self._depth[rule.name] += change
+        queue_depth.set(self._depth[rule.name], priority=rule.name)
+
+    def _head(self) -> Optional[QueuedNotice]:
+        while self._heap:
+            _, seq, key = self._heap[0]
+            queued = self._pending.get(key)
+            if queued is not None and queued._seq == seq:
+                return queued
+            heapq.heappop(self._heap)
+        return None
+
+    def _put(self, item: Union[str, QueuedNotice]):
+        queued = item if isinstance(item, QueuedNotice) else QueuedNotice(text=item)
+        if queued.notice is None:
+            try:
+                queued.notice = GCNParser.parse(queued.text)
+            except GCNParseError:
+                logger.warning("Failed to parse notice, queueing it without coalescing")
+            queued.trace.mark("parse")
+        if queued.notice is not None:
+            queued.trace.info.update(run_num=queued.notice.run_num, evt_num=queued.notice.evt_num,
+                                     revision=queued.notice.revision)
+        queued.rule = self._policy.rule(queued.notice)
+        if queued.enqueued is None:
+            queued.enqueued = time.monotonic()
+
+        key = queued.key
+        if (running := self._in_flight.get(key)) is not None:
+            if queued.revision <= running.revision:
+                logger.info(f"Dropping revision {queued.revision} of {key}, "
+                            f"revision {running.revision} is already rendering")
+                self._discard(queued, "duplicate")
+                return
+            logger.info(f"Cancelling render of revision {running.revision} of {key}, "
+                        f"superseded by revision {queued.revision}")
+            running.cancel.set()
+
+        if (pending := self._pending.get(key)) is not None:
+            if queued.revision < pending.revision:
+                logger.info(f"Dropping revision {queued.revision} of {key}, "
+                            f"revision {pending.revision} is already queued")
+                self._discard(queued, "superseded")
+            else:
+                logger.info(f"Replacing queued revision {pending.revision} of {key} "
+                            f"with revision {queued.revision}")
+                # Keep the queue position of the earlier revision, unless the priority changed
+                queued.enqueued = pending.enqueued
+                self._add_pending(queued)
+                self._discard(pending, "superseded")
+                self._maybe_preempt()
+            return
+
+        self._add_pending(queued)
+        self._maybe_preempt()
+
+    def _get(self) -> QueuedNotice:
+        queued = self._head()
+        heapq.heappop(self._heap)
+        del self._pending[queued.key]
+        self._update_depth(queued.rule, -1)
+        self._in_flight[queued.key] = queued
+        queued.trace.mark("queue_wait")
+        queue_wait_seconds.observe(time.monotonic() - queued.enqueued, priority=queued.rule.name)
+        return queued
+
+    def _maybe_preempt(self):
+        # Cancels the least important render if all workers are
+        # busy and the next notice in the queue is important enough
+        if self._workers is None or self._policy.preempt_margin is None:
+            return
+        running = [item for item in self._in_flight.values() if not item.cancel.is_set()]
+        if len(running) < self._workers or (head := self._head()) is None:
+            return
+
+        now = time.monotonic()
+        candidates = [item for item in running if item.preemptions < self._policy.max_preemptions]
+        if not candidates:
+            return
+        victim = min(candidates, key=lambda item: self._policy.effective_priority(
+            item.rule.priority, item.enqueued, now))
+        victim_priority = self._policy.effective_priority(victim.rule.priority, victim.enqueued, now)
+        head_priority = self._policy.effective_priority(head.rule.priority, head.enqueued, now)
+        if not self._policy.should_preempt(victim_priority, head_priority):
+            return
+
+        logger.info(f"Preempting render of {victim.key} ({victim.rule.name}) for {head.key} ({head.rule.name})")
+        preemptions.inc(priority=victim.rule.name)
+        victim.preempted = True
+        victim.preemptions += 1
+        victim.cancel.set()
+
+    def _discard(self, item: QueuedNotice, reason: str):
+        # Called from _put(), after put_nowait() counted the new item. Leaves the count
+        # unchanged for items that don't end up in the queue.
+        self.unfinished_tasks -= 1
+        item.trace.finish(reason)
+        if self._on_done is not None:
+            self._on_done(item)
+
+    def done(self, item: QueuedNotice):
+        if self._in_flight.get(item.key) is item:
+            del self._in_flight[item.key]
+        if item.preempted:
+            item.preempted = False
+            if item.key not in self._pending:
+                # Put it back with its original queue time, so it keeps its age
+                item.cancel = asyncio.Event()
+                item.trace.mark("preempted")
+                self._add_pending(item)
+                self._changed()
+                return
+            # A newer revision arrived in the meantime, which replaces this one
+            item.trace.finish("superseded")
+        item.trace.finish()
+        if self._on_done is not None:
+            self._on_done(item)
+        if self.unfinished_tasks <= 0:
+            raise ValueError("done() called more times than there were items")
+        self.unfinished_tasks -= 1
+        self._changed()
@@ -0,0 +1,279 @@
+import asyncio
+import json
+import logging
+import tempfile
+import time
+from http.client import HTTPConnection
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Union
+from urllib.parse import urlencode
+
+from stellarium_gcn_wp.readiness import MarkerReader, ReadinessError, resolve_phase_timeouts, start_xvfb, terminate
+from stellarium_gcn_wp.renderer import RenderParams, Renderer, SettleParams, capture_outputs
+from stellarium_gcn_wp.resources import ResourceGroup, ResourceLimits
+
+logger = logging.getLogger(__name__)
+
+# Minimal stellarium config that loads and starts the RemoteControl plugin, which we use
+# to inject render scripts into the running instance.
+_CONFIG_TEMPLATE = """[plugins_load_at_startup]
+RemoteControl = true
+
+[RemoteControl]
+autoStart = true
+enableAuthentication = false
+port = {port}
+"""
+
+
+class RenderServer:
+    """
+    Keeps one Xvfb + Stellarium pair running between renders. Render jobs are sent to
+    the running instance through stellarium's RemoteControl plugin, so we only pay for
+    startup and catalog loading once instead of once per notice.
+
+    The processes are started on the first render, and are
+    restarted automatically when a health check or a render fails. They run under
+    `limits`, and the cpu time each render takes is reported when it ends.
+    """
+
+    def __init__(self, display: str = ":98", port: int = 8090,
+                 screen_width: int = 1920, screen_height: int = 1200,
+                 limits: Optional[ResourceLimits] = None, startup_timeout: float = 10 * 60,
+                 health_interval: float = 30.0, tmp_root: Optional[Path] = None,
+                 phase_timeouts: Optional[Dict[str, float]] = None,
+                 settle: Optional[SettleParams] = None):
+        self._display = display
+        self._port = port
+        self._screen_width = screen_width
+        self._screen_height = screen_height
+        self._limits = limits
+        self._startup_timeout = startup_timeout
+        self._health_interval = health_interval
+        self._tmp_root = tmp_root
+        self._phase_timeouts = resolve_phase_timeouts(phase_timeouts)
+        self._settle = settle
+        self._template = Renderer.TEMPLATE_PATH.read_text()
+
+        self._tmp_dir: Optional[tempfile.TemporaryDirectory] = None
+
+        self._p_xvfb = None
+        self._p_stellarium = None
+        self._markers: Optional[MarkerReader] = None
+        self._resources: Optional[ResourceGroup] = None
+        self._health_task = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    @property
+    def _work_dir(self) -> Path:
+        return Path(self._tmp_dir.name)
+
+    async def start(self):
+        logger.info(f"Starting render server on display {self._display}")
+        self._tmp_dir = tempfile.TemporaryDirectory(dir=self._tmp_root)
+        self._lock = asyncio.Lock()
+        try:
+            async with self._lock:
+                await self._launch()
+        except BaseException:
+            # Start from scratch on the next render
+            self._tmp_dir.cleanup()
+            self._tmp_dir = None
+            raise
+        self._health_task = asyncio.create_task(self._health_loop())
+
+    async def stop(self):
+        if self._tmp_dir is None:
+            return
+        logger.info("Stopping render server")
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        async with self._lock:
+            await self._terminate()
+        self._tmp_dir.cleanup()
+        self._tmp_dir = None
+
+    async def render(self, render_params: Union[RenderParams, Sequence[RenderParams]],
+                     out_path: Union[str, Path, Sequence[Union[str, Path]]],
+                     timeout: Optional[float] = None, cancel: Optional[asyncio.Event] = None,
+                     on_phase: Optional[Callable[[str], None]] = None) -> bool:
+        if self._tmp_dir is None:
+            await self.start()
+
+        logger.info(f"Starting server render, timeout={timeout}")
+        t_start = time.time()
+        if on_phase is None:
+            on_phase = lambda phase: None
+        outputs = Renderer.as_outputs(render_params)
+        out_paths = [Path(out_path)] if isinstance(out_path, (str, Path)) else [Path(p) for p in out_path]
+        if len(out_paths) != len(outputs):
+            raise ValueError(f"Got {len(out_paths)} output paths for {len(outputs)} outputs")
+        width, height = Renderer.screen_size(outputs)
+        if width > self._screen_width or height > self._screen_height:
+            raise ValueError(f"Outputs need a {width}x{height} screen, but the render server "
+                             f"has {self._screen_width}x{self._screen_height}")
+        result = await self._render_job(outputs, out_paths, timeout, cancel, on_phase)
+        logger.info(f"Server render finished. result={result}, dt={time.time() - t_start:.2f} s")
+        return result
+
+    def _stellarium_cmd(self, config_path: Path):
+        return (f"WAYLAND_DISPLAY= DISPLAY={self._display} stellarium --full-screen no "
+                f"--config-file {config_path.absolute()} "
+                f"--screenshot-dir {self._work_dir.absolute()}")
+
+    async def _launch(self):
+        try:
+            await self._launch_processes()
+        except BaseException:
+            # Don't leave Xvfb, stellarium or the cgroup behind when startup fails
+            await self._terminate()
+            raise
+
+    async def _launch_processes(self):
+        config_path = self._work_dir / "config.ini"
+        config_path.write_text(_CONFIG_TEMPLATE.format(port=self._port))
+
+        self._resources = ResourceGroup(self._limits, name=f"server{self._display.lstrip(':')}")
+        await self._resources.setup()
+        logger.info(f"Running Xvfb server on {self._display}")
+        self._p_xvfb = await start_xvfb(self._display, self._screen_width, self._screen_height,
+                                        self._phase_timeouts["xvfb"], self._resources.wrap_exec)
+        self._resources.track(self._p_xvfb.pid)
+
+        cmd = self._resources.wrap_shell(self._stellarium_cmd(config_path))
+        logger.info(f"Running stellarium: {cmd}")
+        self._p_stellarium = await asyncio.create_subprocess_shell(cmd,
+                                                                   stdout=asyncio.subprocess.PIPE,
+                                                                   stderr=asyncio.subprocess.STDOUT,
+                                                                   start_new_session=True)
+        self._resources.track(self._p_stellarium.pid, group=True)
+        self._markers = MarkerReader(self._p_stellarium)
+
+        logger.info("Waiting for stellarium remote control to come up")
+        async with asyncio.timeout(self._startup_timeout):
+            while not await self._is_healthy():
+                if self._p_stellarium.returncode is not None:
+                    raise RuntimeError(f"Stellarium exited during startup, code={self._p_stellarium.returncode}")
+                await asyncio.sleep(1.0)
+        logger.info("Render server is up")
+
+    async def _terminate(self):
+        await terminate(self._p_stellarium, self._p_xvfb)
+        if self._markers is not None:
+            self._markers.close()
+            self._markers = None
+        if self._resources is not None:
+            await self._resources.close()
+            self._resources = None
+        self._p_stellarium = None
+        self._p_xvfb = None
+
+    async def _restart(self):
+        logger.warning("Restarting render server")
+        await self._terminate()
+        await self._launch()
+
+    def _request(self, method: str, path: str, body: Optional[dict] = None):
+        conn = HTTPConnection("localhost", self._port, timeout=5)
+        try:
+            headers = {}
+            data = None
+            if body is not None:
+                data = urlencode(body)
+                headers["Content-Type"] = "application/x-www-form-urlencoded"
+            conn.request(method, path, body=data, headers=headers)
+            resp = conn.getresponse()
+            return resp.status, resp.read().decode()
+        finally:
+            conn.close()
+
+    async def _is_healthy(self) -> bool:
+        for p in (self._p_xvfb, self._p_stellarium):
+            if p is None or p.returncode is not None:
+                return False
+        try:
+            status, body = await asyncio.to_thread(self._request, "GET", "/api/main/status")
+            json.loads(body)
+            return status == 200
+        except (OSError, ValueError):
+            return False
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self._health_interval)
+            async with self._lock:
+                if not await self._is_healthy():
+                    logger.warning("Render server health check failed")
+                    try:
+                        await self._restart()
+                    except Exception:
+                        logger.exception("Failed to restart render server")
+
+    async def _render_job(self, outputs: List[RenderParams], out_paths: List[Path],
+                          timeout: Optional[float], cancel: Optional[asyncio.Event],
+                          on_phase: Callable[[str], None]) -> bool:
+        async with self._lock:
+            if not await self._is_healthy():
+                try:
+                    await self._restart()
+                except Exception:
+                    logger.exception("Failed to restart render server")
+                    return False
+
+            on_phase("server_ready")
+            resources = self._resources
+            usage_before = resources.usage()
+            task = asyncio.create_task(self._run_script(outputs, out_paths, on_phase))
+            watcher = None
+            if cancel is not None:
+                watcher = asyncio.create_task(Renderer._cancel_on(cancel, task))
+            try:
+                async with asyncio.timeout(timeout):
+                    await task
+                return True
+            except TimeoutError:
+                logger.warning("Server render timed out, restarting stellarium")
+            except ReadinessError as e:
+                logger.warning(f"Server render failed: {e}, restarting stellarium")
+            except asyncio.CancelledError:
+                if cancel is None or not cancel.is_set() or asyncio.current_task().cancelling():
+                    raise
+                logger.warning("Server render cancelled, stopping script")
+                if await self._stop_script():
+                    return False
+            except Exception:
+                logger.exception("Server render failed, restarting stellarium")
+            finally:
+                if watcher is not None:
+                    watcher.cancel()
+                resources.report(since=usage_before)
+
+            try:
+                await self._restart()
+            except Exception:
+                logger.exception("Failed to restart render server")
+            return False
+
+    async def _stop_script(self) -> bool:
+        try:
+            status, _ = await asyncio.to_thread(self._request, "POST", "/api/scripts/stop", {})
+            return status == 200
+        except OSError:
+            return False
+
+    async def _run_script(self, outputs: List[RenderParams], out_paths: List[Path],
+                          on_phase: Callable[[str], None]):
+        for screenshot in self._work_dir.glob("screenshot_*.png"):
+            screenshot.unlink()
+        self._markers.clear()
+
+        script = Renderer.make_script(outputs, quit_on_done=False, template=self._template,
+                                      settle=self._settle)
+        status, body = await asyncio.to_thread(self._request, "POST", "/api/scripts/direct",
+                                               {"code": script})
+        if status != 200:
+            raise RuntimeError(f"Failed to submit render script: {status} {body}")
+
+        await capture_outputs(self._markers, self._display, outputs, out_paths, self._work_dir,
+                              self._phase_timeouts, on_phase)
@@ -1,13 +1,16 @@
 import asyncio
+import json
 import logging
-import shutil
 import tempfile
 import time
-import multiprocessing
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, replace
 from pathlib import Path
 from string import Template
-from typing import Union, Optional
+from typing import Callable, Dict, List, Sequence, Tuple, Union, Optional
+
+from stellarium_gcn_wp.output_pipeline import place
+from stellarium_gcn_wp.readiness import MarkerReader, ReadinessError, fit_window, resolve_phase_timeouts, start_xvfb, terminate
+from stellarium_gcn_wp.resources import ResourceGroup, ResourceLimits
 
 logger = logging.getLogger(__name__)
 
@@ -42,112 +45,220 @@ class RenderParams:
     pos_str: str
     en_str: str
 
+    # label styling
+    label_size: int = 14
+    show_labels: bool = True
+    show_marker: bool = True
 
-class Renderer:
-    TEMPLATE_PATH = Path(__file__).parent / "screenshot.ssc"
 
-    def __init__(self, render_params: RenderParams, cpu_limit: float = -1):
-        self._render_script = self.TEMPLATE_PATH.read_text()
-        self._render_params = render_params
-        self._cpu_limit = cpu_limit
+# Parameters that can differ between the outputs of a single render
+_OUTPUT_FIELDS = ("image_width", "image_height", "fov", "projection", "ra_view_offset",
+                  "dec_view_offset", "label_size", "show_labels")
+
+
+@dataclass
+class OutputSpec:
+    """
+    One image to produce for every event, e.g. for a specific monitor. Fields that are
+    None are taken from the render parameters made from the settings.
+    """
+    name: str
+    image_width: Optional[int] = None
+    image_height: Optional[int] = None
+    fov: Optional[float] = None
+    projection: Optional[str] = None
+    ra_view_offset: Optional[float] = None
+    dec_view_offset: Optional[float] = None
+    label_size: Optional[int] = None
+    show_labels: Optional[bool] = None
+    # Output filename, like Settings.out_file_name. If None, Settings.out_file_name is used
+    out_file_name: Optional[str] = None
+
+    def apply(self, render_params: RenderParams) -> RenderParams:
+        return replace(render_params, **{name: getattr(self, name) for name in _OUTPUT_FIELDS
+                                         if getattr(self, name) is not None})
 
-    def _stellarium_cmd(self, script_path: Path, output_dir: Path):
-        cmd = (f"stellarium --full-screen no "
-               f"--startup-script {script_path.absolute()} "
-               f"--screenshot-dir {output_dir.absolute()}")
 
-        if self._cpu_limit > 0:
-            limit = int(self._cpu_limit * multiprocessing.cpu_count() * 100)
-            cmd = f"cpulimit -l {limit} -i {cmd}"
+@dataclass
+class SettleParams:
+    # Frame rate while the script waits for the window size and for the scene to settle.
+    # Stellarium runs at 1 fps otherwise, to keep the cpu usage of software rendering low.
+    fps: float = 10
+    # How often the script checks whether the window has its new size, in seconds
+    interval: float = 0.25
+    # Seconds the script waits once the window has its size and the view is in place, so
+    # stellarium can finish loading catalogs and textures before the screenshot. This is
+    # a fixed delay: the scripting API doesn't tell when loading is done. The default is the
+    # 10 s the script always waited. Shorter delays are faster, but only safe once
+    # benchmarks/bench_settle.py shows they give the same image on the rendering machine.
+    delay: float = 10.0
+
+    @classmethod
+    def fixed(cls, seconds: float = 10.0) -> "SettleParams":
+        """Waits `seconds` at 1 fps, like the script did originally."""
+        return cls(fps=1, interval=1.0, delay=seconds)
+
+
+async def capture_outputs(markers: MarkerReader, display: str, outputs: Sequence[RenderParams],
+                          out_paths: Sequence[Path], screenshot_dir: Path, timeouts: Dict[str, float],
+                          on_phase: Callable[[str], None]):
+    """
+    Follows a running render script through all of its outputs: resizes the window
+    whenever the script asks for it, and moves every screenshot to its output path.
+    The move is atomic, and only a rename if `screenshot_dir` is on the same filesystem.
+    """
+    logger.info("Waiting for rendering loop to start")
+    await markers.wait("[SGW] render_loop", timeouts["render_loop"])
+    on_phase("render_loop")
+
+    for i, (params, out_path) in enumerate(zip(outputs, out_paths)):
+        await markers.wait(f"[SGW] resize {i} ", timeouts["screen_sized"])
+
+        logger.info(f"Resizing stellarium window to {params.image_width}x{params.image_height}")
+        await fit_window(display, params.image_width, params.image_height, timeouts["window"])
+
+        logger.info("Waiting for resize")
+        await markers.wait(f"[SGW] screen_sized {i}", timeouts["screen_sized"])
+        on_phase("screen_sized")
+
+        logger.info("Waiting for the scene to settle")
+        await markers.wait(f"[SGW] settled {i} ", timeouts["settled"])
+        on_phase("settled")
+
+        logger.info("Waiting for screenshot")
+        await markers.wait(f"[SGW] shot {i}", timeouts["done"])
+        on_phase("done")
+
+        logger.info(f"Saving screenshot to '{out_path}'")
+        place(screenshot_dir / f"screenshot_{i}.png", out_path)
+        on_phase("file_move")
+
+    await markers.wait("[SGW] done", timeouts["done"])
 
-        return f"WAYLAND_DISPLAY= DISPLAY=:99 {cmd}"
 
-    def _xvfb_cmd(self):
-        return f"Xvfb :99 -screen 0 {self._render_params.image_width}x{self._render_params.image_height}x24"
+class Renderer:
+    """
+    Renders one event with a fresh Xvfb + Stellarium. `render_params` can be a list, to
+    produce several outputs (e.g. sizes or views) of the same event in one session. The
+    outputs only differ in the fields of OutputSpec, everything else is taken from the
+    first of them. Xvfb and stellarium run under `limits`, and their resource usage is
+    reported when the render ends.
+    """
+    TEMPLATE_PATH = Path(__file__).parent / "screenshot.ssc"
+
+    def __init__(self, render_params: Union[RenderParams, Sequence[RenderParams]],
+                 limits: Optional[ResourceLimits] = None, display: str = ":99", tmp_root: Optional[Path] = None,
+                 phase_timeouts: Optional[Dict[str, float]] = None,
+                 settle: Optional[SettleParams] = None):
+        self._render_script = self.TEMPLATE_PATH.read_text()
+        self._outputs = self.as_outputs(render_params)
+        self._limits = limits
+        self._display = display
+        self._tmp_root = tmp_root
+        self._phase_timeouts = resolve_phase_timeouts(phase_timeouts)
+        self._settle = settle
+        self._on_phase: Callable[[str], None] = lambda phase: None
 
     @staticmethod
-    async def _wait_stdout(process, key: str):
-        while key not in (l := (await process.stdout.readline()).decode().rstrip()):
-            logger.debug("[stdout] %s", l)
-            pass
+    def as_outputs(render_params: Union[RenderParams, Sequence[RenderParams]]) -> List[RenderParams]:
+        if isinstance(render_params, RenderParams):
+            return [render_params]
+        return list(render_params)
 
     @staticmethod
-    async def _get_window_id():
-        proc = await asyncio.create_subprocess_shell("DISPLAY=:99 xdotool search --onlyvisible stellarium",
-                                                     shell=True,
-                                                     stdout=asyncio.subprocess.PIPE,
-                                                     stderr=asyncio.subprocess.DEVNULL)
-        stdout, _ = await proc.communicate()
-        return int(stdout.decode().strip())
-
-    async def _render(self, out_path: Path):
-        with tempfile.TemporaryDirectory() as tmp_dir:
+    def screen_size(outputs: Sequence[RenderParams]) -> Tuple[int, int]:
+        """Size of the X screen that fits all of `outputs`."""
+        return max(p.image_width for p in outputs), max(p.image_height for p in outputs)
+
+    @classmethod
+    def make_script(cls, render_params: Union[RenderParams, Sequence[RenderParams]], quit_on_done: bool = True,
+                    template: Optional[str] = None, settle: Optional[SettleParams] = None) -> str:
+        if template is None:
+            template = cls.TEMPLATE_PATH.read_text()
+        if settle is None:
+            settle = SettleParams()
+        outputs = cls.as_outputs(render_params)
+        values = asdict(outputs[0])
+        values["outputs"] = json.dumps([{name: getattr(p, name) for name in _OUTPUT_FIELDS} for p in outputs])
+        values.update({f"settle_{k}": v for k, v in asdict(settle).items()})
+        values["show_marker"] = "true" if outputs[0].show_marker else "false"
+        values["quit_on_done"] = "true" if quit_on_done else "false"
+        return Template(template).safe_substitute(values)
+
+    def _stellarium_cmd(self, script_path: Path, output_dir: Path):
+        return (f"WAYLAND_DISPLAY= DISPLAY={self._display} stellarium --full-screen no "
+                f"--startup-script {script_path.absolute()} "
+                f"--screenshot-dir {output_dir.absolute()}")
+
+    async def _render(self, out_paths: List[Path]):
+        timeouts = self._phase_timeouts
+        width, height = self.screen_size(self._outputs)
+        # Stellarium writes the screenshots next to the first output, so moving them into
+        # place is a rename instead of a copy of the whole image
+        out_dir = out_paths[0].parent
+        out_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=self._tmp_root) as tmp_dir, \
+                tempfile.TemporaryDirectory(dir=out_dir, prefix=".sgw-") as screenshot_dir:
             # write render script with actual render parameters set
             script_file = Path(tmp_dir) / 'screenshot.ssc'
-            template = Template(self._render_script)
-            script_file.write_text(template.safe_substitute(asdict(self._render_params)))
+            script_file.write_text(self.make_script(self._outputs, template=self._render_script,
+                                                    settle=self._settle))
 
             p_xvfb = None
             p_stellarium = None
+            markers = None
+            resources = ResourceGroup(self._limits, name=f"render{self._display.lstrip(':')}")
 
             try:
+                await resources.setup()
+
                 # Run Xvfb
-                logger.info(f"Running Xvfb server: {self._xvfb_cmd()}")
-                p_xvfb = await asyncio.create_subprocess_shell(self._xvfb_cmd(),
-                                                               stderr=asyncio.subprocess.DEVNULL)
-                await asyncio.sleep(3.0)
+                logger.info(f"Running Xvfb server on {self._display}")
+                p_xvfb = await start_xvfb(self._display, width, height, timeouts["xvfb"], resources.wrap_exec)
+                resources.track(p_xvfb.pid)
+                self._on_phase("xvfb_up")
 
                 # Run stellarium
-                cmd = self._stellarium_cmd(script_file, Path(tmp_dir))
+                cmd = resources.wrap_shell(self._stellarium_cmd(script_file, Path(screenshot_dir)))
                 logger.info(f"Running stellarium: {cmd}")
                 p_stellarium = await asyncio.create_subprocess_shell(cmd, shell=True,
                                                                      stdout=asyncio.subprocess.PIPE,
-                                                                     stderr=asyncio.subprocess.STDOUT)
-
-                # Wait until we are rendering
-                logger.info("Waiting for rendering loop to start")
-                await self._wait_stdout(p_stellarium, "[SGW] render_loop")
-
-                # Resize the window to the correct size
-                logger.info("Resizing stellarium window")
-                window_id = await self._get_window_id()
-                await asyncio.create_subprocess_shell(f"DISPLAY=:99 xdotool windowmove {window_id} 0 0", shell=True)
-                await asyncio.create_subprocess_shell(f"DISPLAY=:99 xdotool windowsize "
-                                                      f"{window_id} {self._render_params.image_width} "
-                                                      f"{self._render_params.image_height}", shell=True)
+                                                                     stderr=asyncio.subprocess.STDOUT,
+                                                                     start_new_session=True)
+                resources.track(p_stellarium.pid, group=True)
+                markers = MarkerReader(p_stellarium)
 
-                logger.info("Waiting for resize")
-                await self._wait_stdout(p_stellarium, "[SGW] screen_sized")
-
-                logger.info("Waiting for screenshot")
-                await self._wait_stdout(p_stellarium, "[SGW] done")
-
-                logger.info(f"Saving screenshot to '{out_path}'")
-                screenshot = Path(tmp_dir) / "screenshot.png"
-                shutil.move(screenshot, out_path)
+                await capture_outputs(markers, self._display, self._outputs, out_paths, Path(screenshot_dir),
+                                      timeouts, self._on_phase)
 
                 logger.info("Done")
             finally:
-                async with asyncio.timeout(5):
-                    if p_xvfb:
-                        p_xvfb.terminate()
-                        await p_xvfb.wait()
-                    if p_stellarium:
-                        p_stellarium.terminate()
-                        await p_stellarium.wait()
+                if markers is not None:
+                    markers.close()
+                # Without cgroups, only running processes can be measured
+                resources.report()
+                await terminate(p_stellarium, p_xvfb)
+                await resources.close()
 
             return True
 
-    def render(self, out_path: Union[str, Path], timeout: Optional[float] = None):
-        out_path = str(out_path)
-
-        async def _render_task():
-            try:
-                async with asyncio.timeout(timeout):
-                    return await self._render(out_path)
-            except TimeoutError:
-                logger.warning("Rendering timed out, terminating")
-            return False
+    @staticmethod
+    async def _cancel_on(event: asyncio.Event, task: asyncio.Task):
+        await event.wait()
+        task.cancel()
+
+    async def render(self, out_path: Union[str, Path, Sequence[Union[str, Path]]], timeout: Optional[float] = None,
+                     cancel: Optional[asyncio.Event] = None,
+                     on_phase: Optional[Callable[[str], None]] = None) -> bool:
+        """
+        Renders to `out_path`, or to one path per output. Returns True if all outputs were written,
+        and False if the render failed, timed out or was cancelled through `cancel`.
+        """
+        out_paths = [Path(out_path)] if isinstance(out_path, (str, Path)) else [Path(p) for p in out_path]
+        if len(out_paths) != len(self._outputs):
+            raise ValueError(f"Got {len(out_paths)} output paths for {len(self._outputs)} outputs")
+        if on_phase is not None:
+            self._on_phase = on_phase
 
         timeout_str = "without a timeout"
         if timeout is not None:
@@ -155,7 +266,26 @@ class Renderer:
         logger.info(f"Starting render {timeout_str}")
 
         t_start = time.time()
-        result = asyncio.run(_render_task())
+        result = False
+        task = asyncio.create_task(self._render(out_paths))
+        watcher = None
+        if cancel is not None:
+            watcher = asyncio.create_task(self._cancel_on(cancel, task))
+        try:
+            async with asyncio.timeout(timeout):
+                result = await task
+        except TimeoutError:
+            logger.warning("Rendering timed out, terminating")
+        except ReadinessError as e:
+            logger.warning(f"Rendering failed: {e}")
+        except asyncio.CancelledError:
+            # Only a cancelled render is a result, cancelling the caller isn't
+            if cancel is None or not cancel.is_set() or asyncio.current_task().cancelling():
+                raise
+            logger.warning("Rendering cancelled, terminating")
+        finally:
+            if watcher is not None:
+                watcher.cancel()
 
         logger.info(f"Rendering finished. result={result}, dt={time.time() - t_start:.2f} s")
         return result
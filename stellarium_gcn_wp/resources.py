@@ -0,0 +1,320 @@
+import asyncio
+import itertools
+import logging
+import os
+import shlex
+import shutil
+from dataclasses import dataclass, replace
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from stellarium_gcn_wp import metrics
+
+logger = logging.getLogger(__name__)
+
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+# Period of cgroup cpu quotas, in microseconds
+CPU_PERIOD = 100000
+
+MODES = ("auto", "cgroup", "systemd", "nice", "none")
+
+render_cpu_seconds = metrics.registry.histogram("sgw_render_cpu_seconds", "Cpu time used by the processes of a render")
+render_peak_memory = metrics.registry.gauge("sgw_render_peak_memory_bytes", "Peak memory use of the last render")
+
+
+@dataclass
+class ResourceLimits:
+    """
+    Limits for the processes of a render, i.e. Xvfb and stellarium with everything they start.
+
+    `cpu_quota` is the share of all cpus they may use together, between (0, 1], or unlimited
+    if it is not positive. `cpu_weight` is their share of contended cpu time relative to other
+    processes, which have a weight of 100, so renders can use idle cores at full speed but
+    back off as soon as anything else wants them. `memory_max` is in bytes.
+
+    `mode` is how the limits are applied:
+      cgroup:  in a new child of `cgroup_parent`, a cgroup v2 directory delegated to us
+      systemd: in a slice of the systemd user manager, with a scope per process started
+               through systemd-run
+      nice:    with the idle cpu scheduler, the idle io class and `nice` level. This can't
+               enforce the quota or the memory limit.
+      none:    not at all
+      auto:    the first of cgroup, systemd and nice that works here
+    """
+    cpu_quota: float = -1
+    cpu_weight: int = 20
+    memory_max: Optional[int] = None
+    nice: int = 10
+    mode: str = "auto"
+    cgroup_parent: Optional[str] = None
+
+    def __post_init__(self):
+        if self.mode not in MODES:
+            raise ValueError(f"Unknown resource control mode '{self.mode}', must be one of {', '.join(MODES)}")
+
+    def share(self, workers: int) -> "ResourceLimits":
+        """The limits of one of `workers` renders running at the same time."""
+        if self.cpu_quota <= 0:
+            return self
+        return replace(self, cpu_quota=self.cpu_quota / workers)
+
+
+@dataclass
+class ResourceUsage:
+    cpu_seconds: float
+    # None if the kernel doesn't report it
+    peak_memory: Optional[int] = None
+
+    def __str__(self):
+        memory = "unknown" if self.peak_memory is None else f"{self.peak_memory / 2 ** 20:.0f} MiB"
+        return f"cpu={self.cpu_seconds:.1f} s, peak memory={memory}"
+
+
+def _writable_cgroup(path: Path) -> bool:
+    if not (path / "cgroup.controllers").exists() or not os.access(path / "cgroup.procs", os.W_OK):
+        return False
+    try:
+        # Children only get the controllers their parent enables for them
+        (path / "cgroup.subtree_control").write_text("+cpu +memory")
+    except OSError as e:
+        logger.warning(f"Can't enable the cpu and memory controllers in {path}: {e}")
+        return False
+    return True
+
+
+def _systemd_user_manager() -> bool:
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    return (shutil.which("systemd-run") is not None and runtime_dir is not None
+            and Path(runtime_dir, "systemd", "private").exists())
+
+
+@lru_cache
+def resolve_mode(mode: str, cgroup_parent: Optional[str] = None) -> str:
+    """The mode that `mode` ends up as here, e.g. nice for cgroup if `cgroup_parent` can't be used."""
+    if mode in ("cgroup", "auto") and cgroup_parent is not None:
+        if _writable_cgroup(Path(cgroup_parent)):
+            return "cgroup"
+        logger.warning(f"{cgroup_parent} is not a writable cgroup v2 directory")
+    if mode in ("cgroup", "systemd", "auto"):
+        if _systemd_user_manager():
+            return "systemd"
+        if mode != "auto":
+            logger.warning(f"Can't use resource control mode '{mode}', falling back to scheduling priorities")
+    if mode == "none":
+        return "none"
+    return "nice"
+
+
+async def _systemctl(*args: str, timeout: float = 10.0):
+    # Runs `systemctl --user` without blocking the event loop, raises RuntimeError if it fails
+    process = await asyncio.create_subprocess_exec("systemctl", "--user", *args,
+                                                   stdout=asyncio.subprocess.DEVNULL,
+                                                   stderr=asyncio.subprocess.PIPE)
+    try:
+        async with asyncio.timeout(timeout):
+            _, stderr = await process.communicate()
+    except TimeoutError:
+        raise RuntimeError(f"systemctl {args[0]} didn't finish within {timeout} s") from None
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+    if process.returncode != 0:
+        raise RuntimeError(stderr.decode().strip() or f"exit code {process.returncode}")
+
+
+def _cgroup_of(pid: int) -> Optional[Path]:
+    try:
+        for line in Path(f"/proc/{pid}/cgroup").read_text().splitlines():
+            if line.startswith("0::"):
+                return CGROUP_ROOT / line[3:].lstrip("/")
+    except OSError:
+        pass
+    return None
+
+
+def _cgroup_usage(path: Path) -> Optional[ResourceUsage]:
+    try:
+        stat = dict(line.split() for line in (path / "cpu.stat").read_text().splitlines())
+    except (OSError, ValueError):
+        return None
+    peak = None
+    for name in ("memory.peak", "memory.current"):
+        try:
+            peak = int((path / name).read_text())
+            break
+        except (OSError, ValueError):
+            continue
+    return ResourceUsage(int(stat.get("usage_usec", 0)) / 1e6, peak)
+
+
+def _process_usage(pids: Set[int], groups: Set[int]) -> ResourceUsage:
+    # Sums the processes in `pids` and in the process groups `groups` that are still running
+    ticks = os.sysconf("SC_CLK_TCK")
+    cpu = 0.0
+    peak = 0
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            # The command name in parentheses can contain spaces
+            fields = (entry / "stat").read_text().rsplit(")", 1)[1].split()
+            if int(entry.name) not in pids and int(fields[2]) not in groups:
+                continue
+            cpu += (int(fields[11]) + int(fields[12])) / ticks
+            for line in (entry / "status").read_text().splitlines():
+                if line.startswith("VmHWM:"):
+                    peak += int(line.split()[1]) * 1024
+        except (OSError, IndexError, ValueError):
+            continue
+    return ResourceUsage(cpu, peak)
+
+
+class ResourceGroup:
+    """
+    The processes of one render, limited by `limits`. After setup(), commands are started
+    through wrap_exec() or wrap_shell(), which put them, and everything they start, under the
+    limits, and are then registered with track(), so usage() can report what they used
+    together. close() cleans up once they have exited.
+    """
+    _ids = itertools.count()
+
+    def __init__(self, limits: Optional[ResourceLimits] = None, name: str = "render"):
+        self._limits = limits if limits is not None else ResourceLimits(mode="none")
+        self.mode = resolve_mode(self._limits.mode, self._limits.cgroup_parent)
+        self._pids: Set[int] = set()
+        self._groups: Set[int] = set()
+        self._cgroup: Optional[Path] = None
+        # The systemd slice that all processes of the render go into, so the limits apply to
+        # them together instead of to each process
+        self._slice: Optional[str] = None
+        self._slice_cgroup: Optional[Path] = None
+        self._name = name
+        self._id = next(self._ids)
+
+    async def setup(self):
+        """Creates the cgroup or systemd slice, or falls back to scheduling priorities if that fails."""
+        if self.mode == "systemd":
+            # A dash would nest the slice in parent slices
+            unit = f"sgw_{self._name}_{os.getpid()}_{self._id}.slice"
+            try:
+                await _systemctl("set-property", "--runtime", unit, *self._systemd_properties())
+                self._slice = unit
+            except (OSError, RuntimeError) as e:
+                logger.warning(f"Failed to set up systemd slice {unit}, falling back to scheduling priorities: {e}")
+                self.mode = "nice"
+        elif self.mode == "cgroup":
+            path = Path(self._limits.cgroup_parent) / f"sgw-{self._name}-{os.getpid()}-{self._id}"
+            try:
+                path.mkdir()
+                self._cgroup = path
+                for file, value in self._cgroup_settings().items():
+                    (path / file).write_text(value)
+            except OSError as e:
+                logger.warning(f"Failed to set up cgroup {path}, falling back to scheduling priorities: {e}")
+                self._remove_cgroup()
+                self.mode = "nice"
+
+    def _quota_percent(self) -> float:
+        return self._limits.cpu_quota * os.cpu_count() * 100
+
+    def _cgroup_settings(self) -> Dict[str, str]:
+        settings = {"cpu.weight": str(self._limits.cpu_weight)}
+        if self._limits.cpu_quota > 0:
+            settings["cpu.max"] = f"{int(self._quota_percent() / 100 * CPU_PERIOD)} {CPU_PERIOD}"
+        if self._limits.memory_max is not None:
+            settings["memory.max"] = str(self._limits.memory_max)
+        return settings
+
+    def _systemd_properties(self) -> List[str]:
+        properties = [f"CPUWeight={self._limits.cpu_weight}"]
+        if self._limits.cpu_quota > 0:
+            properties.append(f"CPUQuota={self._quota_percent():.0f}%")
+        if self._limits.memory_max is not None:
+            properties.append(f"MemoryMax={self._limits.memory_max}")
+        return properties
+
+    def _prefix(self) -> List[str]:
+        if self.mode == "systemd":
+            return ["systemd-run", "--user", "--scope", "--quiet", "--collect", f"--slice={self._slice}"]
+        if self.mode == "nice":
+            cmd = []
+            if shutil.which("chrt") is not None:
+                cmd += ["chrt", "--idle", "0"]
+            if shutil.which("ionice") is not None:
+                cmd += ["ionice", "-c", "3"]
+            return cmd + ["nice", "-n", str(self._limits.nice)]
+        return []
+
+    def wrap_exec(self, argv: List[str]) -> List[str]:
+        """The arguments to run `argv` under the limits. The process keeps its pid."""
+        if self._cgroup is not None:
+            procs = shlex.quote(str(self._cgroup / "cgroup.procs"))
+            return ["sh", "-c", f'echo $$ > {procs} && exec "$@"', "sh", *argv]
+        return self._prefix() + list(argv)
+
+    def wrap_shell(self, cmd: str) -> str:
+        """The shell command to run `cmd` under the limits."""
+        if self._cgroup is not None:
+            return f"echo $$ > {shlex.quote(str(self._cgroup / 'cgroup.procs'))} && {cmd}"
+        prefix = self._prefix()
+        if not prefix:
+            return cmd
+        return f"{shlex.join(prefix)} sh -c {shlex.quote(cmd)}"
+
+    def track(self, pid: int, group: bool = False):
+        """Counts `pid`, or with `group` its whole process group, in usage()."""
+        (self._groups if group else self._pids).add(pid)
+
+    def usage(self) -> Optional[ResourceUsage]:
+        """
+        What the tracked processes used so far. With cgroups this is exact. Otherwise it only
+        covers processes that are still running, so it should be called before terminating them.
+        """
+        if self.mode == "systemd" and self._slice_cgroup is None:
+            # The slice is the parent of the scopes, and outlives them until close()
+            for path in map(_cgroup_of, self._pids | self._groups):
+                if path is not None and path.parent.name == self._slice:
+                    self._slice_cgroup = path.parent
+                    break
+        path = self._cgroup if self._cgroup is not None else self._slice_cgroup
+        if path is not None and (usage := _cgroup_usage(path)) is not None:
+            return usage
+        if not self._pids and not self._groups:
+            return None
+        return _process_usage(self._pids, self._groups)
+
+    def report(self, since: Optional[ResourceUsage] = None) -> Optional[ResourceUsage]:
+        """Logs usage(), minus the cpu time of an earlier usage() `since`, and adds it to the metrics."""
+        usage = self.usage()
+        if usage is not None and since is not None:
+            usage = replace(usage, cpu_seconds=max(0.0, usage.cpu_seconds - since.cpu_seconds))
+        if usage is not None:
+            logger.info(f"Render resource usage ({self.mode}): {usage}")
+            render_cpu_seconds.observe(usage.cpu_seconds)
+            if usage.peak_memory is not None:
+                render_peak_memory.set(usage.peak_memory)
+        return usage
+
+    async def close(self):
+        """Removes the cgroup or slice, once all processes in it have exited."""
+        if self._slice is not None:
+            # Reverting drops the runtime properties, which systemd would otherwise keep
+            for action in ("stop", "revert"):
+                try:
+                    await _systemctl(action, self._slice)
+                except (OSError, RuntimeError) as e:
+                    logger.warning(f"Failed to {action} systemd slice {self._slice}: {e}")
+            self._slice = None
+            self._slice_cgroup = None
+        self._remove_cgroup()
+
+    def _remove_cgroup(self):
+        if self._cgroup is None:
+            return
+        try:
+            self._cgroup.rmdir()
+        except OSError as e:
+            logger.warning(f"Failed to remove cgroup {self._cgroup}: {e}")
+        self._cgroup = None
@@ -1,11 +1,87 @@
+import inspect
+import json
 import os
 import random
-from dataclasses import dataclass
-from http.client import HTTPSConnection
+import time
+import tomllib
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Callable, Tuple
+from typing import Any, Callable, Dict, Tuple
 
 from stellarium_gcn_wp import hooks
+from stellarium_gcn_wp.priority import PriorityRule
+from stellarium_gcn_wp.renderer import OutputSpec, SettleParams
+from stellarium_gcn_wp.resources import ResourceLimits
+
+# Read at startup if it exists and no other config file is given, see _Settings.load()
+DEFAULT_CONFIG_PATH = "~/.config/stellarium-gcn-wp/settings.toml"
+
+# Names in config files for settings that are stored under a different name
+_CONFIG_ALIASES = {
+    "kafka_id": "_gcn_kafka_id",
+    "kafka_secret": "_gcn_kafka_secret",
+    "observer_location": "_oberserver_location",
+}
+
+
+def cached(path: str | None, ttl: float, resolve: Callable[[], Any]) -> Any:
+    """
+    Returns the value stored in the JSON file at `path` if it was written less than `ttl`
+    seconds ago. Otherwise calls `resolve` and stores its result there.
+    """
+    if path is None:
+        return resolve()
+    path = Path(path).expanduser()
+    try:
+        if time.time() - path.stat().st_mtime < ttl:
+            return json.loads(path.read_text())
+    except (OSError, ValueError):
+        pass
+    value = resolve()
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(value))
+    except OSError:
+        pass
+    return value
+
+
+def _lookup_location() -> Tuple[float, float]:
+    from http.client import HTTPSConnection
+
+    conn = HTTPSConnection("ipinfo.io", timeout=10)
+    try:
+        conn.request("GET", "/loc")
+        resp = conn.getresponse()
+        lat, lon = resp.readline().decode().strip().split(",")
+    finally:
+        conn.close()
+    return float(lat), float(lon)
+
+
+def _parse_env_value(value: str) -> Any:
+    # Values are TOML, e.g. 0.5, true or [1, 2], and anything else is a plain string
+    if not value:
+        return None
+    try:
+        return tomllib.loads(f"v = {value}")["v"]
+    except tomllib.TOMLDecodeError:
+        return value.strip("\"'")
+
+
+def _draw_offset(offset: float | Callable[..., float], rng: random.Random) -> float:
+    if not callable(offset):
+        return offset
+    try:
+        inspect.signature(offset).bind(rng)
+    except TypeError:
+        # Functions without parameters, from configs written before the generator was passed
+        # in, draw from the global one, so view_offset_seed doesn't apply to them
+        return offset()
+    except ValueError:
+        # No signature to check
+        pass
+    return offset(rng)
 
 
 @dataclass
@@ -21,6 +97,37 @@ class _Settings:
     # running, and you want to start of from where you left off last time.
     gcn_kafka_group_id: str = "stellarium-gcn-wp"
 
+    # In 'track' mode, received and rendered messages are recorded in this database,
+    # and the offsets of rendered messages are committed every commit_interval seconds.
+    commit_ledger_path: str = "~/.local/state/stellarium-gcn-wp/ledger.sqlite"
+    commit_interval: float = 5.0
+
+    # Default checkpoint for the 'backfill' command. A backfill that is interrupted continues
+    # where it left off when it is started again with the same checkpoint.
+    backfill_checkpoint_path: str = "~/.local/state/stellarium-gcn-wp/backfill.sqlite"
+
+    # Maximum number of notices waiting to be rendered. 0 means no limit.
+    max_queued_notices: int = 32
+
+    # On SIGTERM or SIGINT, renders in progress get this many seconds to finish before they
+    # are cancelled. A second signal cancels them right away.
+    shutdown_timeout: float = 60.0
+
+    # Notices are fetched from kafka in batches of up to kafka_batch_size, waiting at most
+    # kafka_batch_timeout seconds for a batch. Fetched notices that don't fit into the queue
+    # are kept in a buffer, and fetching is paused while it holds kafka_prefetch_bytes.
+    kafka_batch_size: int = 100
+    kafka_batch_timeout: float = 1.0
+    kafka_prefetch_bytes: int = 8 * 1024 ** 2
+    # Extra librdkafka consumer settings, e.g. {"fetch.max.bytes": 1048576}. The defaults
+    # keep librdkafka's own prefetch queue small, since notices are only a few kB each.
+    kafka_config: Dict[str, Any] = field(default_factory=lambda: {"queued.max.messages.kbytes": 4096})
+    # If set, only classic text notices with one of these in their NOTICE_TYPE are rendered,
+    # e.g. ("Gold",). Other notices are skipped before they are parsed.
+    notice_types: Tuple[str, ...] | None = None
+    # How often the consumer lag of each partition is updated in the metrics, in seconds
+    kafka_lag_interval: float = 30.0
+
     # Image output settings
     image_width: int = 1920
     image_height: int = 1200
@@ -28,32 +135,155 @@ class _Settings:
     projection: str = "ProjectionCylinder"
 
     # Limits cpu usage of rendering. Between (0, 1], where 1 allows 100% of cpu to be
-    # used. Setting this to a negative value disables cpu limiting completely
+    # used. Setting this to a negative value disables cpu limiting completely, so renders
+    # can use idle cores at full speed. Only enforced with cgroups, see render_resource_control.
     render_cpu_limit: float = 0.2
+    # Share of contended cpu time of renders, relative to the 100 of all other processes,
+    # so renders stay out of the way of interactive programs
+    render_cpu_weight: int = 20
+    # Limit on the memory of each render, in bytes. Only enforced with cgroups.
+    render_memory_limit: int | None = None
+    # Nice level of renders when cgroups are not available
+    render_nice: int = 10
+    # How the limits above are applied to renders: "cgroup" (in children of render_cgroup,
+    # a cgroup v2 directory we may write to), "systemd" (in systemd user slices), "nice"
+    # (idle scheduling priorities only), "none" or "auto" (the first of these that works),
+    # see resources.ResourceLimits
+    render_resource_control: str = "auto"
+    render_cgroup: str | None = None
 
     # Timeout for the renderer, in seconds. Note that rendering will take a long time,
     # in general, since we are running stellarium in Xvfb (so it runs in the background),
     # which means we are doing software-rendering
     render_timeout: float = 25 * 60
 
+    # Time limits for the individual phases of a render, so a render that hangs, e.g. because
+    # stellarium never starts its script, fails early instead of using up render_timeout.
+    # Phases that are not given here use the defaults in readiness.DEFAULT_PHASE_TIMEOUTS.
+    render_phase_timeouts: Dict[str, float] | None = None
+
+    # How long the render script lets the scene settle before taking the screenshot. This
+    # is a fixed delay, 10 s by default, see SettleParams. E.g. SettleParams(delay=2.0)
+    # renders faster, if benchmarks/bench_settle.py shows it still gives the same image.
+    render_settle: SettleParams = field(default_factory=SettleParams)
+
+    # Number of renders that can run at the same time. Each worker runs its own Xvfb
+    # on a free display number, starting at render_display_base, and gets an equal
+    # share of render_cpu_limit.
+    render_workers: int = 1
+    render_display_base: int = 99
+
+    # Order in which queued notices are rendered. Each notice gets the priority of the
+    # first rule it matches (0 if none), and higher priorities are rendered first.
+    priority_rules: Tuple[PriorityRule, ...] = (
+        PriorityRule("gold", 20, notice_type="gold", max_age=86400),
+        PriorityRule("bronze_signal", 10, notice_type="bronze", min_signalness=0.5, max_age=86400),
+        PriorityRule("recent", 5, max_age=86400),
+    )
+    # Waiting notices gain one priority level every this many seconds, so older and
+    # low priority notices are still rendered while new alerts keep arriving
+    priority_aging: float | None = 60.0
+    # When all workers are busy, cancel the least important render and queue it again if a
+    # notice that is at least this many levels more important arrives. None disables this.
+    priority_preempt_margin: int | None = 10
+
+    # Keep a Xvfb + stellarium instance running for each worker and send renders to it
+    # through stellarium's RemoteControl plugin, instead of starting both for every render.
+    # This saves the startup time on each render, at the cost of keeping stellarium
+    # in memory. Workers use consecutive ports starting at render_server_port.
+    render_server: bool = False
+    render_server_port: int = 8090
+
+    # If set, serve prometheus metrics (notice counts and the time spent in each stage
+    # of the pipeline) on http://127.0.0.1:<metrics_port>/metrics
+    metrics_port: int | None = None
+
+    # If set, the timeline of every notice through the pipeline is appended to this
+    # file, as one JSON object per line
+    trace_file: str | None = None
+
     # Output filename for each generated render. You can use any property of
     # the GCNNotice dataclass in this format string. See gcn_parser.py
-    out_file_name = "~/Pictures/stellarium-gcn/wallpaper_{evt_num}_{revision}.png"
+    # With several outputs, {output} is the name of the output. If it isn't used, the
+    # name is appended to the filename.
+    out_file_name: str = "~/Pictures/stellarium-gcn/wallpaper_{evt_num}_{revision}.png"
 
-    # Functions called with the path of the path of the rendered image.
-    # Can be set to one of the functions in hooks.py to automatically set the
-    # desktop wallpaper
+    # Images to render for every event, e.g. for different monitors. All of them are
+    # rendered in one stellarium session. If empty, a single image is rendered with the
+    # settings above. For example:
+    #   (OutputSpec("desktop", 3840, 2160), OutputSpec("ultrawide", 3440, 1440, fov=200),
+    #    OutputSpec("lockscreen", 1920, 1200, show_labels=False))
+    outputs: Tuple[OutputSpec, ...] = ()
+
+    # Extra files made in the background next to every rendered image: a copy in each of
+    # output_formats ("webp" or "jpeg"), with output_quality, and thumbnails that are
+    # thumbnail_widths pixels wide, in thumbnail_format. These need Pillow.
+    output_formats: Tuple[str, ...] = ()
+    output_quality: int = 85
+    thumbnail_widths: Tuple[int, ...] = ()
+    thumbnail_format: str = "webp"
+    # If set, every parsed notice, with the images rendered for it and their variants, is recorded
+    # in this sqlite database, so past events can be looked up with the 'archive' command, e.g.
+    # "~/.local/state/stellarium-gcn-wp/archive.sqlite"
+    archive_path: str | None = None
+
+    # Functions called with the path of the path of the rendered image (the first one,
+    # with several outputs). Can be set to one of the functions in hooks.py to
+    # automatically set the desktop wallpaper. Use hooks.on_output to pick another
+    # output, e.g. hooks.on_output("lockscreen", hooks.kde_set_lockscreen), hooks.Command
+    # to run a command, e.g. hooks.Command(["feh", "--bg-fill", "{path}"]), or
+    # hooks.DirectoryPublisher / hooks.RsyncPublisher to copy all outputs somewhere else
     post_render_callbacks: Tuple[Callable[[Path], None]] = (hooks.kde_set_wallpaper,
                                                             hooks.kde_set_lockscreen)
 
+    # The callbacks run in the background, up to this many at a time. Each callback runs
+    # for one notice at a time, in the order the notices were rendered.
+    hook_workers: int = 4
+    # Each attempt of a callback is abandoned after this many seconds
+    hook_timeout: float = 60.0
+    # Failed or timed out callbacks are retried this many times, this many seconds apart
+    hook_retries: int = 1
+    hook_retry_delay: float = 5.0
+
     # Observer location can be a tuple of (lat, lon) or None, in which case
     # the location will be set based on the host machines (ip-based) location
     _oberserver_location: tuple[float, float] | None = (-89.99, -63.453056)
+    # The location looked up from the ip address is kept in this file for
+    # observer_location_ttl seconds, so it isn't looked up again on every start
+    observer_location_cache: str | None = "~/.cache/stellarium-gcn-wp/location.json"
+    observer_location_ttl: float = 24 * 60 * 60
+    _resolved_location: tuple[float, float] | None = field(default=None, repr=False)
+
+    # Directory to cache rendered images in, so re-delivered notices don't have to be
+    # rendered again. Set to None to disable the cache. Entries are evicted when they are
+    # older than render_cache_max_age seconds, or least recently used first when the cache
+    # is larger than render_cache_max_bytes. Either limit can be None.
+    # Note that the cache only hits if the view offsets below are the same for each
+    # render of an event, see view_offset_seed.
+    render_cache_dir: str | None = None
+    render_cache_max_bytes: int | None = 2 * 1024 ** 3
+    render_cache_max_age: float | None = 30 * 24 * 60 * 60
+
+    # Directory to cache renders of the sky without the event marker and labels in. If set,
+    # and Pillow is installed, the marker and labels are drawn onto a cached base layer
+    # instead of rendering the whole image with stellarium, which makes new revisions of
+    # an event nearly instant. Base layers are shared by events within base_layer_time_bucket
+    # seconds and base_layer_view_grid degrees of each other, and are evicted with the
+    # same limits as the render cache. Like the render cache, this needs view_offset_seed.
+    base_layer_cache_dir: str | None = None
+    base_layer_time_bucket: float = 10 * 60
+    base_layer_view_grid: float = 1.0
 
     # The offset of the viewpoint from the direction of the rendered event.
-    # If this is 0,0 the event will be exactly in the center of the image
-    _ra_view_offset: float | Callable[[], float] = lambda: random.uniform(-50, 50)
-    _dec_view_offset: float | Callable[[], float] = lambda: random.uniform(-20, 20)
+    # If this is 0,0 the event will be exactly in the center of the image.
+    # Functions are called with a random number generator to draw the offset from, or
+    # without arguments if they take none.
+    _ra_view_offset: float | Callable[..., float] = lambda rng: rng.uniform(-50, 50)
+    _dec_view_offset: float | Callable[..., float] = lambda rng: rng.uniform(-20, 20)
+
+    # If set, the random number generator for the view offsets is seeded with this value
+    # and the run and event number, so every render of an event uses the same view.
+    view_offset_seed: str | None = None
 
     @property
     def gcn_kafka_id(self):
@@ -78,24 +308,68 @@ class _Settings:
     @property
     def observer_location(self):
         if self._oberserver_location is None:
-            conn = HTTPSConnection("ipinfo.io")
-            conn.request("GET", "/loc")
-            resp = conn.getresponse()
-            lat, lon = resp.readline().decode().strip().split(",")
-            return float(lat), float(lon)
+            if self._resolved_location is None:
+                self._resolved_location = tuple(cached(self.observer_location_cache, self.observer_location_ttl,
+                                                       _lookup_location))
+            return self._resolved_location
         return self._oberserver_location
 
     @property
-    def ra_view_offset(self):
-        if isinstance(self._ra_view_offset, Callable):
-            return self._ra_view_offset()
-        return self._ra_view_offset
+    def render_outputs(self) -> Tuple[OutputSpec, ...]:
+        return self.outputs or (OutputSpec("default"),)
+
+    @property
+    def screen_size(self) -> Tuple[int, int]:
+        """The X screen size needed for all outputs"""
+        return (max(o.image_width or self.image_width for o in self.render_outputs),
+                max(o.image_height or self.image_height for o in self.render_outputs))
 
     @property
-    def dec_view_offset(self):
-        if isinstance(self._dec_view_offset, Callable):
-            return self._dec_view_offset()
-        return self._dec_view_offset
+    def render_limits(self) -> ResourceLimits:
+        return ResourceLimits(cpu_quota=self.render_cpu_limit, cpu_weight=self.render_cpu_weight,
+                              memory_max=self.render_memory_limit, nice=self.render_nice,
+                              mode=self.render_resource_control, cgroup_parent=self.render_cgroup)
+
+    def load(self, path: str | Path):
+        """
+        Overrides settings with the values from a TOML file, or from an env file (any other
+        extension) with one NAME=value line per setting. Names are those of the settings
+        above, optionally upper case and prefixed with STELLARIUM_GCN_, e.g.
+        STELLARIUM_GCN_RENDER_WORKERS=2. Only settings with plain values, i.e. strings,
+        numbers, booleans and lists can be set in a file.
+        """
+        path = Path(path).expanduser()
+        if path.suffix == ".toml":
+            with open(path, "rb") as f:
+                values = tomllib.load(f)
+        else:
+            values = {}
+            for line in path.read_text().splitlines():
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                key, sep, value = line.removeprefix("export ").partition("=")
+                if not sep:
+                    raise ValueError(f"Invalid line in {path}: {line}")
+                values[key.strip()] = _parse_env_value(value.strip())
+
+        for key, value in values.items():
+            name = key.lower().removeprefix("stellarium_gcn_")
+            name = _CONFIG_ALIASES.get(name, name)
+            if name not in vars(self) and f"_{name}" in vars(self):
+                name = f"_{name}"
+            if name not in vars(self) or name == "_resolved_location":
+                raise ValueError(f"Unknown setting '{key}' in {path}")
+            if isinstance(value, list):
+                value = tuple(value)
+            setattr(self, name, value)
+
+    def view_offsets(self, run_num: int, evt_num: int) -> Tuple[float, float]:
+        rng = random
+        if self.view_offset_seed is not None:
+            rng = random.Random(f"{self.view_offset_seed}:{run_num}:{evt_num}")
+
+        return _draw_offset(self._ra_view_offset, rng), _draw_offset(self._dec_view_offset, rng)
 
 
 Settings = _Settings()
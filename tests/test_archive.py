@@ -0,0 +1,128 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from stellarium_gcn_wp import archive as archive_module
+from stellarium_gcn_wp.archive import EventArchive, angular_distance, notice_time
+from stellarium_gcn_wp.gcn_parser import GCNNotice
+from stellarium_gcn_wp.hook_executor import HookExecutor
+from stellarium_gcn_wp.main import Settings, handle_notice
+from stellarium_gcn_wp.output_pipeline import OutputProcessor
+from stellarium_gcn_wp.render_queue import QueuedNotice
+
+GOLD = "ICECUBE Astrotrack Gold"
+BRONZE = "ICECUBE Astrotrack Bronze"
+
+
+def make_notice(evt_num: int, ra: float = 0.0, dec: float = 0.0, tjd: int = 21330, sod: int = 0,
+                notice_type: str = GOLD, revision: int = 0) -> GCNNotice:
+    return GCNNotice(notice_type=notice_type, run_num=1, evt_num=evt_num, ra=ra, dec=dec, tjd=tjd, sod=sod,
+                     gal_lon=0.0, gal_lat=0.0, energy=100.0, signalness=0.5, revision=revision)
+
+
+@pytest.fixture(params=["numpy", "python"])
+def archive(request, tmp_path, monkeypatch):
+    if request.param == "python":
+        monkeypatch.setattr(archive_module, "_numpy", lambda: None)
+    else:
+        pytest.importorskip("numpy")
+    archive = EventArchive(tmp_path / "archive.sqlite")
+    yield archive
+    archive.close()
+
+
+def evt_nums(results) -> list:
+    return [n.notice.evt_num for n in results]
+
+
+def test_angular_distance(archive):
+    assert angular_distance(10.0, 20.0, [10.0, 10.0, 190.0], [20.0, 25.0, 20.0]) == pytest.approx([0.0, 5.0, 140.0])
+
+
+def test_cone_search_wraps_around_ra_zero(archive):
+    archive.record(make_notice(1, ra=359.0, dec=10.0))
+    archive.record(make_notice(2, ra=1.5, dec=10.0))
+    archive.record(make_notice(3, ra=180.0, dec=10.0))
+    archive.record(make_notice(4, ra=5.0, dec=10.0))
+
+    assert sorted(evt_nums(archive.cone_search(0.5, 10.0, 3.0))) == [1, 2]
+    assert sorted(evt_nums(archive.cone_search(359.5, 10.0, 3.0))) == [1, 2]
+    # The same position, the other way around
+    assert sorted(evt_nums(archive.cone_search(-0.5, 10.0, 3.0))) == [1, 2]
+    [found] = archive.cone_search(1.5, 10.0, 0.5)
+    assert found.distance == pytest.approx(0.0, abs=1e-6)
+
+
+def test_cone_search_around_the_pole(archive):
+    # Far apart in ra, but close to each other over the pole
+    archive.record(make_notice(1, ra=0.0, dec=88.0))
+    archive.record(make_notice(2, ra=180.0, dec=88.0))
+    archive.record(make_notice(3, ra=90.0, dec=80.0))
+    archive.record(make_notice(4, ra=270.0, dec=-88.0))
+
+    assert sorted(evt_nums(archive.cone_search(0.0, 90.0, 5.0))) == [1, 2]
+    assert sorted(evt_nums(archive.cone_search(0.0, 88.0, 5.0))) == [1, 2]
+    assert sorted(evt_nums(archive.cone_search(45.0, 89.0, 11.0))) == [1, 2, 3]
+    assert evt_nums(archive.cone_search(0.0, -90.0, 5.0)) == [4]
+
+
+def test_cone_search_in_a_wide_box(archive):
+    # Close to the pole the box around the cone covers all ra
+    archive.record(make_notice(1, ra=100.0, dec=75.0))
+    archive.record(make_notice(2, ra=300.0, dec=75.0))
+    assert evt_nums(archive.cone_search(120.0, 80.0, 10.0)) == [1]
+
+
+def test_time_range_is_latest_first_with_the_latest_revisions(archive):
+    archive.record(make_notice(1, sod=100))
+    archive.record(make_notice(2, sod=200, notice_type=BRONZE))
+    archive.record(make_notice(2, sod=200, notice_type=BRONZE, revision=1))
+    archive.record(make_notice(3, tjd=21331))
+    start = notice_time(make_notice(0, sod=150))
+
+    assert evt_nums(archive.time_range()) == [3, 2, 1]
+    assert [n.notice.revision for n in archive.time_range()] == [0, 1, 0]
+    assert evt_nums(archive.time_range(start=start)) == [3, 2]
+    assert evt_nums(archive.time_range(end=start)) == [1]
+    assert evt_nums(archive.time_range(notice_type="bronze")) == [2]
+    assert len(archive.time_range(all_revisions=True)) == 4
+    assert evt_nums(archive.cone_search(0.0, 0.0, 1.0, start=start, end=notice_time(make_notice(0, tjd=21331)))) == [2]
+
+
+def test_outputs_are_added_to_a_recorded_notice(archive, tmp_path):
+    notice = make_notice(1)
+    processor = OutputProcessor(archive=archive)
+    processor.record(notice).result()
+    assert evt_nums(archive.time_range()) == [1]
+    assert archive.outputs(1, 1) == {}
+
+    processor.submit(notice, {"wallpaper": tmp_path / "wallpaper.png"}).result()
+    outputs = archive.outputs(1, 1)
+    assert outputs["wallpaper"]["path"] == str(tmp_path / "wallpaper.png")
+    assert outputs["wallpaper"]["variants"] == []
+    processor.shutdown(wait=False)
+
+
+def test_notices_whose_render_failed_are_archived(tmp_path, monkeypatch):
+    monkeypatch.setattr(Settings, "out_file_name", str(tmp_path / "wallpaper_{evt_num}.png"))
+
+    async def render(params, out_filenames, timeout, cancel, on_phase):
+        return False
+
+    async def run():
+        processor = OutputProcessor(archive=EventArchive(tmp_path / "archive.sqlite"))
+        hook_executor = HookExecutor([])
+        worker = SimpleNamespace(index=0, tmp_dir=tmp_path, render=render)
+        item = QueuedNotice(text="", notice=make_notice(1))
+        await handle_notice(item, worker, hook_executor, output_processor=processor)
+        processor.shutdown(wait=True)
+        await hook_executor.shutdown(wait=True)
+        return item
+
+    item = asyncio.run(run())
+    assert item.trace.result == "failed"
+    archive = EventArchive(tmp_path / "archive.sqlite")
+    assert evt_nums(archive.time_range()) == [1]
+    assert archive.outputs(1, 1) == {}
+    archive.close()
@@ -0,0 +1,85 @@
+from stellarium_gcn_wp.commit_ledger import CommitLedger
+
+TOPIC = "gcn.classic.text.ICECUBE_ASTROTRACK_GOLD"
+
+
+def receive(ledger: CommitLedger, *offsets: int, partition: int = 0):
+    for offset in offsets:
+        assert ledger.received(TOPIC, partition, offset)
+
+
+def test_out_of_order_completion(tmp_path):
+    ledger = CommitLedger(tmp_path / "ledger.sqlite")
+    receive(ledger, 0, 1, 2)
+    assert ledger.watermarks() == {(TOPIC, 0): 0}
+
+    # Nothing can be committed past 0 while it is still rendering
+    ledger.completed(TOPIC, 0, 2)
+    ledger.completed(TOPIC, 0, 1)
+    assert ledger.watermarks() == {(TOPIC, 0): 0}
+
+    ledger.completed(TOPIC, 0, 0)
+    assert ledger.watermarks() == {(TOPIC, 0): 3}
+    assert ledger.pending() == 0
+
+
+def test_gaps_in_offsets(tmp_path):
+    # Transaction markers and compacted messages leave gaps in the offsets
+    ledger = CommitLedger(tmp_path / "ledger.sqlite")
+    receive(ledger, 3, 7, 8)
+    ledger.completed(TOPIC, 0, 3)
+    assert ledger.watermarks() == {(TOPIC, 0): 7}
+    ledger.completed(TOPIC, 0, 8)
+    assert ledger.watermarks() == {(TOPIC, 0): 7}
+    ledger.completed(TOPIC, 0, 7)
+    assert ledger.watermarks() == {(TOPIC, 0): 9}
+
+
+def test_partitions_are_independent(tmp_path):
+    ledger = CommitLedger(tmp_path / "ledger.sqlite")
+    receive(ledger, 0, 1, partition=0)
+    receive(ledger, 10, partition=1)
+    ledger.completed(TOPIC, 0, 0)
+    ledger.completed(TOPIC, 1, 10)
+    assert ledger.watermarks() == {(TOPIC, 0): 1, (TOPIC, 1): 11}
+
+
+def test_restart_from_the_database(tmp_path):
+    path = tmp_path / "ledger.sqlite"
+    ledger = CommitLedger(path)
+    receive(ledger, 0, 1, 2, 3)
+    ledger.completed(TOPIC, 0, 0)
+    ledger.completed(TOPIC, 0, 2)
+    ledger.committed(TOPIC, 0, 1)
+    ledger.close()
+
+    ledger = CommitLedger(path)
+    assert ledger.positions() == {(TOPIC, 0): 1}
+    # Kafka redelivers everything from the committed offset on
+    assert not ledger.received(TOPIC, 0, 0)
+    assert ledger.received(TOPIC, 0, 1)
+    assert not ledger.received(TOPIC, 0, 2)
+    assert ledger.received(TOPIC, 0, 3)
+    assert ledger.watermarks() == {(TOPIC, 0): 1}
+
+    ledger.completed(TOPIC, 0, 1)
+    ledger.completed(TOPIC, 0, 3)
+    assert ledger.uncommitted() == [(TOPIC, 0, 4)]
+
+
+def test_uncommitted_after_failed_commit(tmp_path):
+    ledger = CommitLedger(tmp_path / "ledger.sqlite")
+    receive(ledger, 0, 1)
+    ledger.completed(TOPIC, 0, 0)
+    assert ledger.uncommitted() == [(TOPIC, 0, 1)]
+
+    # The commit failed, so committed() was never called and the offset is still due
+    ledger.completed(TOPIC, 0, 1)
+    assert ledger.uncommitted() == [(TOPIC, 0, 2)]
+
+    ledger.committed(TOPIC, 0, 2)
+    assert ledger.uncommitted() == []
+    receive(ledger, 2)
+    assert ledger.uncommitted() == []
+    ledger.completed(TOPIC, 0, 2)
+    assert ledger.uncommitted() == [(TOPIC, 0, 3)]
@@ -0,0 +1,80 @@
+import asyncio
+
+from confluent_kafka import KafkaError, KafkaException, TopicPartition
+
+from stellarium_gcn_wp.commit_ledger import CommitLedger
+from stellarium_gcn_wp.fake_kafka import FakeBroker, FakeConsumer
+from stellarium_gcn_wp.gcn_consumer import GCNConsumer
+
+TOPIC = "gcn.classic.text.ICECUBE_ASTROTRACK_GOLD"
+
+
+class FailingCommitConsumer(FakeConsumer):
+    def commit(self, message=None, offsets=None, asynchronous=True):
+        raise KafkaException(KafkaError(KafkaError.REQUEST_TIMED_OUT))
+
+
+def make_consumer(factory, **kwargs) -> GCNConsumer:
+    return GCNConsumer(asyncio.Queue(), topics=[TOPIC], consumer_factory=factory, **kwargs)
+
+
+def test_failed_commit_stays_uncommitted(tmp_path):
+    broker = FakeBroker()
+    ledger = CommitLedger(tmp_path / "ledger.sqlite")
+    ledger.received(TOPIC, 0, 0)
+    ledger.completed(TOPIC, 0, 0)
+    consumer = make_consumer(lambda config: FailingCommitConsumer(broker, config),
+                             start_on="track", ledger=ledger)
+
+    consumer._commit()
+    assert ledger.uncommitted() == [(TOPIC, 0, 1)]
+
+    consumer._consumer = broker.consumer({"group.id": "test"})
+    consumer._commit()
+    assert ledger.uncommitted() == []
+
+
+def test_rebalance_keeps_a_full_buffer_paused():
+    broker = FakeBroker()
+    consumer = make_consumer(broker.consumer, start_on="first", prefetch_bytes=0)
+    consumer._update_flow_control()
+    assert consumer._consumer._paused == {TOPIC}
+
+    # A rebalance revokes and assigns the partitions again
+    consumer._consumer.resume(consumer._consumer.assignment())
+    consumer._on_assign(consumer._consumer, [TopicPartition(TOPIC, 0)])
+    assert consumer._consumer._paused == {TOPIC}
+
+
+def test_fetched_batches_count_before_the_loop_receives_them():
+    broker = FakeBroker()
+    for i in range(5):
+        broker.produce(TOPIC, b"x" * 100)
+    handed_over = []
+
+    class StoppingConsumer(FakeConsumer):
+        consumed = 0
+
+        def consume(self, num_messages=1, timeout=-1):
+            StoppingConsumer.consumed += 1
+            consumer._keep_running = StoppingConsumer.consumed < 3
+            return super().consume(num_messages, timeout)
+
+    class Loop:
+        # Never runs the callbacks, like an event loop that is busy while the next batches are fetched
+        def call_soon_threadsafe(self, callback, *args):
+            handed_over.append((callback, args))
+
+    consumer = make_consumer(lambda config: StoppingConsumer(broker, config), start_on="first",
+                             prefetch_bytes=250, batch_size=3, batch_timeout=0.01)
+    consumer._keep_running = True
+    consumer._fetch(Loop())
+    # The first batch fills the buffer, so the next fetches don't get anything
+    assert [len(args[0]) for _, args in handed_over] == [3]
+    assert consumer._buffered_bytes == 300
+    assert consumer._consumer._paused == {TOPIC}
+
+    callback, args = handed_over[0]
+    callback(*args)
+    assert consumer._buffered_bytes == 300
+    assert len(consumer._buffer) == 3
@@ -0,0 +1,120 @@
+import json
+
+import pytest
+
+from stellarium_gcn_wp.gcn_parser import (GCNParser, GCNParseError, InvalidFieldError, MissingFieldError,
+                                          UnknownFormatError, equatorial_to_galactic)
+
+TEXT_NOTICE = """TITLE:            GCN/AMON NOTICE
+NOTICE_DATE:      Wed 06 Mar 24 21:24:46 UT
+NOTICE_TYPE:      ICECUBE Astrotrack Gold
+STREAM:           24
+RUN_NUM:          138966
+EVENT_NUM:        1234567
+SRC_RA:           53.7456d {+03h 34m 59s} (J2000),
+                  53.9845d {+03h 35m 56s} (current),
+                  53.1236d {+03h 32m 30s} (1950)
+SRC_DEC:          +2.3423d {+02d 20' 32"} (J2000),
+                  +2.3985d {+02d 23' 54"} (current),
+                  +2.1825d {+02d 10' 57"} (1950)
+DISCOVERY_DATE:   20375 TJD;    66 DOY;   24/03/06 (yy/mm/dd)
+DISCOVERY_TIME:   76937 SOD {21:22:17.00} UT
+REVISION:         1
+ENERGY:           2.3050e+02 [TeV]
+SIGNALNESS:       6.1523e-01 [dn]
+GAL_COORDS:       182.72,-40.82 [deg] galactic lon,lat of the event
+COMMENTS:         IceCube Gold event.
+"""
+
+VOEVENT_NOTICE = """<?xml version="1.0" encoding="UTF-8"?>
+<voe:VOEvent xmlns:voe="http://www.ivoa.net/xml/VOEvent/v2.0" role="observation" version="2.0">
+  <What>
+    <Param name="Packet_Type" value="173" />
+    <Param name="run_id" value="138966" />
+    <Param name="event_id" value="1234567" />
+    <Param name="Energy" value="230.5" />
+    <Param name="Signalness" value="0.61523" />
+    <Param name="Rev" value="1" />
+  </What>
+  <WhereWhen>
+    <ObsDataLocation><ObservationLocation><AstroCoords>
+      <Time><TimeInstant><ISOTime>2024-03-06T21:22:17</ISOTime></TimeInstant></Time>
+      <Position2D><Value2><C1>53.7456</C1><C2>2.3423</C2></Value2></Position2D>
+    </AstroCoords></ObservationLocation></ObsDataLocation>
+  </WhereWhen>
+</voe:VOEvent>
+"""
+
+JSON_NOTICE = json.dumps({"type": "ICECUBE Astrotrack Gold", "run_id": 138966, "event_id": 1234567,
+                          "ra": 53.7456, "dec": 2.3423, "trigger_time": "2024-03-06T21:22:17Z",
+                          "energy": 230.5, "signalness": 0.61523, "revision": 1})
+
+
+def check(notice):
+    assert notice.notice_type == "ICECUBE Astrotrack Gold"
+    assert (notice.run_num, notice.evt_num, notice.revision) == (138966, 1234567, 1)
+    assert (notice.ra, notice.dec) == (53.7456, 2.3423)
+    assert (notice.tjd, notice.sod) == (20375, 76937)
+    assert notice.gal_lon == pytest.approx(182.72, abs=0.01)
+    assert notice.gal_lat == pytest.approx(-40.82, abs=0.01)
+    assert notice.energy == pytest.approx(230.5)
+    assert notice.signalness == pytest.approx(0.61523)
+
+
+@pytest.mark.parametrize("notice, format", [(TEXT_NOTICE, "text"), (VOEVENT_NOTICE, "voevent"),
+                                            (JSON_NOTICE, "json")])
+def test_parse_each_format(notice, format):
+    assert GCNParser.detect_format(notice) == format
+    check(GCNParser.parse(notice))
+
+
+def test_equatorial_to_galactic():
+    # The galactic center and the north galactic pole
+    assert equatorial_to_galactic(266.40499, -28.93617) == pytest.approx((0.0, 0.0), abs=1e-4)
+    assert equatorial_to_galactic(192.85948, 27.12825)[1] == pytest.approx(90.0, abs=1e-4)
+
+
+def test_parse_text_with_crlf_line_endings():
+    # check() also makes sure no \r is left at the end of the notice type
+    check(GCNParser.parse(TEXT_NOTICE.replace("\n", "\r\n")))
+
+
+def test_missing_field():
+    with pytest.raises(MissingFieldError) as e:
+        GCNParser.parse(TEXT_NOTICE.replace("REVISION:", "REMARK:"))
+    assert e.value.field == "REVISION"
+    assert str(e.value) == "Notice is missing field 'REVISION'"
+    # It is still a KeyError, like before the typed errors
+    assert isinstance(e.value, KeyError)
+
+
+@pytest.mark.parametrize("notice, field", [
+    (TEXT_NOTICE.replace("53.7456d {+03h", "north {+03h"), "SRC_RA"),
+    (VOEVENT_NOTICE.replace('value="173"', 'value="999"'), "Packet_Type"),
+    (JSON_NOTICE.replace("2024-03-06T21:22:17Z", "yesterday"), "trigger_time"),
+])
+def test_invalid_field(notice, field):
+    with pytest.raises(InvalidFieldError) as e:
+        GCNParser.parse(notice)
+    assert e.value.field == field
+
+
+@pytest.mark.parametrize("notice", ["<VOEvent>", "{\"ra\": ", "[1, 2]"])
+def test_malformed_notice(notice):
+    with pytest.raises(GCNParseError):
+        GCNParser.parse(notice)
+
+
+def test_unknown_format():
+    with pytest.raises(UnknownFormatError):
+        GCNParser.parse(TEXT_NOTICE, format="avro")
+
+
+def test_parse_many_mixed_formats():
+    notices = [TEXT_NOTICE, "{}", VOEVENT_NOTICE, JSON_NOTICE]
+    results = GCNParser.parse_many(notices, skip_errors=True)
+    assert results[1] is None
+    for notice in results[:1] + results[2:]:
+        check(notice)
+    with pytest.raises(MissingFieldError):
+        GCNParser.parse_many(notices)
@@ -0,0 +1,52 @@
+import asyncio
+import json
+import time
+from pathlib import Path
+
+from stellarium_gcn_wp import metrics
+from stellarium_gcn_wp.hook_executor import HookExecutor
+
+
+def test_hook_runs_for_one_notice_at_a_time_in_order():
+    calls = []
+
+    def hook(path: Path):
+        # The first notice takes longer, so it would finish last if the runs overlapped
+        time.sleep(0.2 if path.name == "old.png" else 0.0)
+        calls.append(path.name)
+
+    async def run():
+        executor = HookExecutor([hook], workers=4, timeout=5, retries=0)
+        executor.submit({"main": Path("old.png")})
+        executor.submit({"main": Path("new.png")})
+        await executor.shutdown()
+
+    asyncio.run(run())
+    assert calls == ["old.png", "new.png"]
+
+
+def test_trace_is_written_once_the_hooks_are_done(tmp_path):
+    writer = metrics.TraceWriter(tmp_path / "trace.jsonl")
+    metrics.set_trace_writer(writer)
+
+    def hook(path: Path):
+        time.sleep(0.1)
+
+    async def run():
+        trace = metrics.Trace()
+        executor = HookExecutor([hook], workers=1, timeout=5, retries=0)
+        executor.submit({"main": Path("new.png")}, trace=trace)
+        # The queue finishes the notice while its hooks still run
+        trace.finish()
+        assert (tmp_path / "trace.jsonl").read_text() == ""
+        await executor.shutdown()
+
+    try:
+        asyncio.run(run())
+    finally:
+        metrics.set_trace_writer(None)
+        writer.close()
+    entry = json.loads((tmp_path / "trace.jsonl").read_text())
+    assert entry["result"] == "done"
+    assert [stage["stage"] for stage in entry["stages"]] == ["hook:hook"]
+    assert entry["hooks"] == {"hook": "ok"}
@@ -0,0 +1,101 @@
+import asyncio
+import io
+import json
+
+from stellarium_gcn_wp import main
+from stellarium_gcn_wp.hook_executor import HookExecutor
+from stellarium_gcn_wp.notice_files import read_notices, split_notices
+
+
+def make_text_notice(evt_num: int) -> str:
+    return f"""TITLE:            GCN/AMON NOTICE
+NOTICE_TYPE:      ICECUBE Astrotrack Gold
+RUN_NUM:          138966
+EVENT_NUM:        {evt_num}
+SRC_RA:           53.7456d {{+03h 34m 59s}} (J2000),
+SRC_DEC:          +2.3423d {{+02d 20' 32"}} (J2000),
+DISCOVERY_DATE:   20375 TJD;    66 DOY;   24/03/06 (yy/mm/dd)
+DISCOVERY_TIME:   76937 SOD {{21:22:17.00}} UT
+REVISION:         0
+ENERGY:           2.3050e+02 [TeV]
+SIGNALNESS:       6.1523e-01 [dn]
+GAL_COORDS:       182.72,-40.82 [deg] galactic lon,lat of the event
+"""
+
+
+MALFORMED = """TITLE:            GCN/AMON NOTICE
+NOTICE_TYPE:      ICECUBE Astrotrack Gold
+RUN_NUM:          138966
+"""
+
+
+def render_files(paths, monkeypatch) -> tuple:
+    """Runs main.render_files without rendering, and returns the parsed notices and the failure count."""
+    rendered = []
+
+    async def render_notices(items, hook_executor, skip_existing, output_processor):
+        rendered.extend(item.notice for item in items)
+        return len(rendered), 0
+
+    monkeypatch.setattr(main, "render_notices", render_notices)
+    failed = asyncio.run(main.render_files(paths, HookExecutor([])))
+    return rendered, failed
+
+
+def test_split_notices():
+    text = "\n" + make_text_notice(1) + "\n\n" + make_text_notice(2)
+    assert [n.strip() for n in split_notices(text)] == [make_text_notice(1).strip(), make_text_notice(2).strip()]
+    assert split_notices(" \n") == []
+    voevent = '<?xml version="1.0"?>\n<voe:VOEvent>\nTITLE: not a notice\n</voe:VOEvent>\n'
+    assert split_notices(voevent) == [voevent]
+
+
+def test_several_notices_in_one_file(tmp_path):
+    path = tmp_path / "notices.txt"
+    path.write_text(make_text_notice(1) + make_text_notice(2) + make_text_notice(3))
+    single = tmp_path / "single.txt"
+    single.write_text(make_text_notice(4))
+
+    notices = list(read_notices([str(path), str(single)]))
+    assert [source for source, _ in notices] == [str(path), f"{path}:1", f"{path}:2", str(single)]
+    assert [text for _, text in notices] == [make_text_notice(i) for i in range(1, 5)]
+
+
+def test_directories_globs_and_missing_paths(tmp_path):
+    for i in (2, 1):
+        (tmp_path / f"{i}.txt").write_text(make_text_notice(i))
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "3.txt").write_text(make_text_notice(3))
+
+    assert [text for _, text in read_notices([str(tmp_path)])] == [make_text_notice(1), make_text_notice(2)]
+    assert len(list(read_notices([str(tmp_path / "**" / "*.txt")]))) == 3
+    assert list(read_notices([str(tmp_path / "missing.txt")])) == []
+
+
+def test_stdin(monkeypatch):
+    monkeypatch.setattr("sys.stdin", io.StringIO(make_text_notice(1) + make_text_notice(2)))
+    assert list(read_notices(["-"])) == [("<stdin>:0", make_text_notice(1)), ("<stdin>:1", make_text_notice(2))]
+
+
+def test_malformed_notice_in_the_middle_of_a_batch(tmp_path, monkeypatch):
+    path = tmp_path / "notices.txt"
+    path.write_text(make_text_notice(1) + MALFORMED + make_text_notice(3))
+    monkeypatch.setattr("sys.stdin", io.StringIO(make_text_notice(4)))
+
+    rendered, failed = render_files([str(path), "-"], monkeypatch)
+    assert [n.evt_num for n in rendered] == [1, 3, 4]
+    assert failed == 1
+
+
+def test_malformed_jsonl_lines_in_the_middle_of_a_batch(tmp_path, monkeypatch):
+    path = tmp_path / "notices.jsonl"
+    path.write_text("\n".join([json.dumps({"notice": make_text_notice(1)}),
+                               '{"notice": "TITLE: ',
+                               json.dumps({"text": make_text_notice(2)}),
+                               "",
+                               json.dumps({"notice": make_text_notice(3)})]) + "\n")
+
+    assert [source for source, _ in read_notices([str(path)])] == [f"{path}:{i}" for i in (1, 2, 3, 5)]
+    rendered, failed = render_files([str(path)], monkeypatch)
+    assert [n.evt_num for n in rendered] == [1, 3]
+    assert failed == 2
@@ -0,0 +1,148 @@
+import asyncio
+import math
+from dataclasses import replace
+from pathlib import Path
+
+import pytest
+
+from stellarium_gcn_wp import overlay
+from stellarium_gcn_wp.overlay import (PROJECTIONS, BaseLayerCompositor, SkyProjector, base_layer_params,
+                                       overlay_params)
+from stellarium_gcn_wp.render_cache import RenderCache
+from stellarium_gcn_wp.renderer import RenderParams
+
+# J2000.0 itself (JD 2451545.0), so precession is the identity and the sidereal time at
+# Greenwich is 280.46061837 degrees
+J2000_TJD, J2000_SOD = 11544, 43200
+J2000_GMST = 280.46061837
+
+WIDTH, HEIGHT = 1000, 800
+
+
+def make_params(projection: str = "ProjectionCylinder", fov: float = 60.0, **kwargs) -> RenderParams:
+    values = dict(image_width=WIDTH, image_height=HEIGHT, fov=fov, projection=projection,
+                  ra_view_offset=0.0, dec_view_offset=0.0, observer_lat=90.0, observer_lon=0.0,
+                  ra=0.0, dec=30.0, tjd=J2000_TJD, sod=J2000_SOD, marker_color="#ff0000",
+                  evt_str="evt", date_str="date", pos_str="pos", en_str="en")
+    values.update(kwargs)
+    return RenderParams(**values)
+
+
+@pytest.mark.parametrize("projection", list(PROJECTIONS))
+def test_view_center_is_the_image_center(projection):
+    params = make_params(projection, ra=123.4, dec=-20.0, ra_view_offset=10.0, dec_view_offset=5.0,
+                         observer_lat=52.5, observer_lon=13.4)
+    x, y = SkyProjector(params).project(133.4, -15.0)
+    assert x == pytest.approx(WIDTH / 2, abs=1e-3)
+    assert y == pytest.approx(HEIGHT / 2, abs=1e-3)
+
+
+# Distance from the center of a point 10 degrees above it, in pixels, with a 60 degree fov
+# on the smaller, 800 pixel side of the image
+ABOVE_10_DEG = {
+    "ProjectionPerspective": 400 * math.tan(math.radians(10)) / math.tan(math.radians(30)),
+    "ProjectionStereographic": 400 * math.tan(math.radians(5)) / math.tan(math.radians(15)),
+    "ProjectionEqualArea": 400 * math.sin(math.radians(5)) / math.sin(math.radians(15)),
+    "ProjectionFisheye": 400 / 3,
+    "ProjectionOrthographic": 400 * math.sin(math.radians(10)) / math.sin(math.radians(30)),
+    "ProjectionCylinder": 400 / 3,
+    "ProjectionMercator": 400 * math.atanh(math.sin(math.radians(10))) / math.radians(30),
+}
+
+
+@pytest.mark.parametrize("projection", list(PROJECTIONS))
+def test_point_above_the_center(projection):
+    # At the north pole the zenith is the celestial pole, so higher dec is straight up
+    x, y = SkyProjector(make_params(projection)).project(0.0, 40.0)
+    assert x == pytest.approx(WIDTH / 2, abs=1e-3)
+    assert y == pytest.approx(HEIGHT / 2 - ABOVE_10_DEG[projection], abs=1e-3)
+
+
+def test_point_to_the_east():
+    # At the north pole, the view frame is the equatorial frame turned about the pole: with
+    # the view at ra 0, dec 30, right is toward ra -90 and forward is (cos 30, 0, sin 30)
+    dec = math.radians(30)
+    p = (math.cos(dec) * math.cos(math.radians(10)), math.cos(dec) * math.sin(math.radians(10)), math.sin(dec))
+    right = -p[1]
+    forward = p[0] * math.cos(dec) + p[2] * math.sin(dec)
+
+    x, y = SkyProjector(make_params("ProjectionCylinder")).project(10.0, 30.0)
+    assert x == pytest.approx(WIDTH / 2 + math.atan2(right, forward) * 400 / math.radians(30), abs=1e-3)
+    # East is on the left
+    assert x < WIDTH / 2
+
+    x, _ = SkyProjector(make_params("ProjectionPerspective")).project(10.0, 30.0)
+    assert x == pytest.approx(WIDTH / 2 + right / forward * 400 / math.tan(math.radians(30)), abs=1e-3)
+
+
+def test_sidereal_time_places_the_meridian():
+    # On the equator, the meridian at ra = local sidereal time goes through the zenith, so
+    # looking 30 degrees south of it, a point 10 degrees further north is straight above
+    params = make_params("ProjectionCylinder", observer_lat=0.0, observer_lon=20.0,
+                         ra=(J2000_GMST + 20.0) % 360, dec=-30.0)
+    x, y = SkyProjector(params).project(params.ra, -20.0)
+    assert x == pytest.approx(WIDTH / 2, abs=1e-3)
+    assert y == pytest.approx(HEIGHT / 2 - 400 / 3, abs=1e-3)
+
+
+def test_behind_the_view():
+    projector = SkyProjector(make_params("ProjectionPerspective"))
+    assert projector.project(180.0, -30.0) is None
+
+
+def test_unsupported_projection():
+    with pytest.raises(overlay.UnsupportedProjectionError):
+        SkyProjector(make_params("ProjectionHammer"))
+
+
+def test_nearby_events_share_a_base_layer():
+    params = make_params(ra=53.74, dec=2.34, sod=76937)
+    base = base_layer_params(params, time_bucket=600, view_grid=1.0)
+    assert (base.ra, base.dec, base.tjd, base.sod) == (54.0, 2.0, J2000_TJD, 76800)
+    assert not base.show_marker and not base.show_labels and base.evt_str == ""
+
+    # A later revision with a refined position, a few minutes later
+    revision = make_params(ra=53.61, dec=2.49, sod=77100, evt_str="rev 1")
+    assert RenderCache.key(base_layer_params(revision, 600, 1.0)) == RenderCache.key(base)
+
+    for other in (make_params(ra=54.6, dec=2.34, sod=76937), make_params(ra=53.74, dec=2.34, sod=77400)):
+        assert RenderCache.key(base_layer_params(other, 600, 1.0)) != RenderCache.key(base)
+
+
+def test_base_layer_grid_wraps_ra_and_clamps_dec():
+    base = base_layer_params(make_params(ra=359.8, dec=89.9), time_bucket=600, view_grid=1.0)
+    assert (base.ra, base.dec) == (0.0, 90.0)
+
+
+def test_overlay_keeps_the_view_of_the_base_layer():
+    params = make_params(ra=53.74, dec=2.34, sod=76937, ra_view_offset=10.0, dec_view_offset=-5.0)
+    base = base_layer_params(params, 600, 1.0)
+    drawn = overlay_params(params, base)
+    assert (drawn.ra, drawn.dec) == (params.ra, params.dec)
+    assert (drawn.tjd, drawn.sod) == (base.tjd, base.sod)
+    assert drawn.ra + drawn.ra_view_offset == pytest.approx(base.ra + base.ra_view_offset)
+    assert drawn.dec + drawn.dec_view_offset == pytest.approx(base.dec + base.dec_view_offset)
+
+
+def test_compositor_renders_each_base_layer_once(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    rendered = []
+
+    async def render(params, paths):
+        for p, path in zip(params, paths):
+            rendered.append(p)
+            Image.new("RGB", (p.image_width, p.image_height)).save(path)
+        return True
+
+    async def run():
+        compositor = BaseLayerCompositor(RenderCache(tmp_path / "cache"), time_bucket=600, view_grid=1.0)
+        first = make_params(ra=53.74, dec=2.34, sod=76937)
+        revision = replace(first, ra=53.61, evt_str="rev 1")
+        elsewhere = replace(first, ra=120.0)
+        for i, params in enumerate((first, revision, elsewhere)):
+            remaining = await compositor.render({"main": (params, tmp_path / f"{i}.png")}, render, tmp_path)
+            assert remaining == {}
+            assert (tmp_path / f"{i}.png").exists()
+
+    asyncio.run(run())
+    assert [(p.ra, p.dec) for p in rendered] == [(54.0, 2.0), (120.0, 2.0)]
@@ -0,0 +1,103 @@
+import datetime
+import time
+
+from stellarium_gcn_wp.gcn_parser import GCNNotice, datetime_to_tjd_sod
+from stellarium_gcn_wp.priority import DEFAULT_RULE, PriorityPolicy, PriorityRule
+from stellarium_gcn_wp.render_queue import QueuedNotice, RenderQueue
+
+GOLD = PriorityRule("gold", 10, notice_type="gold")
+BRONZE = PriorityRule("bronze", 0, notice_type="bronze")
+
+
+def make_notice(notice_type: str = "ICECUBE Astrotrack Gold", evt_num: int = 1, signalness: float = 0.5,
+                energy: float = 100.0, tjd: int = 21330, sod: int = 0) -> GCNNotice:
+    return GCNNotice(notice_type=notice_type, run_num=1, evt_num=evt_num, ra=0.0, dec=0.0, tjd=tjd, sod=sod,
+                     gal_lon=0.0, gal_lat=0.0, energy=energy, signalness=signalness, revision=0)
+
+
+def make_item(notice_type: str, evt_num: int, enqueued=None) -> QueuedNotice:
+    return QueuedNotice(text="", notice=make_notice(notice_type, evt_num), enqueued=enqueued)
+
+
+def test_first_matching_rule_wins():
+    rules = [PriorityRule("strong", 20, notice_type="gold", min_signalness=0.8, min_energy=200.0),
+             PriorityRule("gold", 10, notice_type="GOLD"),
+             PriorityRule("energetic", 5, min_energy=500.0)]
+    policy = PriorityPolicy(rules)
+    assert policy.rule(make_notice(signalness=0.9, energy=300.0)).name == "strong"
+    assert policy.rule(make_notice(signalness=0.9, energy=100.0)).name == "gold"
+    assert policy.rule(make_notice(signalness=0.5, energy=300.0)).name == "gold"
+    assert policy.rule(make_notice("ICECUBE Astrotrack Bronze", energy=600.0)).name == "energetic"
+    assert policy.rule(make_notice("ICECUBE Astrotrack Bronze")) is DEFAULT_RULE
+    assert policy.rule(None) is DEFAULT_RULE
+
+
+def test_max_age():
+    now = time.time()
+    tjd, sod = datetime_to_tjd_sod(datetime.datetime.utcfromtimestamp(now - 3600))
+    rule = PriorityRule("fresh", 10, max_age=2 * 3600)
+    assert rule.matches(make_notice(tjd=tjd, sod=sod), now)
+    assert not rule.matches(make_notice(tjd=tjd, sod=sod), now + 2 * 3600)
+
+
+def test_order_by_priority_then_age():
+    queue = RenderQueue(policy=PriorityPolicy([GOLD, BRONZE]))
+    items = [make_item("Bronze", 1), make_item("Gold", 2), make_item("Bronze", 3), make_item("Gold", 4)]
+    for item in items:
+        queue.put_nowait(item)
+    assert [queue.get_nowait().notice.evt_num for _ in items] == [2, 4, 1, 3]
+
+
+def test_aging_lets_a_waiting_notice_overtake_a_higher_class():
+    now = time.monotonic()
+    queue = RenderQueue(policy=PriorityPolicy([GOLD, BRONZE], aging=1.0))
+    # 10 levels apart, so bronze needs to wait more than 10 s to overtake gold
+    queue.put_nowait(make_item("Bronze", 1, enqueued=now - 15))
+    queue.put_nowait(make_item("Bronze", 2, enqueued=now - 5))
+    queue.put_nowait(make_item("Gold", 3, enqueued=now))
+    assert [queue.get_nowait().notice.evt_num for _ in range(3)] == [1, 3, 2]
+
+
+def test_preempt_margin():
+    policy = PriorityPolicy([GOLD, BRONZE], preempt_margin=5)
+    assert policy.should_preempt(0, 10)
+    assert policy.should_preempt(5, 10)
+    assert not policy.should_preempt(6, 10)
+    assert not PriorityPolicy([GOLD, BRONZE]).should_preempt(0, 10)
+
+    for margin, preempted in ((5, True), (11, False)):
+        queue = RenderQueue(policy=PriorityPolicy([GOLD, BRONZE], preempt_margin=margin), workers=1)
+        queue.put_nowait(make_item("Bronze", 1))
+        running = queue.get_nowait()
+        queue.put_nowait(make_item("Gold", 2))
+        assert running.cancel.is_set() == preempted
+        assert running.preempted == preempted
+
+
+def test_no_preemption_while_a_worker_is_free():
+    queue = RenderQueue(policy=PriorityPolicy([GOLD, BRONZE], preempt_margin=5), workers=2)
+    queue.put_nowait(make_item("Bronze", 1))
+    running = queue.get_nowait()
+    queue.put_nowait(make_item("Gold", 2))
+    assert not running.cancel.is_set()
+
+
+def test_each_notice_is_preempted_at_most_max_preemptions_times():
+    queue = RenderQueue(policy=PriorityPolicy([GOLD, BRONZE], preempt_margin=5, max_preemptions=1), workers=1)
+    queue.put_nowait(make_item("Bronze", 1))
+    bronze = queue.get_nowait()
+    queue.put_nowait(make_item("Gold", 2))
+    assert bronze.preempted
+
+    # The preempted render goes back into the queue, behind the gold notice
+    queue.done(bronze)
+    assert not bronze.preempted and not bronze.cancel.is_set()
+    gold = queue.get_nowait()
+    assert gold.notice.evt_num == 2
+    queue.done(gold)
+    assert queue.get_nowait() is bronze
+    assert bronze.preemptions == 1
+
+    queue.put_nowait(make_item("Gold", 3))
+    assert not bronze.cancel.is_set()
+    assert not bronze.preempted
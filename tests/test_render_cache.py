@@ -0,0 +1,38 @@
+import os
+import time
+
+from stellarium_gcn_wp.render_cache import RenderCache
+
+
+def write(path, size: int):
+    path.write_bytes(b"\0" * size)
+    return path
+
+
+def test_evicts_least_recently_used_first(tmp_path):
+    cache = RenderCache(tmp_path / "cache", max_bytes=250)
+    cache.put("a", write(tmp_path / "a.png", 100))
+    cache.put("b", write(tmp_path / "b.png", 100))
+    now = time.time()
+    os.utime(cache.lookup("a"), (now - 200, now - 200))
+    os.utime(cache.lookup("b"), (now - 100, now - 100))
+
+    # Using a makes it the most recently used entry, so b goes when c doesn't fit anymore
+    assert cache.lookup("a") is not None
+    cache.put("c", write(tmp_path / "c.png", 100))
+    assert cache.lookup("b") is None
+    assert cache.lookup("a") is not None
+    assert cache.lookup("c") is not None
+
+    assert cache.get("a", tmp_path / "out.png")
+    assert (tmp_path / "out.png").read_bytes() == b"\0" * 100
+    assert not cache.get("b", tmp_path / "missing.png")
+
+
+def test_expires_old_entries(tmp_path):
+    cache = RenderCache(tmp_path / "cache", max_age=60)
+    cache.put("a", write(tmp_path / "a.png", 10))
+    path = cache.lookup("a")
+    os.utime(path, (time.time() - 120, time.time() - 120))
+    assert cache.lookup("a") is None
+    assert not path.exists()
@@ -0,0 +1,38 @@
+import asyncio
+
+from stellarium_gcn_wp.gcn_parser import GCNNotice
+from stellarium_gcn_wp.priority import PriorityPolicy, PriorityRule
+from stellarium_gcn_wp.render_pool import RenderPool, RenderWorker
+from stellarium_gcn_wp.render_queue import QueuedNotice, RenderQueue
+
+
+def make_item(notice_type: str, run_num: int, evt_num: int) -> QueuedNotice:
+    notice = GCNNotice(notice_type=notice_type, run_num=run_num, evt_num=evt_num, ra=0.0, dec=0.0,
+                       tjd=21330, sod=0, gal_lon=0.0, gal_lat=0.0, energy=100.0, signalness=0.5, revision=0)
+    return QueuedNotice(text="", notice=notice)
+
+
+def test_once_renders_the_notice_that_preempted_the_first_one():
+    async def run():
+        policy = PriorityPolicy([PriorityRule("gold", 10, notice_type="gold")], preempt_margin=5)
+        queue = RenderQueue(policy=policy, workers=1)
+        started = asyncio.Event()
+        rendered = []
+
+        async def handler(item: QueuedNotice, worker: RenderWorker):
+            started.set()
+            if item.notice.evt_num == 11:
+                # The bronze render runs until it is preempted
+                await item.cancel.wait()
+                return
+            rendered.append(item.notice.evt_num)
+
+        pool = RenderPool(queue, handler, workers=1, display_base=180)
+        await queue.put(make_item("ICECUBE Astrotrack Bronze", 1, 11))
+        running = asyncio.create_task(pool.run(once=True))
+        await started.wait()
+        await queue.put(make_item("ICECUBE Astrotrack Gold", 2, 22))
+        await asyncio.wait_for(running, 5)
+        return rendered
+
+    assert asyncio.run(run()) == [22]
@@ -0,0 +1,94 @@
+import asyncio
+from collections import Counter
+
+from stellarium_gcn_wp.gcn_parser import GCNNotice
+from stellarium_gcn_wp.render_queue import QueuedNotice, RenderQueue
+
+
+def make_item(evt_num: int, revision: int, run_num: int = 1) -> QueuedNotice:
+    notice = GCNNotice(notice_type="ICECUBE Astrotrack Gold", run_num=run_num, evt_num=evt_num, ra=0.0, dec=0.0,
+                       tjd=21330, sod=0, gal_lon=0.0, gal_lat=0.0, energy=100.0, signalness=0.5,
+                       revision=revision)
+    return QueuedNotice(text="", notice=notice)
+
+
+class Recorder:
+    def __init__(self):
+        self.done = Counter()
+        self.items = {}
+
+    def __call__(self, item: QueuedNotice):
+        self.done[id(item)] += 1
+        self.items[id(item)] = item
+
+
+def test_newer_revision_replaces_queued_one():
+    recorder = Recorder()
+    queue = RenderQueue(on_done=recorder)
+    old, new, older = make_item(7, 1), make_item(7, 2), make_item(7, 0)
+    for item in (old, new, older):
+        queue.put_nowait(item)
+
+    assert queue.qsize() == 1
+    assert queue.get_nowait() is new
+    # Both dropped revisions are finished right away, the one that is rendered isn't yet
+    assert recorder.done == {id(old): 1, id(older): 1}
+    assert old.trace.result == older.trace.result == "superseded"
+    assert queue.unfinished_tasks == 1
+
+
+def test_other_events_are_not_coalesced():
+    queue = RenderQueue()
+    items = [make_item(7, 0), make_item(8, 0), make_item(7, 0, run_num=2)]
+    for item in items:
+        queue.put_nowait(item)
+    assert [queue.get_nowait() for _ in items] == items
+
+
+def test_newer_revision_cancels_render_in_flight():
+    recorder = Recorder()
+    queue = RenderQueue(on_done=recorder)
+    running = make_item(7, 1)
+    queue.put_nowait(running)
+    assert queue.get_nowait() is running
+
+    # Revisions that are not newer than the one rendering are dropped without cancelling it
+    duplicate = make_item(7, 1)
+    queue.put_nowait(duplicate)
+    assert not running.cancel.is_set()
+    assert duplicate.trace.result == "duplicate"
+    assert queue.empty()
+
+    newer = make_item(7, 2)
+    queue.put_nowait(newer)
+    assert running.cancel.is_set()
+    assert queue.get_nowait() is newer
+
+
+def test_done_callback_fires_once_per_item():
+    recorder = Recorder()
+
+    async def run():
+        queue = RenderQueue(on_done=recorder)
+        first = make_item(7, 0)
+        queue.put_nowait(first)
+        running = queue.get_nowait()
+        for revision in (1, 2, 0, 3):
+            queue.put_nowait(make_item(7, revision))
+        queue.put_nowait(make_item(8, 0))
+        queue.done(running)
+        while not queue.empty():
+            queue.done(queue.get_nowait())
+        await asyncio.wait_for(queue.join(), 1)
+        return queue, first
+
+    queue, first = asyncio.run(run())
+    assert queue.unfinished_tasks == 0
+    # 7 rev 0 (cancelled while rendering), 7 rev 1 and 2 (superseded), 7 rev 0 again (duplicate),
+    # 7 rev 3 and 8 rev 0 (rendered)
+    assert len(recorder.done) == 6
+    assert set(recorder.done.values()) == {1}
+    assert first.cancel.is_set()
+    rendered = sorted((item.notice.evt_num, item.revision) for item in recorder.items.values()
+                      if item.trace.result == "done")
+    assert (7, 3) in rendered and (8, 0) in rendered
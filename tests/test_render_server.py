@@ -0,0 +1,24 @@
+import asyncio
+import os
+from pathlib import Path
+
+import pytest
+
+from stellarium_gcn_wp.render_server import RenderServer
+
+STUB_DIR = Path(__file__).parent.parent / "benchmarks" / "stub"
+
+
+def test_failed_start_leaves_nothing_running(monkeypatch):
+    # The stub stellarium has no remote control, so it exits during startup
+    monkeypatch.setenv("PATH", f"{STUB_DIR}{os.pathsep}{os.environ['PATH']}")
+
+    async def run():
+        server = RenderServer(display=":193", port=18193, startup_timeout=5)
+        with pytest.raises(RuntimeError):
+            await server.start()
+        assert server._p_xvfb is None and server._p_stellarium is None
+        assert server._resources is None and server._tmp_dir is None
+        await server.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,24 @@
+import random
+
+from stellarium_gcn_wp.settings import _Settings
+
+
+def test_view_offsets_are_drawn_from_the_seeded_generator():
+    settings = _Settings(view_offset_seed="wallpaper")
+    first = settings.view_offsets(1, 2)
+    assert settings.view_offsets(1, 2) == first
+    assert settings.view_offsets(1, 3) != first
+    assert -50 <= first[0] <= 50 and -20 <= first[1] <= 20
+
+
+def test_view_offsets_accept_functions_without_parameters():
+    # Configs written before the generator was passed in
+    settings = _Settings(_ra_view_offset=lambda: 12.5, _dec_view_offset=lambda: random.uniform(-1, 1),
+                         view_offset_seed="wallpaper")
+    ra, dec = settings.view_offsets(1, 2)
+    assert ra == 12.5
+    assert -1 <= dec <= 1
+
+
+def test_fixed_view_offsets():
+    assert _Settings(_ra_view_offset=0.0, _dec_view_offset=-5.0).view_offsets(1, 2) == (0.0, -5.0)